@@ -0,0 +1,78 @@
+# 17 October 2026
+# Lisa Malins
+# BuildKmerIndex.py
+
+"""
+Converts Jellyfish dump file into a binary k-mer index, once per dump.
+CalcKmerScores.py accepts the index in place of the dump file and memory-maps it,
+so scoring runs skip the hours-long dump reload.
+
+With --backend mph, the index holds the minimal perfect hash of MphKmerDict.py
+instead, which is built one bucket of k-mers at a time through temporary files.
+
+Usage:
+python BuildKmerIndex.py dump.fa
+    Writes dump.kidx
+python BuildKmerIndex.py dump.fa --bloom-bits 12
+    Writes dump.kidx with Bloom filter for CalcKmerScores.py --bloom-bits
+python BuildKmerIndex.py dump.fa --backend mph --bloom-bits 12
+    Writes dump.kidx with minimal perfect hash and Bloom filter
+
+For more usage information:
+python BuildKmerIndex.py --help
+"""
+
+import sys
+import argparse
+try:
+    import numpy as np
+except ImportError:
+    exit("numpy not installed")
+from PackedKmerDict import PackedKmerDict
+from MphKmerDict import MphKmerDict
+from KmerEncoding import CONFLICT_POLICIES
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Build binary k-mer index from jellyfish dump file(s).\n")
+    parser.add_argument("dumps", nargs="+", help="jellyfish dump file(s) of k-mer counts")
+    parser.add_argument("-o", "--output", help="index filename (default: first dump filename with .kidx extension)")
+    parser.add_argument("-k", "--kmer-size", type=int, default=17, help="k-mer size (default: %(default)s)")
+    parser.add_argument("--count-bits", type=int, choices=[16, 32], default=16, \
+    help="bits per count; bigger counts go to overflow table (default: %(default)s)")
+    parser.add_argument("--bucket-bits", type=int, help="bits of each k-mer used for bucket index (default: chosen from number of k-mers)")
+    parser.add_argument("--canonical", action="store_true", \
+    help="store each k-mer under the smaller of it and its reverse complement, so every query is one lookup")
+    parser.add_argument("--conflict", choices=CONFLICT_POLICIES, default="max", \
+    help="with --canonical or mph backend, how to combine counts of a k-mer and its reverse complement (default: %(default)s)")
+    parser.add_argument("--backend", choices=["packed", "mph"], default="packed", \
+    help="k-mer dictionary stored in index, see CalcKmerScores.py (default: %(default)s)")
+    parser.add_argument("--count-cap", type=int, default=65535, \
+    help="mph backend: counts above this are stored as this (default: %(default)s)")
+    parser.add_argument("--fingerprint-bits", type=int, choices=[8, 16], default=16, \
+    help="mph backend: bits of fingerprint used to reject k-mers not in dump (default: %(default)s)")
+    parser.add_argument("--bloom-bits", type=int, default=0, \
+    help="store a Bloom filter of this many bits per k-mer in index, for CalcKmerScores.py --bloom-bits")
+    parser.add_argument("--tmp-dir", help="mph backend: directory for temporary files while building (default: system temporary directory)")
+
+    args = parser.parse_args()
+
+    if args.output is None:
+        args.output = args.dumps[0].rsplit('.', 1)[0] + ".kidx"
+    log = open("/dev/fd/1", 'w')
+
+    if args.backend == "mph":
+        if len(args.dumps) > 1:
+            exit("Minimal perfect hash index holds one dump; use the packed backend for more")
+        pkd = MphKmerDict(k=args.kmer_size, count_cap=args.count_cap, fingerprint_bits=args.fingerprint_bits, \
+            conflict=args.conflict, bloom_bits=args.bloom_bits, tmp_dir=args.tmp_dir)
+    else:
+        count_dtype = np.uint16 if args.count_bits == 16 else np.uint32
+        pkd = PackedKmerDict(k=args.kmer_size, bucket_bits=args.bucket_bits, count_dtype=count_dtype, \
+            canonical=args.canonical, conflict=args.conflict)
+    for dump in args.dumps:
+        pkd.Populate(dump, log)
+    # Bloom filter of packed index over keys of every dump, built once
+    if args.backend == "packed" and args.bloom_bits:
+        pkd.BuildBloom(log, args.bloom_bits)
+    pkd.Save(args.output, log)
+    sys.stderr.write("K-mer index written to " + args.output + "\n")
@@ -3,92 +3,168 @@
 # CalcKmerScores.py
 
 """
-Reads 17-mers and counts from jellyfish dump file into a nested dictionary.
+Reads 17-mers and counts from jellyfish dump file into a k-mer dictionary
+(packed 2-bit arrays by default, or the original nested dictionary).
 Then, calculates k-mer scores for 45-mers in sam file.
-Output is also in sam format with the score appended as KS:i: tag.
+Output is also in sam format with the score appended as KS:i: tag,
+followed by the number of its k-mers not found in the dump as KM:i: tag.
+With --library, oligos are scored against several dumps in one pass and
+the score against each is appended as K1:i:, K2:i:, ... tags in order,
+after KS:i: and KM:i: of the first dump.
 
 Usage:
 python CalcKmerScores.py dump.fa oligos.sam scores_output.sam
     Optional: custom.log {fast mode True/False}
+    Optional: --backend packed/nested/mph/external (default packed, see PackedKmerDict.py)
+    Optional: --count-cap {default 65535} --fingerprint-bits {8/16} (mph backend only)
+    Optional: --canonical --conflict max/sum/error (store k-mers by canonical form, one lookup per query)
+    Optional: --log-missing (write every missing k-mer to custom.log.missing)
+    Optional: --bloom-bits {e.g. 12} (skip lookups of k-mers a Bloom filter rules out)
+    Optional: -k {k-mer size, default 17} -m {oligo size, default 45}
+    Optional: --targeted (load only the dump entries used by the oligos)
+    Optional: --fast-exit (skip freeing k-mer dictionary at end)
+    Optional: --memory-budget {e.g. 16G} (use external sort-merge join if dump won't fit)
+    Optional: --library other_dump.fa (repeat for more; score against each dump in one pass)
+    Optional: --checkpoint-interval {seconds, default 600} --resume (pick up a killed run where it left off)
+    Optional: --cache scores.cache --cache-size {default 4G} (reuse scores of oligos from earlier runs)
+
+oligos.sam can also be an oligo store from GetOligos.py --store (see OligoStore.py);
+every oligo in it is scored and written as an unmapped sam line.
+
+dump.fa can also be a k-mer index from BuildKmerIndex.py, which is
+memory-mapped instead of read, so scoring begins almost instantly.
+An index built with --backend mph is scored with --backend mph.
+
+Every so often, output is flushed and its progress saved to
+scores_output.sam.checkpoint (see Checkpoint.py). If the run is killed,
+run the same command again with --resume to truncate output to the last
+checkpoint and carry on from there.
+
+With --cache scores.cache, scores are also kept in an SQLite file (see
+ScoreCache.py), and later runs with the same dumps and options only score
+oligos that aren't in it. With --targeted too, only k-mers of those oligos are loaded.
 
 If you need to calculate scores with 45-mers from multiple files
 but using same dictionary, use -i flag to open interactive mode
 at close of program and run the following command:
 >>> CalcFromSam(nkd, "nextoligofile.sam", "nextoutputfile.sam", log)
+
+Oligos are scored 4096 at a time with one QueryMany call on the dictionary.
+To look up a batch of k-mers (list of sequences or NumPy array of 2-bit codes) yourself:
+>>> counts, found = nkd.QueryMany(["TAGAAGTGCCGAAGCAA", "AAAAAAAAAAAAAAAAA"])
 """
 
 import sys
 import gc
+import argparse
 from NestedKmerDict import NestedKmerDict
+from PackedKmerDict import PackedKmerDict, IsIndex
+from ExternalKmerDict import ExternalKmerDict
+from MphKmerDict import MphKmerDict, IsMphIndex
+from Checkpoint import Checkpoint, LoadCheckpoint, TruncateTo
+from ScoreCache import ScoreCache
 from time import ctime
 try:
     from time import process_time
 except:
     from time import clock as process_time #python2
+from time import time
 from datetime import timedelta
+from itertools import accumulate
+from io import StringIO
+from os import getpid, stat, path, _exit
+import multiprocessing
+try:
+    import numpy as np
+except ImportError:
+    exit("numpy not installed")
+from KmerEncoding import EncodeAll, Canonicals, CONFLICT_POLICIES
+# Oligo stores are read with OligoStore.py, which lives with GetOligos.py
+sys.path.append(path.join(path.dirname(path.abspath(__file__)), "..", "GetOligos"))
+from OligoStore import OligoStore, IsStore
 
 
 # Calculate k-mer scores of oligos from sam file.
-# Needs nested k-mer dictionary object, oligo source file, and output file
+# Needs k-mer dictionary object, oligo source file, and output file
+# nkd can also be a list of k-mer dictionaries with the same k, one per library;
+# then each oligo also gets K1:i:, K2:i:, ... tags with its score against each,
+# while KS:i:, KM:i: and missing k-mers are those of the first library
+# Oligos are scored thousands at a time (see ScoreLines), so any dictionary
+# with QueryMany can be passed in from interactive mode
 # fast=False will check both forward and reverse k-mers and log if both are found.
 # fast=True will only check for reverse if forward not found.
 # log_missing should be either False or an output file object.
-def CalcFromSam(nkd, oligos, output, log, fast=True, log_missing=False):
+# windowed=True looks up each k-mer position along the chromosome once
+# and shares its count between overlapping oligos (see ScoreWindows).
+# oligo_size is the number of bases of each oligo to score; k-mer size comes from nkd.
+# threads > 1 scores chunks of the sam file in a pool of worker processes (see ScoreParallel).
+# If nkd is an ExternalKmerDict, scores are calculated with its sort-merge join
+# instead, and windowed and threads make no difference.
+# oligos can also be an OligoStore (see OligoStore.py) instead of a sam file;
+# each oligo is then written as an unmapped sam line (see ScoreStore),
+# and windowed, threads, checkpoint and cache make no difference.
+# checkpoint is a Checkpoint object (see Checkpoint.py) saved every so often,
+# or None; scoring starts from wherever oligos is, so a resumed run seeks it first.
+# cache is a ScoreCache object (see ScoreCache.py) of scores from earlier runs, or None;
+# oligos are then scored in batches instead of sliding windows, with the same output.
+def CalcFromSam(nkd, oligos, output, log, fast=True, log_missing=False, windowed=False, oligo_size=45, threads=1, \
+    checkpoint=None, cache=None):
     if isinstance(oligos, str):
         oligos = open(oligos, 'r')
     if isinstance(output, str):
         output = open(output, 'w')
 
     time0 = process_time()
+    wall0 = time()
 
     # Begin log file with context
     log = open(log.name, 'a')
     log.write("Beginning k-mer score calculation for oligo file " + oligos.name + " at " + ctime() + "\n")
     log.write("Output file of 45-mers and k-mer scores = " + output.name + "\n")
     log.write("Fast mode is " + ("on\n" if fast else "off\n"))
+    log.write("Sliding window mode is " + ("on\n" if windowed else "off\n"))
     print("\nBeginning k-mer score calculation for file = " + oligos.name + " at " + ctime())
     print("Output file of 45-mers and k-mer scores = " + output.name)
-    print("Fast mode is " + ("on\n" if fast else "off\n"))
+    print("Fast mode is " + ("on" if fast else "off"))
+    print("Sliding window mode is " + ("on\n" if windowed else "off\n"))
+    log.write("Worker processes: " + str(threads) + "\n")
 
-    # Read 45-mers and calculate k-mer scores
-    num_missing = 0
-    line = oligos.readline()
-    while line:
-        # Print headers without touching them
-        if line[0] == '@':
-            output.write(line)
-            line = oligos.readline()
-            continue
+    libraries = Libraries(nkd)
+    if len(libraries) > 1:
+        log.write("Scoring against " + str(len(libraries)) + " libraries\n")
+        assert all(library.k == libraries[0].k for library in libraries), "All libraries must have the same k-mer size"
+        assert not any(isinstance(library, ExternalKmerDict) for library in libraries), \
+            "External sort-merge join scores one library at a time"
 
-        # Grab oligo and start with score of 0
-        oligo = line.split('\t')[9]
-        score = 0
-
-        # Loop through 45-mer and query all 17-mers
-        for i in range (0, 29):
-            try:
-                seq = oligo[i:i+17]
-                if fast:
-                    count = nkd.QueryFast(seq, log)
-                else:
-                    count = nkd.Query(seq, log)
-                score += int(count)
-
-            # If 17-mer not found in dictionary, note in log and skip it
-            except:
-                num_missing += 1
-                if log_missing:
-                    log_missing.write("No dictionary entry for " + seq + \
-                    " from source oligo " + line.split('\t')[0] + "\n")
-                continue
-
-        # Write line with k-mer score appended
-        output.write(line.rstrip('\n') + "\tKS:i:" + str(score) + "\n")
-
-        line = oligos.readline()
+    # Read 45-mers and calculate k-mer scores
+    if isinstance(oligos, OligoStore):
+        log.write("Scoring every oligo of oligo store\n")
+        num_missing = ScoreStore(nkd, oligos, output, log, fast, log_missing, oligo_size)
+    elif isinstance(nkd, ExternalKmerDict):
+        log.write("Scoring with external sort-merge join\n")
+        num_missing = nkd.ScoreSam(oligos, output, log, fast, log_missing, oligo_size)
+    elif threads > 1:
+        num_missing = ScoreParallel(nkd, oligos, output, log, fast, log_missing, windowed, oligo_size, threads, \
+            checkpoint, cache)
+    elif windowed and not cache:
+        num_missing = ScoreWindows(nkd, oligos, output, log, fast, log_missing, oligo_size, checkpoint=checkpoint)
+    else:
+        num_missing = ScoreLines(nkd, oligos, output, log, fast, log_missing, oligo_size, checkpoint=checkpoint, \
+            cache=cache)
+    if cache:
+        cache.Flush()
+        cache.Evict()
+        log.write(cache.Stats() + "\n")
+        sys.stderr.write(cache.Stats() + "\n")
+    if checkpoint:
+        log.write("Checkpoints saved: " + str(checkpoint.num_saved) + "\n")
+        num_missing += checkpoint.base_missing
 
     proc_time = process_time() - time0
+    wall_time = time() - wall0
     msg = "Calculation time: " + str(timedelta(seconds=proc_time)) + " (total seconds = " + str(proc_time) + ")\n"
+    if threads > 1:
+        msg = "Wall clock time: " + str(timedelta(seconds=wall_time)) + " (total seconds = " + str(wall_time) + ")\n"
     log.write("K-mer score calculation for file " + oligos.name + " completed successfully at " + ctime() + "\n")
     log.write(msg)
     log.write("Scores output at " + output.name + "\n")
@@ -98,8 +174,8 @@ def CalcFromSam(nkd, oligos, output, log, fast=True, log_missing=False):
     sys.stderr.write("Log written to " + log.name + "\n")
     sys.stderr.write("{} k-mers not found in dictionary\n".format(str(num_missing)))
     if log_missing:
-        log.write("Missing k-mers written to " + missing.name + "\n")
-        sys.stderr.write("Missing k-mers written to " + missing.name + "\n")
+        log.write("Missing k-mers written to " + log_missing.name + "\n")
+        sys.stderr.write("Missing k-mers written to " + log_missing.name + "\n")
 
     try:
         del nkd
@@ -109,73 +185,759 @@ def CalcFromSam(nkd, oligos, output, log, fast=True, log_missing=False):
     sys.stderr.write("\nCalcFromSam says: attempting to return to main.\t{}\n".format(ctime()))
     return
 
+# List of libraries from one k-mer dictionary or a list of them
+def Libraries(nkd):
+    return nkd if isinstance(nkd, (list, tuple)) else [nkd]
+
+# Look up every k-mer along sequence in each library, encoding them only once
+# Returns list of count arrays and list of found arrays, one per library,
+# with 0 and False for k-mers containing anything but A, C, G, and T
+def QueryLibraries(libraries, seq, fast=True, log=open("/dev/fd/1", 'w')):
+    codes, valid = EncodeAll(seq, libraries[0].k)
+    valid_codes = codes[valid]
+    counts, found = [], []
+    for nkd in libraries:
+        library_counts = np.zeros(len(codes), dtype=np.uint64)
+        library_found = np.zeros(len(codes), dtype=bool)
+        library_counts[valid], library_found[valid] = nkd.QueryMany(valid_codes, fast, log)
+        counts.append(library_counts)
+        found.append(library_found)
+    return counts, found
+
+# Calculate k-mer score of one oligo by querying all of its k-mers
+# Returns list of scores, one per library, and number of k-mers
+# not found in (first) dictionary
+def ScoreOligo(nkd, oligo, name, log, fast=True, log_missing=False, oligo_size=45):
+    libraries = Libraries(nkd)
+    k = libraries[0].k
+    num_kmers = oligo_size - k + 1
+
+    # Query all k-mers of oligo at once
+    if len(libraries) == 1:
+        counts, found = nkd.QueryAlong(oligo[:oligo_size], fast, log)
+        scores = [sum(counts)]
+    else:
+        counts, found = QueryLibraries(libraries, oligo[:oligo_size], fast, log)
+        scores = [int(library_counts.sum()) for library_counts in counts]
+        found = found[0].tolist()
+
+    # K-mers not found in dictionary (or past end of an oligo too short to have them)
+    num_missing = num_kmers - sum(found[:num_kmers])
+    if num_missing and log_missing:
+        LogMissing(log_missing, oligo, name, [i for i in range(num_kmers) if i >= len(found) or not found[i]], k)
+
+    return scores, num_missing
+
+# Write one line per missing k-mer of oligo to missing k-mer log, all at once
+def LogMissing(log_missing, seq, name, positions, k=17):
+    log_missing.write("".join("No dictionary entry for " + seq[i:i+k] + \
+        " from source oligo " + name + "\n" for i in positions))
+
+# Sam line with k-mer score and number of missing k-mers appended as tags
+# scores has one score per library; with more than one library,
+# each library's score is also appended as K1:i:, K2:i:, ... tags
+def ScoredLine(line, scores, num_missing):
+    tags = "\tKS:i:" + str(scores[0]) + "\tKM:i:" + str(num_missing)
+    if len(scores) > 1:
+        tags += "".join("\tK" + str(i) + ":i:" + str(score) for i, score in enumerate(scores, 1))
+    return line.rstrip('\n') + tags + "\n"
+
+# Score sam lines in batches of batch_size oligos, with one QueryMany call per batch
+# Scores, tags and logs are the same as scoring each oligo with ScoreOligo
+# If checkpoint is given, it is saved between batches when due
+# If cache is given, oligos in it aren't scored again, and new scores are added to it
+# Returns number of k-mers not found in dictionary
+def ScoreLines(nkd, oligos, output, log, fast=True, log_missing=False, oligo_size=45, batch_size=4096, checkpoint=None, \
+    cache=None):
+    num_missing = 0
+    batch = []
+    line = oligos.readline()
+    while line:
+        # Print headers without touching them
+        if line[0] == '@':
+            num_missing += ScoreBatch(nkd, batch, output, log, fast, log_missing, oligo_size, cache)
+            batch = []
+            output.write(line)
+            line = oligos.readline()
+            continue
+
+        batch.append(line)
+        if len(batch) == batch_size:
+            num_missing += ScoreBatch(nkd, batch, output, log, fast, log_missing, oligo_size, cache)
+            batch = []
+            if cache:
+                cache.Flush()
+            if checkpoint and checkpoint.Due():
+                checkpoint.Save(num_missing)
+        line = oligos.readline()
+
+    num_missing += ScoreBatch(nkd, batch, output, log, fast, log_missing, oligo_size, cache)
+    if cache:
+        cache.Flush()
+    return num_missing
+
+# Letters of oligos from a store as bwa writes them in sam files:
+# uppercase, with N for anything but A, C, G, and T
+_SAM_LETTERS = np.full(256, ord("N"), dtype=np.uint8)
+for _letter in b"ACGT":
+    _SAM_LETTERS[_letter] = _SAM_LETTERS[_letter | 0x20] = _letter
+
+# Score every oligo of an oligo store (see OligoStore.py), batch_size at a time,
+# and write each as an unmapped sam line with the same tags as ScoreLines
+# Returns number of k-mers not found in (first) dictionary
+def ScoreStore(nkd, store, output, log, fast=True, log_missing=False, oligo_size=45, batch_size=4096):
+    libraries = Libraries(nkd)
+    k = libraries[0].k
+    num_missing = 0
+    for names, rows in store.Batches(batch_size):
+        width = rows.shape[1]
+        text = _SAM_LETTERS[rows].tobytes().decode()
+        seqs = [text[j * width:(j + 1) * width] for j in range(len(names))]
+        results = ScoreSeqs(libraries, [seq[:oligo_size] for seq in seqs], fast, log, oligo_size, bool(log_missing))
+
+        lines = []
+        for name, seq, (scores, missing) in zip(names, seqs, results):
+            oligo_missing = missing if isinstance(missing, int) else len(missing)
+            num_missing += oligo_missing
+            if oligo_missing and log_missing:
+                LogMissing(log_missing, seq, name, missing, k)
+            lines.append(ScoredLine(name + "\t4\t*\t0\t0\t*\t*\t0\t0\t" + seq + "\t*", scores, oligo_missing))
+        output.write("".join(lines))
+    return num_missing
+
+# Score batch of sam lines and write them out
+# Oligos are joined with N between them, so k-mers spanning two oligos come out
+# invalid and are never looked up; the rest are looked up with one QueryMany call
+# Each oligo's score is the difference of two cumulative sums, same as FlushRun
+# With several libraries, k-mers are encoded once and looked up in each
+# If cache is given (see ScoreCache.py), only oligos not in it are looked up
+# Returns number of k-mers not found in (first) dictionary
+def ScoreBatch(nkd, lines, output, log, fast=True, log_missing=False, oligo_size=45, cache=None):
+    if not lines:
+        return 0
+    libraries = Libraries(nkd)
+    k = libraries[0].k
+    num_kmers = oligo_size - k + 1
+    fields = [line.split('\t', 10) for line in lines]
+    seqs = [f[9][:oligo_size] for f in fields]
+
+    if cache:
+        results = cache.Get(seqs)
+        todo = [i for i, result in enumerate(results) if result is None]
+        if todo:
+            todo_seqs = [seqs[i] for i in todo]
+            scored = ScoreSeqs(libraries, todo_seqs, fast, log, oligo_size, True)
+            cache.Put(todo_seqs, scored)
+            for i, result in zip(todo, scored):
+                results[i] = result
+    else:
+        results = ScoreSeqs(libraries, seqs, fast, log, oligo_size, bool(log_missing))
+
+    num_missing = 0
+    for line, f, (scores, missing) in zip(lines, fields, results):
+        oligo_missing = missing if isinstance(missing, int) else len(missing)
+        num_missing += oligo_missing
+
+        if oligo_missing and log_missing:
+            LogMissing(log_missing, f[9], f[0], missing, k)
+
+        output.write(ScoredLine(line, scores, oligo_missing))
+    return num_missing
+
+# Calculate scores of list of oligo sequences, all at once
+# Returns (list of scores, one per library, missing) for each oligo, where missing
+# is list of positions of k-mers not found in (first) dictionary if positions=True,
+# otherwise just the number of them
+def ScoreSeqs(libraries, seqs, fast=True, log=open("/dev/fd/1", 'w'), oligo_size=45, positions=False):
+    k = libraries[0].k
+    num_kmers = oligo_size - k + 1
+    starts = [0] + list(accumulate(len(seq) + 1 for seq in seqs))
+
+    counts, found = QueryLibraries(libraries, "N".join(seqs), fast, log)
+    count_sums = [np.concatenate((np.zeros(1, dtype=np.uint64), np.cumsum(c))).tolist() for c in counts]
+    found_sums = np.concatenate(([0], np.cumsum(found[0]))).tolist()
+    found = found[0].tolist()
+
+    results = []
+    for seq, start in zip(seqs, starts):
+        # Oligo too short to have all its k-mers counts the rest as missing
+        end = start + max(0, len(seq) - k + 1)
+        scores = [sums[end] - sums[start] for sums in count_sums]
+        missing = num_kmers - (found_sums[end] - found_sums[start])
+        if missing and positions:
+            missing = [i for i in range(num_kmers) if start + i >= end or not found[start + i]]
+        elif positions:
+            missing = []
+        results.append((scores, missing))
+    return results
+
+# Stretch of chromosome covered by consecutive overlapping oligos in sam file
+# Holds the stretch's sequence and the sam lines of the oligos on it
+class OligoRun():
+    def __init__(self, k=17, max_length=1000000):
+        self.k = k
+        self.max_length = max_length
+        self.Reset()
+
+    # Start new empty run
+    def Reset(self):
+        self.chrom = None
+        self.start = 0
+        self.seq = ""
+        self.oligos = []
+
+    # Start new run with one oligo
+    def StartNew(self, line, name, chrom, start, oligo):
+        self.chrom = chrom
+        self.start = start
+        self.seq = oligo
+        self.oligos = [(line, name, 0)]
+
+    # Append oligo if it continues this run and agrees with its sequence
+    # Returns True if appended, False if oligo belongs in a new run
+    def Extend(self, line, name, chrom, start, oligo):
+        if chrom != self.chrom or not self.oligos or len(self.seq) >= self.max_length:
+            return False
+        offset = start - self.start
+
+        # Oligo must overlap the run by at least k - 1 bases,
+        # so every k-mer in the run belongs to at least one oligo
+        overlap = len(self.seq) - offset
+        if offset < 0 or overlap < self.k - 1:
+            return False
+        if self.seq[offset:offset + len(oligo)] != oligo[:overlap]:
+            return False
+
+        self.seq += oligo[overlap:]
+        self.oligos.append((line, name, offset))
+        return True
+
+# Score sam lines by sliding along each chromosome instead of oligo by oligo.
+# Oligo names from GetOligos.py are chromosome_index, so consecutive oligos with
+# the same chromosome and overlapping indices are merged into one run.
+# Each k-mer position in the run is looked up once, and each oligo's score
+# is the difference of two cumulative sums, so overlapping oligos share lookups.
+# Oligos that cannot join a run (reverse strand, unparseable name, wrong length,
+# or sequence disagreeing with its neighbors) are scored on their own,
+# so output is identical to ScoreLines either way.
+# If checkpoint is given and due, current run is cut short and scored before saving it.
+# Returns number of k-mers not found in dictionary
+def ScoreWindows(nkd, oligos, output, log, fast=True, log_missing=False, oligo_size=45, max_run=1000000, \
+    checkpoint=None):
+    num_missing = 0
+    run = OligoRun(Libraries(nkd)[0].k, max_run)
+
+    line = oligos.readline()
+    while line:
+        # Print headers without touching them
+        if line[0] == '@':
+            num_missing += FlushRun(run, nkd, output, log, fast, log_missing, oligo_size)
+            output.write(line)
+            line = oligos.readline()
+            continue
+
+        fields = line.split('\t')
+        name, oligo = fields[0], fields[9]
+
+        # Find position of oligo from its name
+        try:
+            chrom, start = name.rsplit('_', 1)
+            start = int(start)
+            assert not int(fields[1]) & 16 and len(oligo) == oligo_size
+        except (ValueError, AssertionError):
+            chrom = None
+
+        # Add oligo to current run, or else finish current run and start another
+        if chrom is None or not run.Extend(line, name, chrom, start, oligo):
+            num_missing += FlushRun(run, nkd, output, log, fast, log_missing, oligo_size)
+            if chrom is None:
+                scores, oligo_missing = ScoreOligo(nkd, oligo, name, log, fast, log_missing, oligo_size)
+                num_missing += oligo_missing
+                output.write(ScoredLine(line, scores, oligo_missing))
+            else:
+                run.StartNew(line, name, chrom, start, oligo)
+
+        if checkpoint and checkpoint.Due():
+            num_missing += FlushRun(run, nkd, output, log, fast, log_missing, oligo_size)
+            checkpoint.Save(num_missing)
+        line = oligos.readline()
+
+    num_missing += FlushRun(run, nkd, output, log, fast, log_missing, oligo_size)
+    return num_missing
+
+# Look up every k-mer in run once and write scores of its oligos
+# Returns number of k-mers not found in dictionary, counted per oligo like ScoreLines
+def FlushRun(run, nkd, output, log, fast=True, log_missing=False, oligo_size=45):
+    if not run.oligos:
+        return 0
+
+    # Count for each k-mer position and library, 0 if not found
+    libraries = Libraries(nkd)
+    counts, found = QueryLibraries(libraries, run.seq, fast, log)
+
+    # Cumulative sums so each window total is one subtraction
+    count_sums = [np.concatenate((np.zeros(1, dtype=np.uint64), np.cumsum(c))).tolist() for c in counts]
+    found_sums = np.concatenate(([0], np.cumsum(found[0]))).tolist()
+    found = found[0].tolist()
+
+    k = libraries[0].k
+    num_kmers = oligo_size - k + 1
+    num_missing = 0
+    for line, name, offset in run.oligos:
+        end = offset + num_kmers
+        scores = [sums[end] - sums[offset] for sums in count_sums]
+        oligo_missing = num_kmers - (found_sums[end] - found_sums[offset])
+        num_missing += oligo_missing
+
+        # Note missing k-mers in log in same order as ScoreOligo
+        if oligo_missing and log_missing:
+            LogMissing(log_missing, run.seq, name, [i for i in range(offset, end) if not found[i]], k)
+
+        output.write(ScoredLine(line, scores, oligo_missing))
+
+    run.Reset()
+    return num_missing
+
+# First pass of targeted loading: collect every k-mer the oligos will look up.
+# Oligos are joined into batches with N between them, so k-mers spanning
+# two oligos come out invalid and are dropped along with k-mers containing N.
+# If cache is given, oligos already in it are skipped, since they won't be looked up.
+# Returns sorted NumPy array of unique canonical codes, for Populate(keep=...)
+def CollectKmers(oligos, k=17, oligo_size=45, log=open("/dev/fd/1", 'w'), batch_size=1 << 14, cache=None):
+    if isinstance(oligos, str):
+        oligos = open(oligos, 'r')
+    time0 = process_time()
+    log.write("Collecting k-mers of oligos in " + oligos.name + " at " + ctime() + "\n")
+
+    kmers = [np.zeros(0, dtype=np.uint64)]
+    num_collected = 0
+    batch = []
+    line = oligos.readline()
+    while True:
+        if len(batch) == batch_size or not line:
+            if cache:
+                batch = [seq for seq, missing in zip(batch, cache.Missing(batch)) if missing]
+            codes, valid = EncodeAll("N".join(batch), k)
+            kmers.append(Canonicals(codes[valid], k))
+            num_collected += len(kmers[-1])
+            batch = []
+            # Squash duplicates once in a while so memory follows the number of unique k-mers
+            if len(kmers) > 64:
+                kmers = [np.unique(np.concatenate(kmers))]
+            if not line:
+                break
+
+        if line[0] != '@':
+            batch.append(line.split('\t', 10)[9][:oligo_size])
+        line = oligos.readline()
+
+    oligos.seek(0)
+    kmers = np.unique(np.concatenate(kmers))
+
+    proc_time = process_time() - time0
+    log.write("{} unique canonical k-mers out of {} collected\n".format(len(kmers), num_collected))
+    log.write("Collection time: " + str(timedelta(seconds=proc_time)) + " (total seconds = " + str(proc_time) + ")\n")
+    log.flush()
+    return kmers
+
+# Rough peak memory in bytes to load dump file into each in-memory backend,
+# from file size and the shortest possible entry (">1\n" and k-mer line)
+# (mph builds one bucket at a time, so its peak is little more than the finished hash)
+_LOAD_BYTES_PER_ENTRY = {"packed": 64, "nested": 400, "mph": 12}
+def EstimateLoadMemory(filename, k=17, backend="packed"):
+    return stat(filename).st_size // (k + 4) * _LOAD_BYTES_PER_ENTRY[backend]
+
+# Returns True if file is a k-mer index from BuildKmerIndex.py, of either backend
+def IsKmerIndex(filename):
+    return IsIndex(filename) or IsMphIndex(filename)
+
+# Reads size like 500M or 8G into number of bytes
+def ParseSize(size):
+    units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+    size = size.strip().upper().rstrip("B")
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+# K-mer dictionary shared with worker processes
+# Workers are forked after this is set, so they read the parent's copy
+# (copy-on-write, or the same page cache if it is a memory-mapped index)
+_shared_nkd = None
+
+# Split file into chunks of about chunk_size bytes that start and end on line boundaries
+# First chunk starts at byte offset start, which must be the beginning of a line
+# Returns list of (start, end) byte offsets
+def SplitChunks(filename, chunk_size, start=0):
+    filesize = stat(filename).st_size
+    chunks = []
+    with open(filename, 'rb') as f:
+        while start < filesize:
+            f.seek(min(start + chunk_size, filesize))
+            f.readline()
+            end = min(f.tell(), filesize)
+            chunks.append((start, end))
+            start = end
+    return chunks
+
+# Score cache shared with worker processes the same way, or None
+# Workers open it again to read, and hand new entries back to be written
+_shared_cache = None
+
+# Score one chunk of sam file in worker process
+# Returns output text, missing k-mer text, log text, number missing,
+# number of oligos, CPU seconds, worker process id, and new score cache entries
+def ScoreChunk(task):
+    filename, start, end, fast, log_missing, windowed, oligo_size = task
+    time0 = process_time()
+
+    with open(filename, 'rb') as f:
+        f.seek(start)
+        oligos = StringIO(f.read(end - start).decode())
+    output = StringIO()
+    log = StringIO()
+    missing = StringIO() if log_missing else False
+
+    cache = _shared_cache.Reopen() if _shared_cache else None
+    if windowed and not cache:
+        num_missing = ScoreWindows(_shared_nkd, oligos, output, log, fast, missing, oligo_size)
+    else:
+        num_missing = ScoreLines(_shared_nkd, oligos, output, log, fast, missing, oligo_size, cache=cache)
+    pending = None
+    if cache:
+        pending = cache.TakePending()
+        cache.Close()
+
+    num_oligos = output.getvalue().count("\tKS:i:")
+    return output.getvalue(), missing.getvalue() if missing else "", log.getvalue(), \
+        num_missing, num_oligos, process_time() - time0, getpid(), pending
+
+# Score sam file in a pool of worker processes.
+# File is split into byte-range chunks on line boundaries, and each worker
+# scores whole chunks against the one shared k-mer dictionary.
+# Chunks are written back in input order, so output is byte-identical to ScoreLines.
+# Scoring starts from current position in oligos, and checkpoint (if given)
+# is saved after a chunk is written when due.
+# If cache is given, workers look oligos up in it and this process adds their new scores.
+# Returns number of k-mers not found in dictionary
+def ScoreParallel(nkd, oligos, output, log, fast=True, log_missing=False, windowed=False, oligo_size=45, threads=2, \
+    checkpoint=None, cache=None):
+    global _shared_nkd, _shared_cache
+    _shared_nkd = nkd
+    _shared_cache = cache
+
+    # Several chunks per worker so a slow chunk doesn't hold up the end
+    filesize = stat(oligos.name).st_size
+    chunk_size = max(1 << 20, min(64 << 20, filesize // (threads * 8) + 1))
+    chunks = SplitChunks(oligos.name, chunk_size, oligos.tell())
+    log.write("Scoring " + str(len(chunks)) + " chunks of about " + str(chunk_size) + " bytes\n")
+    log.flush()
+
+    tasks = [(oligos.name, start, end, fast, bool(log_missing), windowed, oligo_size) for start, end in chunks]
+    num_missing = 0
+    workers = {}
+    pool = multiprocessing.get_context("fork").Pool(threads)
+    try:
+        # imap returns results in order of tasks, even if they finish out of order
+        for (start, end), result in zip(chunks, pool.imap(ScoreChunk, tasks)):
+            text, missing_text, log_text, chunk_missing, num_oligos, seconds, pid, pending = result
+            output.write(text)
+            if log_missing:
+                log_missing.write(missing_text)
+            log.write(log_text)
+            num_missing += chunk_missing
+            if cache:
+                cache.AddPending(pending)
+                cache.Flush()
+            if checkpoint and checkpoint.Due():
+                checkpoint.Save(num_missing, input_offset=end)
+
+            oligo_count, total_seconds = workers.get(pid, (0, 0))
+            workers[pid] = (oligo_count + num_oligos, total_seconds + seconds)
+    finally:
+        pool.close()
+        pool.join()
+        _shared_nkd = None
+        _shared_cache = None
+
+    # Throughput of each worker
+    for pid, (num_oligos, seconds) in sorted(workers.items()):
+        log.write("Worker {} scored {} oligos in {:.2f} CPU seconds ({:.0f} oligos/s)\n".format( \
+            pid, num_oligos, seconds, num_oligos / seconds if seconds else 0))
+    return num_missing
+
 # ----------------main-------------------
 
 if __name__ == "__main__":
 
-    usage = "Usage: {dump input file} {oligo input file} {scores output file} " \
-    "Optional: {custom log file name} {fast mode True/False}"
+    parser = argparse.ArgumentParser(description="Calculate k-mer scores for oligos in a sam file.\n")
+    parser.add_argument("dump", help="jellyfish dump file of k-mer counts, or k-mer index from BuildKmerIndex.py")
+    parser.add_argument("oligos", help="sam file of oligos to score, or oligo store from GetOligos.py --store")
+    parser.add_argument("output", help="scores output file in sam format")
+    parser.add_argument("log", nargs="?", help="custom log file name (default: output filename with .log extension)")
+    parser.add_argument("fast", nargs="?", default="True", choices=["True", "False"], \
+    help="fast mode only checks reverse complement if forward k-mer not found (default: %(default)s)")
+    parser.add_argument("-k", "--kmer-size", type=int, default=17, \
+    help="k-mer size of dump file (default: %(default)s; k-mer index and nested backend set their own)")
+    parser.add_argument("-m", "--oligo-size", type=int, default=45, help="oligo size in bases (default: %(default)s)")
+    parser.add_argument("--sliding-window", action="store_true", \
+    help="look up each k-mer along the chromosome once and share counts between overlapping oligos")
+    parser.add_argument("-t", "--threads", type=int, default=1, \
+    help="number of worker processes sharing one k-mer dictionary (default: %(default)s)")
+    parser.add_argument("--targeted", action="store_true", \
+    help="read oligos first and load only the dump entries they use, so memory follows the number of oligos")
+    parser.add_argument("--fast-exit", action="store_true", \
+    help="exit as soon as output files are flushed, without freeing the k-mer dictionary")
+    parser.add_argument("--backend", choices=["packed", "nested", "mph", "external"], default="packed", \
+    help="k-mer dictionary to load counts into: packed 2-bit arrays, nested python dictionaries, " \
+    "minimal perfect hash, or sorted tables on disk for a sort-merge join (default: %(default)s)")
+    parser.add_argument("--count-cap", type=int, default=65535, \
+    help="mph backend: counts above this are stored as this (default: %(default)s)")
+    parser.add_argument("--fingerprint-bits", type=int, choices=[8, 16], default=16, \
+    help="mph backend: bits of fingerprint used to reject k-mers not in dump (default: %(default)s)")
+    parser.add_argument("--canonical", action="store_true", \
+    help="store each k-mer under the smaller of it and its reverse complement, so fast and exact mode " \
+    "are both one lookup per k-mer (packed and nested backends; mph and external always do)")
+    parser.add_argument("--conflict", choices=CONFLICT_POLICIES, default="max", \
+    help="how to combine counts of a k-mer and its reverse complement when both are in dump; " \
+    "max gives the same scores as exact mode (default: %(default)s)")
+    parser.add_argument("--log-missing", action="store_true", \
+    help="write each k-mer not found in dump to log file with .missing extension " \
+    "(number missing per oligo is always in KM:i: tag)")
+    parser.add_argument("--bloom-bits", type=int, default=0, \
+    help="bits per k-mer of Bloom filter that skips lookups of k-mers certainly not in dump; " \
+    "12 gives about 1%% false positives (default: off)")
+    parser.add_argument("--memory-budget", type=ParseSize, \
+    help="memory to use, e.g. 16G; if loading the dump would take more, use the external sort-merge join instead")
+    parser.add_argument("--tmp-dir", help="directory for temporary files of external sort-merge join " \
+    "and of building mph backend (default: output directory)")
+    parser.add_argument("--library", action="append", default=[], metavar="DUMP", \
+    help="another jellyfish dump or k-mer index to score oligos against in the same pass; repeat for more. " \
+    "Scores against the first dump and each library go in K1:i:, K2:i:, ... tags (not with external backend)")
+    parser.add_argument("--checkpoint-interval", type=int, default=600, \
+    help="seconds between checkpoints of output progress, 0 for none (default: %(default)s; not with external backend)")
+    parser.add_argument("--resume", action="store_true", \
+    help="continue from last checkpoint of an earlier run with the same output file and options")
+    parser.add_argument("--cache", metavar="FILE", \
+    help="SQLite file of scores from earlier runs; oligos already in it with the same dumps and options " \
+    "aren't scored again, and new scores are added to it (not with external backend)")
+    parser.add_argument("--cache-size", type=ParseSize, default=4 << 30, \
+    help="size limit of score cache, e.g. 500M; entries used least recently are evicted past it (default: 4G)")
 
-    if len(sys.argv) < 4 or len(sys.argv) > 6:
-        exit(usage)
+    args = parser.parse_args()
+    usage = parser.format_usage()
 
     # Verify all files found and not garbage before loading dictionary
-    # Open jellyfish dump file of 17-mers
-    try:
-        dump = open(sys.argv[1], 'r')
-    except FileNotFoundError:
-        exit("File " + sys.argv[1] + " not found.")
-    print("Will read counts from " + dump.name)
+    # Open jellyfish dump file of 17-mers, and one for each other library
+    dumps = []
+    for filename in [args.dump] + args.library:
+        try:
+            dumps.append(open(filename, 'r'))
+        except FileNotFoundError:
+            exit("File " + filename + " not found.")
+        print("Will read counts from " + filename)
+    if len(dumps) > 1 and args.backend == "external":
+        exit("External backend scores one dump at a time; use another backend with --library")
 
     # Open file of 45-mers
     try:
-        oligos = open(sys.argv[2], 'r')
+        oligos = open(args.oligos, 'r')
     except FileNotFoundError:
-        exit("File " + sys.argv[2] + " not found.")
+        exit("File " + args.oligos + " not found.")
     print("Will read oligos from " + oligos.name)
+    if IsStore(oligos.name):
+        oligos.close()
+        oligos = OligoStore(args.oligos)
+        if args.resume:
+            exit("Scoring an oligo store doesn't save checkpoints, so it can't resume")
+        if args.backend == "external":
+            exit("External backend scores sam files only; use another backend for an oligo store")
+        for option in ("targeted", "cache", "sliding_window"):
+            if getattr(args, option):
+                sys.stderr.write("Ignoring --" + option.replace("_", "-") + " for oligo store\n")
+                setattr(args, option, False if option != "cache" else None)
 
     # Remember that one time I named the log but forgot to name the output file
     # and then it wrote the output and the log in the same place lol that was hilarious
-    assert sys.argv[3][-3:] != "log", "Make sure you specify an output file\n" + usage
-    # Open output file
-    output = open(sys.argv[3], 'w')
-    print("Will write scores to " + output.name)
+    assert args.output[-3:] != "log", "Make sure you specify an output file\n" + usage
+
+    # Options that change output, which a resumed run must share with the run it continues
+    settings = {key: getattr(args, key) for key in ("fast", "kmer_size", "oligo_size", "backend", \
+        "count_cap", "fingerprint_bits", "canonical", "conflict", "log_missing")}
+    settings["dumps"] = [path.abspath(filename) for filename in [args.dump] + args.library]
+
+    # Find checkpoint of earlier run if resuming
+    checkpoint_file = args.output + ".checkpoint"
+    saved = None
+    if args.resume:
+        if args.backend == "external":
+            exit("External backend doesn't save checkpoints, so it can't resume")
+        saved = LoadCheckpoint(checkpoint_file)
+        if saved is None:
+            sys.stderr.write("No checkpoint found at " + checkpoint_file + ", starting from beginning\n")
+        elif saved["settings"] != settings:
+            exit("Checkpoint " + checkpoint_file + " was saved with different options:\n" + str(saved["settings"]))
+        elif saved["oligos"] != path.abspath(oligos.name) or saved["oligos_size"] != stat(oligos.name).st_size:
+            exit("Checkpoint " + checkpoint_file + " was saved for a different oligo file: " + saved["oligos"])
+
+    # Open output file, or keep what was written before checkpoint
+    if saved:
+        output = TruncateTo(args.output, saved["output_offset"])
+        print("Will append scores to " + output.name + " after byte " + str(saved["output_offset"]))
+    else:
+        output = open(args.output, 'w')
+        print("Will write scores to " + output.name)
 
     # Open main log file
-    logfile = sys.argv[4] if len(sys.argv) > 4 else output.name.rsplit('.', 1)[0] + ".log"
-    log = open(logfile, 'w')
+    logfile = args.log if args.log else output.name.rsplit('.', 1)[0] + ".log"
+    log = open(logfile, 'a' if saved else 'w')
     print("Logging to " + log.name)
     log.write("Log file for CalcKmerScores.py\n")
+    if saved:
+        log.write("Resuming from checkpoint saved " + saved["time"] + " at byte " + \
+            str(saved["input_offset"]) + " of " + oligos.name + "\n")
     log.flush()
 
-    # Separate log file for missing k-mers
-    log_missing = True
-    if log_missing:
-        missing = open(log.name + ".missing", 'w')
+    # Separate log file for missing k-mers, if asked for
+    # Number missing per oligo is in KM:i: tag either way
+    missing = False
+    if args.log_missing and saved:
+        missing = TruncateTo(log.name + ".missing", saved["missing_offset"], buffering=1 << 20)
+    elif args.log_missing:
+        missing = open(log.name + ".missing", 'w', buffering=1 << 20)
 
     # Take a quick look at oligos file BEFORE loading k-mer dictionary loads into memory
-    i = 0
-    # Find first non-comment line
-    while True:
-        i += 1
-        line = oligos.readline()
-        if line[0] != "@":
-            break
-    # Verify line has 15 fields
-    if len(line.split('\t')) != 15:
-        error_message = "ERROR: Unexpected input from line {} of oligo file {}.\n" \
-        "Expected 15 fields, instead found {} fields.\n" \
-        "Line was:\n{}".format(i, oligos.name, len(line.split('\t')), line)
-        print(error_message)
-        log.write(error_message)
-        log.close()
-        sys.exit(1)
-    # If file looks good, reset to beginning
-    oligos.seek(0)
+    # (oligo store was checked when it was opened)
+    if not isinstance(oligos, OligoStore):
+        i = 0
+        # Find first non-comment line
+        while True:
+            i += 1
+            line = oligos.readline()
+            if line[0] != "@":
+                break
+        # Verify line has 15 fields
+        if len(line.split('\t')) != 15:
+            error_message = "ERROR: Unexpected input from line {} of oligo file {}.\n" \
+            "Expected 15 fields, instead found {} fields.\n" \
+            "Line was:\n{}".format(i, oligos.name, len(line.split('\t')), line)
+            print(error_message)
+            log.write(error_message)
+            log.close()
+            sys.exit(1)
+        # If file looks good, reset to beginning
+        oligos.seek(0)
+
+    # Switch to sort-merge join if dump won't fit in memory budget
+    # Only possible for a single dump; indexes are memory-mapped and don't count
+    if args.memory_budget is not None and args.backend != "external":
+        estimate = sum(EstimateLoadMemory(dump.name, args.kmer_size, args.backend) \
+            for dump in dumps if not IsKmerIndex(dump.name))
+        log.write("Estimated memory to load dumps: " + str(estimate) + " bytes, budget " + \
+            str(args.memory_budget) + " bytes\n")
+        if estimate > args.memory_budget:
+            if len(dumps) > 1:
+                exit("Dumps won't fit in memory budget together; score each library separately")
+            if not IsKmerIndex(dumps[0].name) and isinstance(oligos, OligoStore):
+                exit("Dump won't fit in memory budget, and oligo stores can't be scored with external sort-merge join")
+            if not IsKmerIndex(dumps[0].name):
+                sys.stderr.write("Dump won't fit in memory budget, using external sort-merge join\n")
+                args.backend = "external"
+
+    # Open score cache for these dumps and options
+    cache = None
+    if args.cache and args.backend == "external":
+        sys.stderr.write("Ignoring --cache for external backend\n")
+    elif args.cache:
+        score_settings = {key: value for key, value in settings.items() if key not in ("dumps", "log_missing")}
+        cache = ScoreCache(args.cache, [dump.name for dump in dumps], score_settings, \
+            args.cache_size, " ".join(dump.name for dump in dumps))
+        log.write("Score cache: " + args.cache + " with " + str(cache.NumEntries()) + " entries\n")
+
+    # Setup k-mer dictionary for each library
+    # Oligos are read for --targeted once, and the same k-mers kept from each dump
+    # (only k-mers of oligos not in score cache, if there is one)
+    libraries = []
+    keep = None
+    for dump in dumps:
+        # Memory-map index if given one, otherwise read dump
+        if IsIndex(dump.name):
+            if args.targeted:
+                sys.stderr.write("Ignoring --targeted for k-mer index, which is memory-mapped instead of loaded\n")
+            assert args.backend == "packed", "K-mer index " + dump.name + " can only be used with packed backend"
+            dump.close()
+            log.write("K-mer dictionary backend: packed (memory-mapped index)\n")
+            nkd = PackedKmerDict(bloom_bits=args.bloom_bits)
+            nkd.Load(dump.name, log)
+            if args.canonical and not nkd.canonical:
+                sys.stderr.write("K-mer index " + dump.name + " is not canonical; rebuild it with BuildKmerIndex.py --canonical\n")
+        elif IsMphIndex(dump.name):
+            if args.targeted:
+                sys.stderr.write("Ignoring --targeted for k-mer index, which is memory-mapped instead of loaded\n")
+            assert args.backend == "mph", "K-mer index " + dump.name + " can only be used with mph backend"
+            dump.close()
+            log.write("K-mer dictionary backend: mph (memory-mapped index)\n")
+            nkd = MphKmerDict(bloom_bits=args.bloom_bits)
+            nkd.Load(dump.name, log)
+        elif args.backend == "external":
+            if args.conflict != "max":
+                sys.stderr.write("Ignoring --conflict for external backend, which scores the same as exact mode\n")
+            tmp_dir = args.tmp_dir if args.tmp_dir else path.dirname(path.abspath(output.name))
+            nkd = ExternalKmerDict(k=args.kmer_size, tmp_dir=tmp_dir, \
+                memory_budget=args.memory_budget if args.memory_budget else 1 << 30)
+            log.write("K-mer dictionary backend: external\n")
+            nkd.Populate(dump, log)
+            dump.close()
+        else:
+            if args.backend == "nested":
+                nkd = NestedKmerDict(canonical=args.canonical, conflict=args.conflict, bloom_bits=args.bloom_bits)
+            elif args.backend == "mph":
+                nkd = MphKmerDict(k=args.kmer_size, count_cap=args.count_cap, \
+                    fingerprint_bits=args.fingerprint_bits, conflict=args.conflict, bloom_bits=args.bloom_bits, \
+                    tmp_dir=args.tmp_dir if args.tmp_dir else path.dirname(path.abspath(output.name)))
+            else:
+                nkd = PackedKmerDict(k=args.kmer_size, canonical=args.canonical, conflict=args.conflict, \
+                    bloom_bits=args.bloom_bits)
+            log.write("K-mer dictionary backend: " + args.backend + "\n")
+            if args.targeted and keep is None:
+                keep = CollectKmers(oligos, nkd.k, args.oligo_size, log, cache=cache)
+            nkd.Populate(dump, log, keep=keep)
+            dump.close()
+        libraries.append(nkd)
+    del keep
+
+    nkd = libraries[0] if len(libraries) == 1 else libraries
+
+    # Checkpoints of progress, starting after the checkpoint being resumed
+    # (--targeted reads oligos from the beginning, so seek only now)
+    checkpoint = None
+    if not isinstance(nkd, ExternalKmerDict) and not isinstance(oligos, OligoStore):
+        checkpoint = Checkpoint(checkpoint_file, oligos, output, missing, settings, \
+            args.checkpoint_interval, saved["num_missing"] if saved else 0)
+        if saved:
+            oligos.seek(saved["input_offset"])
+
+    CalcFromSam(nkd, oligos, output, log, fast=(args.fast == "True"), log_missing=missing, \
+        windowed=args.sliding_window, oligo_size=args.oligo_size, threads=args.threads, checkpoint=checkpoint, \
+        cache=cache)
+    if cache:
+        cache.Close()
+
+    # Run is finished, so there is nothing left to resume
+    if checkpoint:
+        checkpoint.Remove()
+
+    # Remove temporary files of sort-merge join
+    if isinstance(nkd, ExternalKmerDict):
+        nkd.Close()
 
-    # Setup nested kmer dictionary
-    nkd = NestedKmerDict()
-    nkd.Populate(dump, log)
-    dump.close()
+    for f in (output, missing, log):
+        if f:
+            f.close()
 
-    CalcFromSam(nkd, oligos, output, log, fast=True, log_missing=missing)
+    # Everything is written, so skip freeing memory the OS takes back anyway
+    if args.fast_exit:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        _exit(0)
+    for nkd in libraries:
+        nkd.Close()
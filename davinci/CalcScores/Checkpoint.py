@@ -0,0 +1,102 @@
+# 17 October 2026
+# Lisa Malins
+# Checkpoint.py
+
+"""
+Periodic checkpoints of a CalcKmerScores.py run, so a run that is killed
+part way (preempted node, out of memory) can pick up where it left off
+with --resume instead of starting over.
+
+A checkpoint records how far into the oligo file scoring has got, how much
+of the output (and missing k-mer log) was written by then, and the running
+number of missing k-mers. Output is flushed to disk before each checkpoint,
+and the checkpoint file is replaced in one step, so it never points past
+output that was actually written.
+
+Usage:
+from Checkpoint import Checkpoint, LoadCheckpoint, TruncateTo
+checkpoint = Checkpoint("scores.sam.checkpoint", oligos, output, missing, settings, interval=600)
+if checkpoint.Due():
+    checkpoint.Save(num_missing)
+checkpoint.Remove()                                 # once run is finished
+
+saved = LoadCheckpoint("scores.sam.checkpoint")     # dict, or None if there is none
+output = TruncateTo("scores.sam", saved["output_offset"])
+"""
+
+import json
+from os import fsync, replace, remove, path, stat
+from time import time, ctime
+
+class Checkpoint():
+    def __init__(self, filename, oligos, output, log_missing=False, settings=None, interval=600, base_missing=0):
+        self.filename = filename
+        self.oligos = oligos
+        self.output = output
+        self.log_missing = log_missing
+        # Options that change output, so a resumed run can check they match
+        self.settings = settings if settings else {}
+        # Seconds between checkpoints, 0 for none
+        self.interval = interval
+        # Missing k-mers counted before the run was resumed
+        self.base_missing = base_missing
+        self.num_saved = 0
+        self.last = time()
+
+    # Whether enough time has passed since last checkpoint
+    def Due(self):
+        return self.interval > 0 and time() - self.last >= self.interval
+
+    # Flush output to disk and record how far scoring has got
+    # num_missing counts missing k-mers since run (or resume) began;
+    # input_offset defaults to current position in oligo file
+    def Save(self, num_missing, input_offset=None):
+        if input_offset is None:
+            input_offset = self.oligos.tell()
+        for f in (self.output, self.log_missing):
+            if f:
+                f.flush()
+                fsync(f.fileno())
+
+        state = {
+            "oligos": path.abspath(self.oligos.name),
+            "oligos_size": stat(self.oligos.name).st_size,
+            "input_offset": input_offset,
+            "output_offset": self.output.tell(),
+            "missing_offset": self.log_missing.tell() if self.log_missing else None,
+            "num_missing": self.base_missing + num_missing,
+            "settings": self.settings,
+            "time": ctime(),
+        }
+        # Write whole checkpoint to temporary file, then replace old one with it
+        tmp = self.filename + ".tmp"
+        with open(tmp, 'w') as f:
+            json.dump(state, f, indent=1)
+            f.flush()
+            fsync(f.fileno())
+        replace(tmp, self.filename)
+
+        self.num_saved += 1
+        self.last = time()
+
+    # Remove checkpoint file once run is finished
+    def Remove(self):
+        if path.exists(self.filename):
+            remove(self.filename)
+
+# Reads checkpoint file
+# Returns dict of saved state, or None if there is no checkpoint
+def LoadCheckpoint(filename):
+    if not path.exists(filename):
+        return None
+    with open(filename, 'r') as f:
+        return json.load(f)
+
+# Opens file for writing, keeping only its first offset bytes
+def TruncateTo(filename, offset, buffering=-1):
+    f = open(filename, 'r+', buffering=buffering)
+    if stat(filename).st_size < offset:
+        raise AssertionError("File " + filename + " is shorter than its checkpoint; was it changed since?")
+    f.truncate(offset)
+    f.seek(offset)
+    return f
@@ -0,0 +1,90 @@
+# 17 October 2026
+# Lisa Malins
+# CompareKmerDicts.py
+
+"""
+Reports memory use of PackedKmerDict and MphKmerDict against NestedKmerDict.
+Loads each dump file into all three dictionaries, checks that every k-mer
+gets the same count from each, and prints the size of each in bytes.
+
+Usage:
+python CompareKmerDicts.py
+    Default: fakedump.fa, dump100.fa, and a scaled synthetic dump of 100000 17-mers
+
+python CompareKmerDicts.py {dump file} {dump file} ...
+python CompareKmerDicts.py --scaled {number of 17-mers}
+"""
+
+import sys
+from os import devnull, path
+from NestedKmerDict import NestedKmerDict
+from PackedKmerDict import PackedKmerDict
+from MphKmerDict import MphKmerDict
+from FakeFiles import fakescaleddump
+
+# Load dump into all dictionaries and report sizes
+def Compare(dumpfile, log):
+    nkd = NestedKmerDict()
+    nkd.Populate(dumpfile, log)
+    pkd = PackedKmerDict()
+    pkd.Populate(dumpfile, log)
+    mkd = MphKmerDict()
+    mkd.Populate(dumpfile, log)
+
+    # Both dictionaries must agree on every entry
+    for seq, count in NkdItems(nkd):
+        assert pkd.QueryFast(seq) == int(count), "Count mismatch for " + seq
+        assert pkd.QueryFast(nkd.RC(seq)) == int(nkd.QueryFast(nkd.RC(seq))), \
+        "Count mismatch for reverse complement of " + seq
+        # Mph stores larger count of k-mer and its reverse complement, capped
+        expected = min(max(int(count), int(nkd.QueryFast(nkd.RC(seq)))), mkd.count_cap)
+        assert mkd.Query(seq) == expected, "Count mismatch in mph for " + seq
+
+    nested_size, packed_size, mph_size = nkd.Size(), pkd.Size(), mkd.Size()
+    num_entries = nkd.NumEntries()
+    nkd.Close()
+    pkd.Close()
+    mkd.Close()
+    return num_entries, nested_size, packed_size, mph_size
+
+# Walk all sequences and counts in nested dictionary
+def NkdItems(nkd):
+    for level1, d1 in nkd.PrintAll().items():
+        for level2, d2 in d1.items():
+            for level3, count in d2.items():
+                yield level1 + level2 + level3, count
+
+if __name__ == '__main__':
+    usage = "Usage: python CompareKmerDicts.py {dump files} OR --scaled {number of 17-mers}"
+
+    num_scaled = 100000
+    if len(sys.argv) == 3 and sys.argv[1] == "--scaled":
+        num_scaled = int(sys.argv[2])
+        dumps = []
+    elif len(sys.argv) > 1:
+        if sys.argv[1][0] == "-":
+            exit(usage)
+        dumps = sys.argv[1:]
+    else:
+        dumps = ["fakedump.fa", "dump100.fa"]
+
+    # Make scaled synthetic dump unless specific files were requested
+    if len(sys.argv) == 1 or sys.argv[1] == "--scaled":
+        scaled = "fakescaleddump_" + str(num_scaled) + ".fa"
+        if not path.exists(scaled):
+            sys.stderr.write("Writing scaled synthetic dump " + scaled + "\n")
+            fakescaleddump(num_scaled, scaled)
+        dumps.append(scaled)
+
+    log = open(devnull, 'w')
+    results = []
+    for dumpfile in dumps:
+        num_entries, nested_size, packed_size, mph_size = Compare(dumpfile, log)
+        results.append((dumpfile, num_entries, nested_size, packed_size, mph_size))
+
+    print("\n{:<32}{:>12}{:>16}{:>16}{:>16}{:>10}{:>10}{:>10}{:>8}".format("dump file", "entries", \
+    "nested bytes", "packed bytes", "mph bytes", "nested/k", "packed/k", "mph/k", "ratio"))
+    for dumpfile, num_entries, nested_size, packed_size, mph_size in results:
+        print("{:<32}{:>12}{:>16}{:>16}{:>16}{:>10.1f}{:>10.1f}{:>10.1f}{:>8.1f}".format(dumpfile, num_entries, \
+        nested_size, packed_size, mph_size, nested_size / num_entries, packed_size / num_entries, \
+        mph_size / num_entries, nested_size / packed_size))
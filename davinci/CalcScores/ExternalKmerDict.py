@@ -0,0 +1,428 @@
+# 17 October 2026
+# Lisa Malins
+# ExternalKmerDict.py
+
+"""
+Out-of-core k-mer dictionary for machines without enough memory to hold the dump.
+Nothing is kept in memory but bounded buffers; everything else lives in
+temporary files on disk.
+
+Populate() reads the Jellyfish dump (fasta or column format) in blocks, sorts each batch by canonical
+2-bit code into a run file, then merges the runs into a table on disk with
+one row per canonical k-mer (count of each orientation found in the dump).
+
+ScoreSam() scores a sam file with a sort-merge join instead of lookups:
+1. Read oligos and write (canonical k-mer, oligo id and position) pairs
+   to sorted run files
+2. Merge the runs and join each merged block against the sorted table,
+   adding counts to per-oligo arrays kept in memory-mapped files
+3. Read the sam file again and write each line with its score in original order
+
+Scores, missing k-mer logs, and fast/exact mode behave the same as
+NestedKmerDict and PackedKmerDict.
+
+Usage:
+from ExternalKmerDict import ExternalKmerDict
+ekd = ExternalKmerDict(memory_budget=2 << 30, tmp_dir=".")
+ekd.Populate("dump.fa", log)
+num_missing = ekd.ScoreSam(oligos, output, log, fast, log_missing)
+ekd.Close()
+"""
+
+import sys
+import os
+import shutil
+import tempfile
+from time import ctime
+try:
+    from time import process_time
+except:
+    from time import clock as process_time #python2
+from datetime import timedelta
+try:
+    import numpy as np
+except ImportError:
+    exit("numpy not installed")
+from KmerEncoding import Encode, Decode, RCCode, RCCodes, EncodeAll
+from JellyfishDump import DumpReader
+
+# Records in sorted run files are a canonical code and a payload
+# Dump payload is count << 1 | orientation,
+# oligo payload is (oligo id * k-mers per oligo + position) << 1 | orientation,
+# where orientation is 1 if the sequence is the reverse complement of the canonical code
+
+# Bytes of memory per record while sorting a run (record, sort order, sorted copy)
+_BYTES_PER_RECORD = 48
+
+class ExternalKmerDict():
+    def __init__(self, source=None, k=17, memory_budget=1 << 30, tmp_dir=None):
+        self.k = k
+        self.memory_budget = memory_budget
+        # Records per sorted run, and per merged block
+        self.run_records = max(1 << 16, memory_budget // _BYTES_PER_RECORD)
+        self.block_records = max(1 << 14, self.run_records // 4)
+
+        # All files go in a fresh temporary directory, removed by Close()
+        self.tmp_dir = tempfile.mkdtemp(prefix="kmerjoin_", dir=tmp_dir)
+
+        # Sorted table of canonical codes, count of each orientation
+        # (canonical first), and whether each orientation was found in dump
+        self.table_keys = np.zeros(0, dtype=np.uint64)
+        self.table_counts = np.zeros((0, 2), dtype=np.uint64)
+        self.table_found = np.zeros((0, 2), dtype=bool)
+
+        # Size info
+        self.num_entries = 0
+        self.cur_size = 0
+
+        # Deluxe constructor: Can populate at same time
+        if source is not None:
+            self.Populate(source)
+
+    # Temporary files go too if program stops early
+    def __del__(self):
+        self.Close()
+
+    # Use in with statement to remove temporary files at end of block
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.Close()
+
+    # Read k-mers from Jellyfish dump file into sorted table on disk
+    # Accepts string of filename or file object
+    def Populate(self, source, log=open("/dev/fd/1", 'w')):
+        assert self.num_entries == 0, "Populate only reads one dump into an external k-mer dictionary"
+        time0 = process_time()
+
+        # If string of filename passed, reassign variable to be file object
+        if isinstance(source, str):
+            try:
+                source = open(source, 'r')
+            except FileNotFoundError:
+                exit("File " + source + " not found")
+
+        sys.stderr.write("\nSorting kmer counts from file " + source.name + " into " + self.tmp_dir + "...\n")
+        sys.stderr.write("Logging to " + log.name + "\n")
+        log.write("Kmer sorting from " + source.name + " began at time " + ctime() + "\n")
+        log.write("Memory budget is " + str(self.memory_budget) + " bytes, " + \
+            str(self.run_records) + " records per sorted run\n")
+        log.flush()
+
+        runs = _RunWriter(self.tmp_dir, "dump", self.run_records)
+
+        # Parse dump a block at a time and add it to current run
+        reader = DumpReader(source, self.k)
+        for codes, counts, seqs in reader:
+            rcodes = RCCodes(codes, self.k)
+            orient = (rcodes < codes).astype(np.uint64)
+            runs.Add(np.minimum(codes, rcodes), (counts << np.uint64(1)) | orient)
+        self.num_entries = reader.num_records
+
+        source.close()
+        run_files = runs.Close()
+        log.write(str(self.num_entries) + " kmers sorted into " + str(len(run_files)) + " runs\n")
+        log.flush()
+
+        # Merge runs into one table, a block at a time
+        table = [open(os.path.join(self.tmp_dir, "table." + part), 'wb') for part in ("keys", "counts", "found")]
+        num_rows = 0
+        for keys, values in _MergeRuns(run_files, self.block_records):
+            keys, counts, found = self._Reduce(keys, values, source.name)
+            for f, part in zip(table, (keys, counts, found)):
+                part.tofile(f)
+            num_rows += len(keys)
+        for f in table:
+            f.close()
+        _RemoveRuns(run_files)
+        self._OpenTable(num_rows)
+
+        # Output size of table
+        proc_time = process_time() - time0
+        self.cur_size = self.Size()
+        sys.stderr.write(str(self.num_entries) + " kmers and counts sorted from file " + source.name + "\n")
+        sys.stderr.write("Table size on disk is " + str(self.cur_size) + " bytes.\n")
+        log.write("Kmer sorting from " + source.name + " completed at time " + ctime() + "\n")
+        log.write("Sort time: " + str(timedelta(seconds=proc_time)) + " (total seconds = " + str(proc_time) + ")\n")
+        log.write("Sort rate: " + reader.Rates(proc_time) + " (" + reader.format + " format)\n")
+        log.write("Table size on disk is " + str(self.cur_size) + " bytes for " + str(num_rows) + \
+            " canonical k-mers from " + str(self.num_entries) + " entries\n")
+        log.flush()
+
+    # Combine block of dump records into table rows, one per canonical code
+    # Raises AssertionError on duplicates, same as NestedKmerDict
+    def _Reduce(self, keys, values, name):
+        orient = (values & np.uint64(1)).astype(np.int64)
+        order = np.lexsort((orient, keys))
+        keys = keys[order]
+        orient = orient[order]
+        counts = values[order] >> np.uint64(1)
+
+        # If entry already exists, raise error (should be no duplicates in file)
+        dups = np.flatnonzero((keys[1:] == keys[:-1]) & (orient[1:] == orient[:-1]))
+        if len(dups):
+            code = int(keys[dups[0]])
+            if orient[dups[0]]:
+                code = RCCode(code, self.k)
+            raise AssertionError("Duplicate entry found for sequence " + Decode(code, self.k) + " in " + name)
+
+        # Row of each record
+        first = np.concatenate(([True], keys[1:] != keys[:-1]))
+        rows = np.cumsum(first) - 1
+        table_counts = np.zeros((first.sum(), 2), dtype=np.uint64)
+        table_found = np.zeros((first.sum(), 2), dtype=bool)
+        table_counts[rows, orient] = counts
+        table_found[rows, orient] = True
+        return keys[first], table_counts, table_found
+
+    # Memory-map table files written by Populate
+    def _OpenTable(self, num_rows):
+        if num_rows == 0:
+            return
+        path = os.path.join(self.tmp_dir, "table.")
+        self.table_keys = np.memmap(path + "keys", dtype=np.uint64, mode='r')
+        self.table_counts = np.memmap(path + "counts", dtype=np.uint64, mode='r', shape=(num_rows, 2))
+        self.table_found = np.memmap(path + "found", dtype=bool, mode='r', shape=(num_rows, 2))
+
+    # Calculate k-mer scores of oligos from sam file with a sort-merge join.
+    # Output is in original order with score and number missing appended as
+    # KS:i: and KM:i: tags, same as ScoreLines
+    # in CalcKmerScores.py, and so are the missing k-mer logs.
+    # Returns number of k-mers not found in dictionary
+    def ScoreSam(self, oligos, output, log, fast=True, log_missing=False, oligo_size=45):
+        k = self.k
+        num_kmers = oligo_size - k + 1
+        assert 0 < num_kmers <= 64, "External k-mer scoring needs 1 to 64 k-mers per oligo"
+        time0 = process_time()
+
+        # First pass: pair each k-mer with its oligo and position, in sorted runs
+        runs = _RunWriter(self.tmp_dir, "oligos", self.run_records)
+        num_oligos = 0
+        batch = []
+        line = oligos.readline()
+        while True:
+            if len(batch) == 1 << 14 or not line:
+                self._AddOligoKmers(runs, batch, num_oligos - len(batch), num_kmers)
+                batch = []
+                if not line:
+                    break
+            if line[0] != '@':
+                batch.append(line.split('\t', 10)[9][:oligo_size])
+                num_oligos += 1
+            line = oligos.readline()
+        run_files = runs.Close()
+        log.write("{} oligos split into k-mers in {} sorted runs\n".format(num_oligos, len(run_files)))
+        log.flush()
+
+        # Per-oligo scores and bit masks of positions found (and found in both orientations)
+        scores = self._Accumulator("scores", num_oligos)
+        found_mask = self._Accumulator("found", num_oligos)
+        both_mask = self._Accumulator("both", num_oligos) if not fast else None
+
+        # Second step: merge runs and join each block against table
+        one = np.uint64(1)
+        for keys, values in _MergeRuns(run_files, self.block_records):
+            # Only search the stretch of table this block's keys fall in
+            lo = int(np.searchsorted(self.table_keys, keys[0]))
+            hi = int(np.searchsorted(self.table_keys, keys[-1], side='right'))
+            if lo == hi:
+                continue
+            rows = np.minimum(np.searchsorted(self.table_keys[lo:hi], keys), hi - lo - 1) + lo
+            hit = self.table_keys[rows] == keys
+            rows = rows[hit]
+            values = values[hit]
+
+            orient = (values & one).astype(np.int64)
+            slots = values >> one
+            ids = (slots // np.uint64(num_kmers)).astype(np.int64)
+            bits = one << (slots % np.uint64(num_kmers))
+            counts = np.array(self.table_counts[rows])
+            found = np.array(self.table_found[rows])
+            index = np.arange(len(rows))
+
+            if fast:
+                # Orientation matching oligo if found, otherwise the other one
+                same = found[index, orient]
+                count = np.where(same, counts[index, orient], counts[index, 1 - orient])
+            else:
+                count = np.where(found, counts, 0).max(axis=1)
+                both = found.all(axis=1)
+                np.bitwise_or.at(both_mask, ids[both], bits[both])
+            np.add.at(scores, ids, count)
+            np.bitwise_or.at(found_mask, ids, bits)
+
+        _RemoveRuns(run_files)
+        log.write("Join completed at " + ctime() + "\n")
+        log.flush()
+
+        # Third step: read sam file again and write scores in original order
+        oligos.seek(0)
+        num_missing = 0
+        oligo_id = 0
+        line = oligos.readline()
+        while line:
+            # Print headers without touching them
+            if line[0] == '@':
+                output.write(line)
+                line = oligos.readline()
+                continue
+
+            fields = line.split('\t', 10)
+            oligo, name = fields[9], fields[0]
+            mask = int(found_mask[oligo_id])
+
+            # Log k-mers found in both orientations in same order as Query
+            if both_mask is not None and both_mask[oligo_id]:
+                both = int(both_mask[oligo_id])
+                for i in range(num_kmers):
+                    if both >> i & 1:
+                        kmer = oligo[i:i+k]
+                        log.write("Both " + kmer + " and reverse complement " + \
+                            Decode(RCCode(Encode(kmer), k), k) + " found in dictionary\n")
+
+            # If k-mer not found in dictionary (or oligo too short to have it), note in log
+            oligo_missing = num_kmers - bin(mask).count("1")
+            num_missing += oligo_missing
+            if oligo_missing and log_missing:
+                log_missing.write("".join("No dictionary entry for " + oligo[i:i+k] + \
+                    " from source oligo " + name + "\n" for i in range(num_kmers) if not mask >> i & 1))
+
+            output.write(line.rstrip('\n') + "\tKS:i:" + str(int(scores[oligo_id])) + \
+                "\tKM:i:" + str(oligo_missing) + "\n")
+            oligo_id += 1
+            line = oligos.readline()
+
+        del scores, found_mask, both_mask
+        for part in ("scores", "found", "both"):
+            filename = os.path.join(self.tmp_dir, part)
+            if os.path.exists(filename):
+                os.remove(filename)
+
+        proc_time = process_time() - time0
+        log.write("Sort-merge join time: " + str(timedelta(seconds=proc_time)) + " (total seconds = " + str(proc_time) + ")\n")
+        return num_missing
+
+    # Add k-mers of batch of oligos to sorted runs
+    # Oligos are joined with N between them, so k-mers spanning two oligos come out invalid
+    def _AddOligoKmers(self, runs, batch, first_id, num_kmers):
+        if not batch:
+            return
+        k = self.k
+        starts = np.cumsum([0] + [len(oligo) + 1 for oligo in batch[:-1]])
+        codes, valid = EncodeAll("N".join(batch), k)
+        windows = np.flatnonzero(valid)
+        which = np.searchsorted(starts, windows, side='right') - 1
+        slots = ((first_id + which) * num_kmers + windows - starts[which]).astype(np.uint64)
+
+        codes = codes[valid]
+        rcodes = RCCodes(codes, k)
+        orient = (rcodes < codes).astype(np.uint64)
+        runs.Add(np.minimum(codes, rcodes), (slots << np.uint64(1)) | orient)
+
+    # Zeroed uint64 array of given length in memory-mapped file
+    def _Accumulator(self, name, length):
+        if length == 0:
+            return np.zeros(0, dtype=np.uint64)
+        return np.memmap(os.path.join(self.tmp_dir, name), dtype=np.uint64, mode='w+', shape=(length,))
+
+    # Remove temporary files
+    def Close(self):
+        self.table_keys = np.zeros(0, dtype=np.uint64)
+        self.table_counts = np.zeros((0, 2), dtype=np.uint64)
+        self.table_found = np.zeros((0, 2), dtype=bool)
+        if os.path.isdir(self.tmp_dir):
+            shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    # Same as Close, for contextlib.closing and habits from file objects
+    close = Close
+
+    # Size of table on disk in bytes
+    def Size(self):
+        return self.table_keys.nbytes + self.table_counts.nbytes + self.table_found.nbytes
+
+    def NumEntries(self):
+        return self.num_entries
+
+    def Help(self):
+        print("ekd.ScoreSam(oligos, output, log, fast, log_missing) to score sam file with sort-merge join\n" \
+        "ekd.NumEntries() for number of entries\n" \
+        "ekd.Size() for size of table on disk in bytes\n" \
+        "ekd.Close() to remove temporary files")
+
+# Collects records into fixed-size buffers and writes each full buffer to disk as a sorted run
+# Each run is a file of keys and a file of values, so keys can be searched without copying
+class _RunWriter():
+    def __init__(self, tmp_dir, prefix, run_records):
+        self.tmp_dir = tmp_dir
+        self.prefix = prefix
+        self.keys = np.empty(run_records, dtype=np.uint64)
+        self.values = np.empty(run_records, dtype=np.uint64)
+        self.used = 0
+        self.files = []
+
+    # Add arrays of keys and values
+    def Add(self, keys, values):
+        done = 0
+        while done < len(keys):
+            take = min(len(keys) - done, len(self.keys) - self.used)
+            self.keys[self.used:self.used + take] = keys[done:done + take]
+            self.values[self.used:self.used + take] = values[done:done + take]
+            self.used += take
+            done += take
+            if self.used == len(self.keys):
+                self._Flush()
+
+    # Sort buffers and write them as next run
+    def _Flush(self):
+        if not self.used:
+            return
+        order = np.argsort(self.keys[:self.used], kind="stable")
+        filename = os.path.join(self.tmp_dir, self.prefix + ".run" + str(len(self.files)))
+        self.keys[:self.used][order].tofile(filename + ".keys")
+        self.values[:self.used][order].tofile(filename + ".values")
+        self.files.append(filename)
+        self.used = 0
+
+    # Write last run and free buffers
+    # Returns list of run filenames (without .keys/.values extension)
+    def Close(self):
+        self._Flush()
+        self.keys = self.values = None
+        return self.files
+
+# Remove run files written by _RunWriter
+def _RemoveRuns(filenames):
+    for filename in filenames:
+        os.remove(filename + ".keys")
+        os.remove(filename + ".values")
+
+# Merge sorted run files into sorted blocks of roughly block_records records.
+# Each step takes from every run all records up to the smallest key that
+# every run can reach within its share of the block, so blocks come out in
+# order and all records with the same key land in the same block.
+# Yields arrays of keys and values
+def _MergeRuns(filenames, block_records):
+    if not filenames:
+        return
+    keys = [np.memmap(filename + ".keys", dtype=np.uint64, mode='r') for filename in filenames]
+    values = [np.memmap(filename + ".values", dtype=np.uint64, mode='r') for filename in filenames]
+    positions = [0] * len(keys)
+    step = max(1, block_records // len(keys))
+
+    while True:
+        live = [i for i in range(len(keys)) if positions[i] < len(keys[i])]
+        if not live:
+            return
+        bound = min(keys[i][min(positions[i] + step, len(keys[i])) - 1] for i in live)
+
+        block_keys = []
+        block_values = []
+        for i in live:
+            end = positions[i] + int(np.searchsorted(keys[i][positions[i]:], bound, side='right'))
+            block_keys.append(np.array(keys[i][positions[i]:end]))
+            block_values.append(np.array(values[i][positions[i]:end]))
+            positions[i] = end
+        block_keys = np.concatenate(block_keys)
+        order = np.argsort(block_keys, kind="stable")
+        yield block_keys[order], np.concatenate(block_values)[order]
@@ -3,7 +3,7 @@
 # FakeFiles.py
 
 """
-These 3 functions make synthetic test files for LoadKmerDict.py and CalcKmerScores.py.
+These 4 functions make synthetic test files for LoadKmerDict.py and CalcKmerScores.py.
 
 fakedump() generates a fake file of 17-mers in the style of jellyfish dump.
 
@@ -12,11 +12,17 @@ unintentional) in the style of Lisa's earlier masterpiece GetOligos.py.
 
 fakesam() takes an existing sam file and swaps out 45-mers with fake ones.
 
-Every 17-mer and 45-mer generated is a string of A's followed by a string of G's.
+fakescaleddump() generates a jellyfish-style dump of any size with random 17-mers
+and counts, for measuring memory use and load time of the k-mer dictionaries.
+
+Except for fakescaleddump(), every 17-mer and 45-mer generated is a string of
+A's followed by a string of G's.
 These files play nicely together because the 17-mers from fakedump() completely
 cover the 45-mers from fake45mers() and fakesam().
 """
 
+import random
+
 # Makes fake jellyfish dump file
 def fakedump():
     output = open("fakedump.fa", 'w')
@@ -83,3 +89,30 @@ def fakesam():
 
         # Next sequence has 2 less A's and 2 more G's
         seq = seq[2:] + "GG"
+
+# Makes fake jellyfish dump file of random unique 17-mers
+# Counts follow a rough k-mer spectrum: mostly error k-mers with count 1,
+# a peak around the coverage, and a long tail of repeats
+def fakescaleddump(num_kmers=1000000, filename="fakescaleddump.fa", coverage=30, seed=85):
+    output = open(filename, 'w')
+    rng = random.Random(seed)
+    seen = set()
+
+    while len(seen) < num_kmers:
+        seq = "".join(rng.choice("ACGT") for x in range(17))
+        if seq in seen:
+            continue
+        seen.add(seq)
+
+        roll = rng.random()
+        if roll < 0.4:
+            count = 1
+        elif roll < 0.95:
+            count = max(2, int(rng.gauss(coverage, coverage / 4)))
+        else:
+            count = int(coverage * rng.paretovariate(0.8))
+
+        output.write(">" + str(count) + "\n")
+        output.write(seq + "\n")
+
+    output.close()
@@ -0,0 +1,154 @@
+# 17 October 2026
+# Lisa Malins
+# JellyfishDump.py
+
+"""
+Bulk reader for Jellyfish dump files, used by Populate in all k-mer dictionaries.
+Reads the dump in large blocks of bytes and parses every record in a block
+at once with NumPy, instead of two readline() calls per record.
+
+Accepts both formats of jellyfish dump, detected from the first byte:
+fasta    jellyfish dump          >count\\nSEQUENCE\\n
+column   jellyfish dump -c -t    SEQUENCE\\tcount\\n  (space also accepted)
+
+Usage:
+from JellyfishDump import DumpReader
+reader = DumpReader("dump.fa", k=17)
+for codes, counts, seqs in reader:
+    # codes: uint64 2-bit codes, counts: uint64 counts,
+    # seqs: uint8 array of ASCII sequences, one row per record
+    ...
+print(reader.format, reader.num_records, reader.num_bytes)
+"""
+
+try:
+    import numpy as np
+except ImportError:
+    exit("numpy not installed")
+from KmerEncoding import EncodeRows
+
+# Largest count that fits in uint64 without overflow while parsing digits
+_MAX_DIGITS = 19
+
+class DumpReader():
+    def __init__(self, source, k=17, block_size=1 << 24):
+        # If string of filename passed, open it; if text file passed, read its bytes
+        if isinstance(source, str):
+            source = open(source, 'rb')
+        self.name = source.name
+        self.file = getattr(source, "buffer", source)
+        self.k = k
+        self.block_size = block_size
+
+        # Detected from first byte of file, "fasta" or "column"
+        self.format = None
+        # Progress info
+        self.num_records = 0
+        self.num_bytes = 0
+
+    # Yields arrays of codes, counts, and ASCII sequences for each block of records
+    def __iter__(self):
+        leftover = b""
+        while True:
+            data = self.file.read(self.block_size)
+            block = leftover + data
+            if not block:
+                return
+            if self.format is None:
+                self.format = "fasta" if block[:1] == b">" else "column"
+
+            if data:
+                # Cut block after last complete record, keep rest for next block
+                if self.format == "fasta":
+                    cut = block.rfind(b"\n>") + 1
+                else:
+                    cut = block.rfind(b"\n") + 1
+                if cut <= 0:
+                    leftover = block
+                    continue
+                block, leftover = block[:cut], block[cut:]
+            elif not block.endswith(b"\n"):
+                # Last line of file without newline
+                block += b"\n"
+
+            self.num_bytes += len(block)
+            codes, counts, seqs = self._Parse(block)
+            self.num_records += len(codes)
+            yield codes, counts, seqs
+
+            if not data:
+                return
+
+    # Parse block of complete records
+    def _Parse(self, block):
+        k = self.k
+        arr = np.frombuffer(block, dtype=np.uint8)
+        ends = np.flatnonzero(arr == ord("\n"))
+        starts = np.empty_like(ends)
+        starts[:1] = 0
+        starts[1:] = ends[:-1] + 1
+
+        if self.format == "fasta":
+            # Count line then sequence line
+            if len(ends) % 2:
+                self._Unexpected(block, starts[-1], ends[-1])
+            seq_starts, seq_ends = starts[1::2], ends[1::2]
+            count_starts, count_ends = starts[0::2] + 1, ends[0::2]
+            bad = arr[starts[0::2]] != ord(">")
+            bad |= seq_ends - seq_starts != k
+            bad_lines = np.flatnonzero(bad) * 2
+            if len(bad_lines) and arr[starts[bad_lines[0]]] == ord(">"):
+                bad_lines += 1
+        else:
+            # Sequence, tab or space, count on each line
+            seq_starts = starts
+            count_starts, count_ends = starts + k + 1, ends
+            bad = ends - starts < k + 2
+            bad |= ~np.isin(arr[np.minimum(starts + k, len(arr) - 1)], (ord("\t"), ord(" ")))
+            bad_lines = np.flatnonzero(bad)
+        if len(bad_lines):
+            self._Unexpected(block, starts[bad_lines[0]], ends[bad_lines[0]])
+
+        # Sequences as matrix of bytes, one row per record
+        seqs = arr[seq_starts[:, None] + np.arange(k)]
+        codes, valid = EncodeRows(seqs)
+        if not valid.all():
+            raise ValueError("Function Encode only accepts A, C, G, and T")
+
+        return codes, self._ParseCounts(block, arr, count_starts, count_ends), seqs
+
+    # Parse decimal counts between starts and ends, one digit position at a time
+    # Counts are right-aligned, so shorter counts skip the first positions
+    def _ParseCounts(self, block, arr, starts, ends):
+        lengths = ends - starts
+        if not len(lengths):
+            return np.zeros(0, dtype=np.uint64)
+        width = int(lengths.max())
+        if lengths.min() < 1 or width > _MAX_DIGITS:
+            line = int(np.flatnonzero((lengths < 1) | (lengths > _MAX_DIGITS))[0])
+            self._Unexpected(block, starts[line], ends[line])
+
+        counts = np.zeros(len(lengths), dtype=np.uint64)
+        bad = np.zeros(len(lengths), dtype=bool)
+        for position in range(width, 0, -1):
+            in_count = lengths >= position
+            digits = arr[np.maximum(ends - position, 0)].astype(np.int16) - ord("0")
+            bad |= in_count & ((digits < 0) | (digits > 9))
+            counts = np.where(in_count, counts * np.uint64(10) + digits.astype(np.uint64), counts)
+        if bad.any():
+            line = int(np.flatnonzero(bad)[0])
+            self._Unexpected(block, starts[line], ends[line])
+        return counts
+
+    # Error message for unreadable input, same as line-by-line Populate
+    # Shows whole line from its beginning to end
+    def _Unexpected(self, block, start, end):
+        start = block.rfind(b"\n", 0, int(start)) + 1
+        line = block[start:int(end)].decode(errors="replace")
+        raise AssertionError("\nUnable to read k-mers and scores due to unexpected input. " + \
+        "Line was:\n" + line + "\nfrom " + self.name)
+
+    # Rate of reading, for logs
+    def Rates(self, seconds):
+        seconds = max(seconds, 1e-9)
+        return "{:.0f} records/s, {:.1f} MB/s".format(self.num_records / seconds, self.num_bytes / seconds / 1e6)
@@ -0,0 +1,92 @@
+# 17 October 2026
+# Lisa Malins
+# KmerBloom.py
+
+"""
+Bloom filter over canonical 2-bit k-mer codes, used by the k-mer dictionaries
+to reject k-mers that are not in the dump before probing their tables.
+A k-mer in the filter always passes; a k-mer not in it passes only rarely
+(false positive rate about 1% at 12 bits per k-mer), and then the table
+lookup finds it missing as usual. Scores are the same with or without it.
+
+Each k-mer sets num_hashes bits within one 64-bit word (a blocked Bloom
+filter), so checking a k-mer reads one word instead of num_hashes.
+
+Usage:
+from KmerBloom import KmerBloom
+bloom = KmerBloom(len(codes), bits_per_key=12)
+bloom.Add(Canonicals(codes, 17))
+bloom.MightContain(Canonicals(query_codes, 17))   # NumPy array of bools
+"""
+
+try:
+    import numpy as np
+except ImportError:
+    exit("numpy not installed")
+from KmerEncoding import HashCodes
+
+# Hash seed, different from the seeds MphKmerDict uses
+_BLOOM_SEED = 0x2545F491
+
+# Checking fewer k-mers than this at once (e.g. one oligo) costs more in
+# NumPy overhead than the lookups it saves, so dictionaries skip the filter
+MIN_KMERS = 256
+
+class KmerBloom():
+    # words: bit words of a filter saved before (e.g. mapped from an index), instead of an empty one
+    def __init__(self, num_keys, bits_per_key=12, num_hashes=None, words=None):
+        # Whole number of 64-bit words, at least one
+        self.num_words = max(1, -(-num_keys * bits_per_key // 64)) if words is None else len(words)
+        # Bits per key times ln 2 is the best number of hashes for a plain Bloom filter;
+        # blocked filters do better with a few less, and 6 bits of hash each must fit below bit 32
+        if num_hashes is None:
+            num_hashes = max(1, min(5, int(bits_per_key * 0.69) - 2))
+        assert 1 <= num_hashes <= 5, "num_hashes must be 1 to 5"
+        self.num_hashes = num_hashes
+        self.words = np.zeros(self.num_words, dtype=np.uint64) if words is None else words
+
+    # Word index and bit mask of each code
+    # Top 32 bits of hash pick the word, low bits pick the bits within it
+    def _Locate(self, codes):
+        h = HashCodes(np.asarray(codes, dtype=np.uint64), _BLOOM_SEED)
+        words = ((h >> np.uint64(32)) % np.uint64(self.num_words)).astype(np.int64)
+        one, six = np.uint64(1), np.uint64(6)
+        masks = np.zeros(len(h), dtype=np.uint64)
+        for i in range(self.num_hashes):
+            masks |= one << (h & np.uint64(63))
+            h = h >> six
+        return words, masks
+
+    # Add array of canonical codes to filter
+    # One OR per word over the codes sorted by word, same as MphKmerDict sets bits
+    def Add(self, codes):
+        if not len(codes):
+            return
+        words, masks = self._Locate(codes)
+        order = np.argsort(words, kind="stable")
+        words, masks = words[order], masks[order]
+        starts = np.flatnonzero(np.concatenate(([True], words[1:] != words[:-1])))
+        self.words[words[starts]] |= np.bitwise_or.reduceat(masks, starts)
+
+    # Returns array of whether each canonical code might be in filter
+    # False means certainly not
+    def MightContain(self, codes):
+        words, masks = self._Locate(codes)
+        return (self.words[words] & masks) == masks
+
+    # Size in bytes
+    def Size(self):
+        return self.words.nbytes
+
+# Demo: measure false positive rate on random codes
+if __name__ == '__main__':
+    rng = np.random.RandomState(1)
+    keys = rng.randint(0, 1 << 34, size=1000000, dtype=np.uint64)
+    others = rng.randint(0, 1 << 34, size=1000000, dtype=np.uint64)
+    others = others[~np.isin(others, keys)]
+    for bits_per_key in (8, 12, 16):
+        bloom = KmerBloom(len(keys), bits_per_key)
+        bloom.Add(keys)
+        assert bloom.MightContain(keys).all()
+        print("{} bits per k-mer, {} hashes: false positive rate {:.4f}".format( \
+            bits_per_key, bloom.num_hashes, bloom.MightContain(others).mean()))
@@ -0,0 +1,250 @@
+# 17 October 2026
+# Lisa Malins
+# KmerEncoding.py
+
+"""
+Helper functions for 2-bit encoding of k-mers.
+Each base takes 2 bits (A=0, C=1, G=2, T=3), so a k-mer of up to 32 bases
+fits in one unsigned 64-bit integer and sorts in the same order as its string.
+
+Usage:
+from KmerEncoding import Encode, Decode, RCCode
+Encode("ACGT")     # 27
+Decode(27, 4)      # "ACGT"
+RCCode(27, 4)      # 27 (ACGT is its own reverse complement)
+
+To encode every k-mer of an oligo without slicing out substrings:
+fcodes, rcodes = RollingCodes(oligo, 17)
+Canonical(fcodes[0], rcodes[0])
+
+To encode many k-mers (e.g. a batch of dump entries) at once:
+codes, valid = EncodeMany(["TAGAAGTGCCGAAGCAA", "AAAAAAAAAAAAAAAAA"], 17)
+Canonicals(codes, 17)
+
+To store a dump by canonical k-mer, with one count per k-mer and its reverse complement:
+keys, counts, num_collisions = CombineStrands(codes, counts, 17, conflict="max")
+"""
+
+try:
+    import numpy as np
+except ImportError:
+    exit("numpy not installed")
+
+# Translation tables between bases and base-4 digits
+_TO_DIGITS = str.maketrans("ACGT", "0123")
+_FROM_DIGITS = "ACGT"
+
+# Translation table from ASCII bytes to 2-bit codes, with 4 for anything but A, C, G, and T
+_TO_CODES = bytearray([4]) * 256
+for _code, _letter in enumerate(b"ACGT"):
+    _TO_CODES[_letter] = _code
+_TO_CODES = bytes(_TO_CODES)
+
+# Longest k-mer that fits in a 64-bit code
+MAX_K = 32
+
+# Converts sequence to 2-bit code
+# Raises ValueError for anything other than A, C, G, and T
+def Encode(seq):
+    try:
+        return int(seq.translate(_TO_DIGITS), 4)
+    except ValueError:
+        raise ValueError("Function Encode only accepts A, C, G, and T")
+
+# Converts 2-bit code back to sequence of length k
+def Decode(code, k):
+    letters = []
+    for i in range(k):
+        letters.append(_FROM_DIGITS[code & 3])
+        code >>= 2
+    return "".join(reversed(letters))
+
+# Converts 2-bit code to the code of its reverse complement
+# Complement is bitwise NOT, then the 2-bit groups are reversed in place
+def RCCode(code, k):
+    code = ~code & 0xFFFFFFFFFFFFFFFF
+    code = ((code >> 2) & 0x3333333333333333) | ((code & 0x3333333333333333) << 2)
+    code = ((code >> 4) & 0x0F0F0F0F0F0F0F0F) | ((code & 0x0F0F0F0F0F0F0F0F) << 4)
+    code = ((code >> 8) & 0x00FF00FF00FF00FF) | ((code & 0x00FF00FF00FF00FF) << 8)
+    code = ((code >> 16) & 0x0000FFFF0000FFFF) | ((code & 0x0000FFFF0000FFFF) << 16)
+    code = ((code >> 32) & 0x00000000FFFFFFFF) | ((code & 0x00000000FFFFFFFF) << 32)
+    return (code & 0xFFFFFFFFFFFFFFFF) >> (64 - 2 * k)
+
+# Canonical code is the smaller of a k-mer and its reverse complement
+def Canonical(fcode, rcode):
+    return fcode if fcode <= rcode else rcode
+
+# Encodes every k-mer along sequence in one pass with rolling updates.
+# Each new base shifts into the forward code from the right and,
+# complemented, into the reverse complement code from the left.
+# Returns list of forward codes and list of reverse complement codes,
+# one per k-mer, with None for k-mers containing anything but A, C, G, and T
+def RollingCodes(seq, k):
+    mask = (1 << (2 * k)) - 1
+    top = 2 * (k - 1)
+    fcodes = []
+    rcodes = []
+    fcode = rcode = 0
+    # Number of valid bases in a row ending at current position
+    run = 0
+
+    for i, base in enumerate(seq.encode().translate(_TO_CODES)):
+        if base == 4:
+            run = 0
+        else:
+            fcode = ((fcode << 2) | base) & mask
+            rcode = (rcode >> 2) | ((3 - base) << top)
+            run += 1
+        if i >= k - 1:
+            if run >= k:
+                fcodes.append(fcode)
+                rcodes.append(rcode)
+            else:
+                fcodes.append(None)
+                rcodes.append(None)
+    return fcodes, rcodes
+
+# Same as RCCode but for a NumPy array of uint64 codes
+def RCCodes(codes, k):
+    codes = ~np.asarray(codes, dtype=np.uint64)
+    for shift, mask in ((2, 0x3333333333333333), (4, 0x0F0F0F0F0F0F0F0F), \
+    (8, 0x00FF00FF00FF00FF), (16, 0x0000FFFF0000FFFF), (32, 0x00000000FFFFFFFF)):
+        shift, mask = np.uint64(shift), np.uint64(mask)
+        codes = ((codes >> shift) & mask) | ((codes & mask) << shift)
+    return codes >> np.uint64(64 - 2 * k)
+
+# Same translation table as NumPy array
+_BASE_CODES = np.frombuffer(_TO_CODES, dtype=np.uint8)
+
+# Converts every k-mer along sequence to 2-bit code at once
+# Returns NumPy array of codes and array of whether each k-mer
+# is valid (only A, C, G, and T); codes of invalid k-mers are meaningless
+def EncodeAll(seq, k):
+    bases = _BASE_CODES[np.frombuffer(seq.encode(), dtype=np.uint8)]
+    num_kmers = len(bases) - k + 1
+    if num_kmers <= 0:
+        return np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=bool)
+
+    # K-mer is valid if its window holds no invalid bases
+    invalid_sums = np.concatenate(([0], np.cumsum(bases == 4)))
+    valid = invalid_sums[k:] == invalid_sums[:-k]
+
+    # Shift in one base at a time across all positions
+    bases = bases.astype(np.uint64) & np.uint64(3)
+    codes = np.zeros(num_kmers, dtype=np.uint64)
+    for i in range(k):
+        codes = (codes << np.uint64(2)) | bases[i:i + num_kmers]
+    return codes, valid
+
+# Converts list of sequences, all of length k, to 2-bit codes at once
+# Returns NumPy array of codes and array of whether each sequence
+# is valid (only A, C, G, and T); codes of invalid sequences are meaningless
+def EncodeMany(seqs, k):
+    letters = np.frombuffer("".join(seqs).encode(), dtype=np.uint8)
+    if len(letters) != len(seqs) * k:
+        raise ValueError("Function EncodeMany only accepts sequences of length " + str(k))
+    return EncodeRows(letters.reshape(len(seqs), k))
+
+# Same as EncodeMany, but for a NumPy array of ASCII bytes with one sequence per row
+def EncodeRows(letters):
+    bases = _BASE_CODES[letters]
+    valid = (bases != 4).all(axis=1)
+
+    # One base position at a time, each a contiguous row after transposing
+    codes = np.zeros(len(bases), dtype=np.uint64)
+    for column in np.ascontiguousarray(bases.T):
+        codes <<= np.uint64(2)
+        codes |= column
+    return codes, valid
+
+# Codes of a batch of k-mers for QueryMany, which takes either
+# NumPy array of 2-bit codes (all valid) or list of sequences of length k
+# Returns NumPy array of codes and array of whether each is valid
+def EncodeKmers(kmers, k):
+    if isinstance(kmers, np.ndarray):
+        return kmers.astype(np.uint64, copy=False), np.ones(len(kmers), dtype=bool)
+    if isinstance(kmers, str):
+        kmers = [kmers]
+    return EncodeMany(list(kmers), k)
+
+# Canonical codes of a NumPy array of codes
+def Canonicals(codes, k):
+    return np.minimum(codes, RCCodes(codes, k))
+
+# Returns array of whether each code is in sorted array keys
+def IsIn(codes, keys):
+    if len(keys) == 0:
+        return np.zeros(len(codes), dtype=bool)
+    pos = np.minimum(np.searchsorted(keys, codes), len(keys) - 1)
+    return keys[pos] == codes
+
+# 64-bit hash of NumPy array of uint64 codes with seed (murmur3 finalizer)
+# NumPy uint64 arithmetic wraps around, which is what the mixing needs
+def HashCodes(codes, seed):
+    x = codes ^ np.uint64((seed * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF)
+    x = x ^ (x >> np.uint64(33))
+    x = x * np.uint64(0xFF51AFD7ED558CCD)
+    x = x ^ (x >> np.uint64(33))
+    x = x * np.uint64(0xC4CEB9FE1A85EC53)
+    return x ^ (x >> np.uint64(33))
+
+# Ways to combine counts of a k-mer and its reverse complement
+# when both are in a dump: keep the larger, add them, or raise an error
+CONFLICT_POLICIES = ("max", "sum", "error")
+
+# Same as Decode but for a NumPy array of codes
+# Returns NumPy array of ASCII bytes with one sequence per row
+def DecodeRows(codes, k):
+    shifts = np.arange(2 * (k - 1), -1, -2, dtype=np.uint64)
+    digits = (np.asarray(codes, dtype=np.uint64)[:, None] >> shifts) & np.uint64(3)
+    return np.frombuffer(b"ACGT", dtype=np.uint8)[digits.astype(np.intp)]
+
+# Combines counts of each run of equal keys in sorted array keys by conflict policy
+# Returns unique keys, their counts, and number of entries combined away
+def CombineRuns(keys, counts, conflict="max"):
+    first = np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1])))
+    if len(first) == len(keys):
+        return keys, counts, 0
+    if conflict == "sum":
+        counts = np.add.reduceat(counts, first)
+    else:
+        counts = np.maximum.reduceat(counts, first)
+    return keys[first], counts, len(keys) - len(first)
+
+# Converts codes and counts of dump entries to sorted unique canonical codes
+# If a k-mer and its reverse complement are both in the dump, their counts
+# are combined by conflict policy ("max" matches exact mode of Query)
+# Returns canonical codes, counts, and number of k-mers found with their reverse complement
+# Raises AssertionError if the same k-mer is in the dump twice,
+# or if conflict is "error" and a k-mer is in the dump with its reverse complement
+def CombineStrands(codes, counts, k, conflict="max", name="dump"):
+    assert conflict in CONFLICT_POLICIES, "conflict must be one of " + ", ".join(CONFLICT_POLICIES)
+    keys = Canonicals(codes, k)
+    orient = keys != codes
+    order = np.lexsort((orient, keys))
+    keys = keys[order]
+    counts = counts[order]
+    orient = orient[order]
+    same_key = keys[1:] == keys[:-1]
+
+    # If entry already exists, raise error (should be no duplicates in file)
+    dups = np.flatnonzero(same_key & (orient[1:] == orient[:-1]))
+    if len(dups):
+        code = int(keys[dups[0]])
+        if orient[dups[0]]:
+            code = RCCode(code, k)
+        raise AssertionError("Duplicate entry found for sequence " + Decode(code, k) + " in " + name)
+
+    if conflict == "error" and same_key.any():
+        code = int(keys[np.flatnonzero(same_key)[0]])
+        raise AssertionError("Both " + Decode(code, k) + " and reverse complement " + \
+        Decode(RCCode(code, k), k) + " found in " + name)
+    return CombineRuns(keys, counts, conflict)
+
+# Example usage
+if __name__ == '__main__':
+    for seq in ["AAAAAAAAAAAAAAAAA", "TAGAAGTGCCGAAGCAA", "ACGT"]:
+        code = Encode(seq)
+        rc = RCCode(code, len(seq))
+        print(seq, code, Decode(rc, len(seq)), rc)
+    print(RollingCodes("TAGAAGTGCCGAAGCAAC", 17))
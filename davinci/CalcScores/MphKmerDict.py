@@ -0,0 +1,643 @@
+# 17 October 2026
+# Lisa Malins
+# MphKmerDict.py
+
+"""
+Minimal perfect hash k-mer dictionary class for very large k-mer spectra.
+K-mers themselves are not stored. Each canonical k-mer is hashed to its own
+slot in a dense array of counts, so it takes a few bits of hash plus its
+count plus a small fingerprint, instead of the 8-byte key PackedKmerDict keeps.
+
+Layout (BBHash-style, see Limasset et al. 2017):
+buckets       k-mers are split into buckets of about a million by a hash, and
+              each bucket gets its own stretch of every level, so the hash is
+              built one bucket at a time
+levels        bit arrays of about 2 bits per remaining k-mer; a k-mer belongs to
+              the first level where its hash hits a bit no other k-mer of its
+              bucket hit
+ranks         number of set bits before each 512-bit block, and before each
+              word within its block, so a k-mer's slot is the number of
+              set bits before its own
+counts        one count per slot, saturating at count_cap
+fingerprints  8 or 16 bits of a second hash per slot; k-mers not in the
+              dictionary land on some slot too, and are rejected unless
+              their fingerprint matches (false match rate about 1 in 2^bits)
+
+Because keys are canonical, Query and QueryFast are the same single lookup.
+If a dump has both a k-mer and its reverse complement, the larger count is
+kept by default, which matches exact mode of the other dictionaries
+(conflict="sum" adds them, conflict="error" refuses the dump).
+Unlike them, a count above count_cap reads as count_cap, and an absent
+k-mer is very rarely reported with some other k-mer's count.
+
+Populate reads the dump once, writing each k-mer to a temporary file for its
+group of buckets, then reads the files back one at a time and builds their
+buckets. Only one file's k-mers are in memory at once, on top of the
+finished arrays.
+
+The finished arrays can be saved to an index file with Save(), which
+BuildKmerIndex.py --backend mph does once per dump. Load() opens it with
+mmap, the same as PackedKmerDict.Load.
+
+Usage:
+mkd = MphKmerDict(count_cap=65535, fingerprint_bits=16)
+mkd.Populate("dump.fa")
+mkd.Query("TAGAAGTGCCGAAGCAA")
+mkd.Save("dump.kidx")
+"""
+
+import sys
+import os
+import mmap
+import shutil
+import struct
+import tempfile
+from time import ctime
+try:
+    from time import process_time
+except:
+    from time import clock as process_time #python2
+from datetime import timedelta
+try:
+    import numpy as np
+except ImportError:
+    exit("numpy not installed")
+from KmerEncoding import Encode, Canonicals, HashCodes, IsIn, EncodeAll, EncodeKmers, RollingCodes, RCCodes, CombineStrands
+from JellyfishDump import DumpReader
+from KmerBloom import KmerBloom, MIN_KMERS
+
+# Number of set bits in each byte value
+_POPCOUNT8 = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+# Bits per rank block
+_BLOCK_WORDS = 8
+
+# Give up building levels after this many and keep leftover k-mers in a sorted side table
+_MAX_LEVELS = 32
+
+# Seed of fingerprint hash, different from every level seed
+_FINGERPRINT_SEED = 0x5bd1e995
+
+# Seed of hash picking each k-mer's bucket
+_BUCKET_SEED = 0x27d4eb2f
+
+# K-mers per bucket aimed for when choosing number of buckets from size of dump
+_BUCKET_KMERS = 1 << 18
+
+# Most temporary files k-mers are split into while building, one open at a time per file
+_MAX_PARTITION_BITS = 8
+
+# Temporary file record of k-mer code and count
+_RECORD = np.dtype([("code", "<u8"), ("count", "<u8")])
+
+# Index file format
+# Header is magic, version, k, bucket bits, number of levels, bytes per count,
+# fingerprint bits, flags, Bloom filter bits per k-mer and hashes,
+# number of entries, slots, leftover k-mers, Bloom filter words, count cap,
+# padded to 128 bytes. Flags are 1 if there is a Bloom filter.
+# Then seed and number of words of each level, then each level's bucket
+# bases, words, ranks and word ranks, then counts, fingerprints, leftover keys,
+# leftover counts and Bloom filter words, each starting on an 8-byte boundary.
+# All numbers are little-endian.
+MPH_INDEX_MAGIC = b"DAVKMPH\0"
+MPH_INDEX_VERSION = 1
+_HEADER = struct.Struct("<8sIIIIIIIIIQQQQQ")
+_FLAG_BLOOM = 1
+_HEADER_SIZE = 128
+
+# Returns True if file is a k-mer index written by MphKmerDict.Save
+def IsMphIndex(filename):
+    with open(filename, 'rb') as f:
+        return f.read(len(MPH_INDEX_MAGIC)) == MPH_INDEX_MAGIC
+
+# Number of set bits in each uint64 word
+def _Popcount(words):
+    words = np.ascontiguousarray(words, dtype=np.uint64)
+    return _POPCOUNT8[words.view(np.uint8)].reshape(words.shape + (8,)).sum(axis=-1, dtype=np.int64)
+
+class MphKmerDict():
+    # bucket_bits: log2 of number of buckets (default: chosen from size of dump)
+    # tmp_dir: directory for temporary files while building (default: system temporary directory)
+    def __init__(self, source=None, k=17, count_cap=65535, fingerprint_bits=16, gamma=2.0, conflict="max", \
+    bloom_bits=0, bucket_bits=None, tmp_dir=None):
+        self.k = k
+        self.fixed_bucket_bits = bucket_bits
+        self.tmp_dir = tmp_dir
+        self.bloom_bits = bloom_bits
+        self.conflict = conflict
+        self.count_cap = count_cap
+        self.fingerprint_bits = fingerprint_bits
+        self.gamma = gamma
+        if count_cap < 1 << 8:
+            self.count_dtype = np.uint8
+        elif count_cap < 1 << 16:
+            self.count_dtype = np.uint16
+        else:
+            self.count_dtype = np.uint32
+        assert count_cap <= np.iinfo(self.count_dtype).max, "count_cap must fit in 32 bits"
+        assert fingerprint_bits in (8, 16), "fingerprint_bits must be 8 or 16"
+        self.fingerprint_dtype = np.uint8 if fingerprint_bits == 8 else np.uint16
+
+        self._Empty()
+
+        # Deluxe constructor: Can populate at same time
+        if source is not None:
+            self.Populate(source)
+
+    # Start with no levels and no slots
+    def _Empty(self):
+        # Each level is (seed, first bit of each bucket and end of last, bit words,
+        # ranks of blocks, ranks of words in block)
+        self.levels = []
+        self.bucket_bits = 0
+        self.counts = np.zeros(0, dtype=self.count_dtype)
+        self.fingerprints = np.zeros(0, dtype=self.fingerprint_dtype)
+        # Sorted side table for k-mers no level could place
+        self.leftover_keys = np.zeros(0, dtype=np.uint64)
+        self.leftover_counts = np.zeros(0, dtype=self.count_dtype)
+        # Optional Bloom filter over canonical keys
+        self.bloom = None
+
+        # Size info
+        self.num_entries = 0
+        self.num_collisions = 0
+        self.num_saturated = 0
+        self.cur_size = 0
+
+    # Use in with statement to release arrays at end of block
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.Close()
+
+    # Release arrays, and unmap index file if opened with Load
+    def Close(self):
+        self._Empty()
+        index_map = getattr(self, "index_map", None)
+        if index_map is not None:
+            try:
+                index_map.close()
+            except BufferError:
+                # Someone still holds a view of the index; it is unmapped when they let go
+                pass
+            self.index_map = None
+
+    # Same as Close, for contextlib.closing and habits from file objects
+    close = Close
+
+    # Read k-mers from Jellyfish dump file and build hash over them
+    # Accepts string of filename or file object
+    # keep is an optional sorted NumPy array of canonical codes, same as PackedKmerDict
+    # All k-mers are needed to build the hash, so only one dump can be read
+    # K-mers go through temporary files by bucket, so only one file of them is in memory at once
+    def Populate(self, source, log=open("/dev/fd/1", 'w'), keep=None):
+        assert not self.num_entries, "Populate only reads one dump into a minimal perfect hash dictionary"
+        time0 = process_time()
+
+        # If string of filename passed, reassign variable to be file object
+        if isinstance(source, str):
+            try:
+                source = open(source, 'r')
+            except FileNotFoundError:
+                exit("File " + source + " not found")
+
+        sys.stderr.write("\nReading kmer counts from file " + source.name + "...\n")
+        sys.stderr.write("Logging to " + log.name + "\n")
+        log.write("Kmer loading from " + source.name + " began at time " + ctime() + "\n")
+        if keep is not None:
+            log.write("Keeping only k-mers from set of " + str(len(keep)) + " canonical k-mers\n")
+        log.flush()
+
+        # Number of buckets from size of dump, if it is a regular file
+        self.bucket_bits = self.fixed_bucket_bits
+        if self.bucket_bits is None:
+            try:
+                num_kmers = os.fstat(source.fileno()).st_size // (self.k + 4)
+            except (AttributeError, OSError):
+                num_kmers = 0
+            self.bucket_bits = max(0, (num_kmers // _BUCKET_KMERS).bit_length())
+        partition_bits = min(self.bucket_bits, _MAX_PARTITION_BITS)
+
+        tmp_dir = tempfile.mkdtemp(prefix="mphbuild_", dir=self.tmp_dir)
+        try:
+            # Write codes and counts to file of their buckets
+            filenames = [os.path.join(tmp_dir, "part" + str(i)) for i in range(1 << partition_bits)]
+            parts = [open(filename, 'wb') for filename in filenames]
+            reader = DumpReader(source, self.k)
+            num_kept = 0
+            for codes, counts, seqs in reader:
+                keys = Canonicals(codes, self.k)
+                if keep is not None:
+                    kept = IsIn(keys, keep)
+                    codes, counts, keys = codes[kept], counts[kept], keys[kept]
+                num_kept += len(codes)
+                records = np.empty(len(codes), dtype=_RECORD)
+                records["code"] = codes
+                records["count"] = counts
+                part = self._Buckets(keys) >> (self.bucket_bits - partition_bits)
+                order = np.argsort(part, kind="stable")
+                part, records = part[order], records[order]
+                bounds = np.searchsorted(part, np.arange((1 << partition_bits) + 1))
+                for i in np.flatnonzero(np.diff(bounds)).tolist():
+                    records[bounds[i]:bounds[i + 1]].tofile(parts[i])
+                del codes, counts, keys, records, part, order
+            source.close()
+            for part in parts:
+                part.close()
+
+            # Build buckets of each file in turn
+            self._Build(filenames, source.name, num_kept)
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+        # Output size of dictionary
+        proc_time = process_time() - time0
+        sys.stderr.write(str(reader.num_records) + " kmers and counts read from file " + source.name + "\n")
+        self.cur_size = self.Size()
+        sys.stderr.write("Memory size is " + str(self.cur_size) + " bytes.\n")
+        log.write("Kmer loading from " + source.name + " completed at time " + ctime() + "\n")
+        log.write("Load time: " + str(timedelta(seconds=proc_time)) + " (total seconds = " + str(proc_time) + ")\n")
+        log.write("Load rate: " + reader.Rates(proc_time) + " (" + reader.format + " format)\n")
+        log.write("{} k-mers found with reverse complement in dump, counts combined by {}\n".format( \
+            self.num_collisions, self.conflict))
+        log.write("{} counts saturated at {}\n".format(self.num_saturated, self.count_cap))
+        log.write("Hash has {} buckets, {} levels and {} leftover k-mers, {:.2f} bits per k-mer\n".format( \
+            1 << self.bucket_bits, len(self.levels), len(self.leftover_keys), \
+            8 * self._HashSize() / max(1, self.num_entries)))
+        if self.bloom is not None:
+            log.write("Bloom filter of {} bytes ({} bits per k-mer, {} hashes)\n".format( \
+                self.bloom.Size(), self.bloom_bits, self.bloom.num_hashes))
+        log.write("Total size in memory is " + str(self.cur_size) + " bytes for " + str(self.num_entries) + " entries\n")
+        log.flush()
+
+        # Print help if running in interactive mode
+        if not sys.argv[0]:
+            print("\nFurther commands:")
+            self.Help()
+
+    # Bucket of each canonical code, top bits of a hash
+    def _Buckets(self, codes):
+        if not self.bucket_bits:
+            return np.zeros(len(codes), dtype=np.int64)
+        return (HashCodes(codes, _BUCKET_SEED) >> np.uint64(64 - self.bucket_bits)).astype(np.int64)
+
+    # Build hash over k-mers in temporary files written by Populate, one file at a time
+    # num_records: number of records in all files, for size of Bloom filter
+    # Each level holds each bucket's bits in turn, and slots are numbered by level, then bucket,
+    # then bit, so a bucket's counts can be kept as soon as it is built
+    def _Build(self, filenames, name, num_records):
+        num_buckets = 1 << self.bucket_bits
+        # For each level, bits of each bucket and lists of bit words, counts and fingerprints of each bucket
+        level_bits = []
+        level_words = []
+        level_counts = []
+        level_fingerprints = []
+        leftover_keys = [np.zeros(0, dtype=np.uint64)]
+        leftover_counts = [np.zeros(0, dtype=self.count_dtype)]
+
+        for filename in filenames:
+            # Buckets of file in order
+            records = np.fromfile(filename, dtype=_RECORD)
+            os.remove(filename)
+            buckets = self._Buckets(Canonicals(records["code"], self.k))
+            order = np.argsort(buckets, kind="stable")
+            records = records[order]
+            bounds = np.searchsorted(buckets[order], np.arange(num_buckets + 1))
+            del buckets, order
+
+            for bucket in np.flatnonzero(np.diff(bounds)).tolist():
+                # K-mer and its reverse complement share a canonical code and bucket; combine their counts
+                bucket_records = records[bounds[bucket]:bounds[bucket + 1]]
+                keys, counts, num_collisions = CombineStrands(bucket_records["code"], bucket_records["count"], \
+                    self.k, self.conflict, name)
+                self.num_collisions += num_collisions
+                self.num_entries += len(keys)
+                self.num_saturated += int((counts > self.count_cap).sum())
+                counts = np.minimum(counts, self.count_cap).astype(self.count_dtype)
+                # K-mers missing from dump walk every level before their fingerprint rejects them,
+                # so a Bloom filter saves the most here
+                if self.bloom_bits:
+                    if self.bloom is None:
+                        self.bloom = KmerBloom(num_records, self.bloom_bits)
+                    self.bloom.Add(keys)
+
+                unplaced = np.ones(len(keys), dtype=bool)
+                for level, (num_bits, words, placed) in enumerate(self._BuildBucket(keys)):
+                    if level == len(level_bits):
+                        level_bits.append(np.zeros(num_buckets, dtype=np.int64))
+                        level_words.append([])
+                        level_counts.append([])
+                        level_fingerprints.append([])
+                    level_bits[level][bucket] = num_bits
+                    level_words[level].append(words)
+                    level_counts[level].append(counts[placed])
+                    level_fingerprints[level].append(self._Fingerprint(keys[placed]))
+                    unplaced[placed] = False
+                if unplaced.any():
+                    leftover_keys.append(keys[unplaced])
+                    leftover_counts.append(counts[unplaced])
+            del records
+
+        # Join buckets of each level, and count ranks across all levels
+        offset = 0
+        for level, bits in enumerate(level_bits):
+            bases = np.concatenate(([0], np.cumsum(bits)))
+            words = np.concatenate(level_words[level])
+            words = np.concatenate((words, np.zeros(-len(words) % _BLOCK_WORDS, dtype=np.uint64)))
+            level_words[level] = None
+            word_counts = _Popcount(words).reshape(-1, _BLOCK_WORDS)
+            block_counts = word_counts.sum(axis=1)
+            ranks = np.concatenate(([0], np.cumsum(block_counts)[:-1])).astype(np.uint64) + np.uint64(offset)
+            word_ranks = (np.cumsum(word_counts, axis=1) - word_counts).astype(np.uint16).ravel()
+            self.levels.append((level + 1, bases, words, ranks, word_ranks))
+            offset += int(block_counts.sum())
+
+        # Slot arrays, ordered by slot
+        self.counts = np.concatenate([np.zeros(0, dtype=self.count_dtype)] + \
+            [counts for counts_of_level in level_counts for counts in counts_of_level])
+        del level_counts
+        self.fingerprints = np.concatenate([np.zeros(0, dtype=self.fingerprint_dtype)] + \
+            [fingerprints for fingerprints_of_level in level_fingerprints for fingerprints in fingerprints_of_level])
+        del level_fingerprints
+
+        # K-mers no level could place (only if something went badly wrong)
+        self.leftover_keys = np.concatenate(leftover_keys)
+        order = np.argsort(self.leftover_keys)
+        self.leftover_keys = self.leftover_keys[order]
+        self.leftover_counts = np.concatenate(leftover_counts)[order]
+
+    # Build levels over unique canonical keys of one bucket
+    # Returns number of bits, bit words, and positions in keys of k-mers placed, in order of their bits,
+    # for each level until every k-mer is placed or there are _MAX_LEVELS
+    def _BuildBucket(self, keys):
+        remaining = np.arange(len(keys))
+        seed = 1
+        while len(remaining) and seed <= _MAX_LEVELS:
+            # Round number of bits up to whole words
+            num_bits = int(self.gamma * len(remaining)) + 1
+            num_bits = -(-num_bits // 64) * 64
+            positions = HashCodes(keys[remaining], seed) % np.uint64(num_bits)
+
+            # K-mers alone on their position are placed at this level
+            order = np.argsort(positions)
+            sorted_positions = positions[order]
+            same = sorted_positions[1:] == sorted_positions[:-1]
+            shared = np.zeros(len(order), dtype=bool)
+            shared[1:] |= same
+            shared[:-1] |= same
+
+            # Set their bits, one OR per word over the sorted unique positions
+            words = np.zeros(num_bits // 64, dtype=np.uint64)
+            set_positions = sorted_positions[~shared]
+            if len(set_positions):
+                word_index = (set_positions >> np.uint64(6)).astype(np.int64)
+                starts = np.flatnonzero(np.concatenate(([True], word_index[1:] != word_index[:-1])))
+                words[word_index[starts]] = np.bitwise_or.reduceat( \
+                    np.uint64(1) << (set_positions & np.uint64(63)), starts)
+            yield num_bits, words, remaining[order[~shared]]
+
+            remaining = remaining[order[shared]]
+            seed += 1
+
+    # Write arrays to binary index file for Load
+    def Save(self, filename, log=open("/dev/fd/1", 'w')):
+        time0 = process_time()
+        sys.stderr.write("\nWriting k-mer index to " + filename + "...\n")
+        bloom_words = self.bloom.words if self.bloom is not None else np.zeros(0, dtype=np.uint64)
+
+        # Write to temporary file and rename so a half-written index is never loaded
+        tmpname = filename + ".tmp"
+        with open(tmpname, 'wb') as out:
+            out.write(_HEADER.pack(MPH_INDEX_MAGIC, MPH_INDEX_VERSION, self.k, self.bucket_bits, len(self.levels), \
+                self.counts.dtype.itemsize, self.fingerprint_bits, _FLAG_BLOOM if self.bloom is not None else 0, \
+                self.bloom_bits if self.bloom is not None else 0, self.bloom.num_hashes if self.bloom is not None else 0, \
+                self.num_entries, len(self.counts), len(self.leftover_keys), len(bloom_words), self.count_cap))
+            out.write(b"\0" * (_HEADER_SIZE - _HEADER.size))
+            sections = [np.array([(seed, len(words)) for seed, bases, words, ranks, word_ranks in self.levels], \
+                dtype=np.uint64).reshape(-1, 2)]
+            for level in self.levels:
+                sections.extend(level[1:])
+            sections.extend((self.counts, self.fingerprints, self.leftover_keys, self.leftover_counts, bloom_words))
+            for section in sections:
+                section.astype(section.dtype.newbyteorder('<'), copy=False).tofile(out)
+                out.write(b"\0" * (-section.nbytes % 8))
+        os.replace(tmpname, filename)
+
+        proc_time = process_time() - time0
+        log.write("K-mer index with " + str(self.num_entries) + " entries written to " + filename + \
+            " at time " + ctime() + "\n")
+        log.write("Index write time: " + str(timedelta(seconds=proc_time)) + " (total seconds = " + str(proc_time) + ")\n")
+        log.flush()
+
+    # Memory-map binary index file written by Save
+    # Arrays are read-only views of the file, so nothing is read until it is queried
+    # The Bloom filter is used if bloom_bits was given and the index has one
+    def Load(self, filename, log=open("/dev/fd/1", 'w')):
+        assert self.num_entries == 0, "Load only works on an empty k-mer dictionary"
+        time0 = process_time()
+
+        with open(filename, 'rb') as f:
+            self.index_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, k, bucket_bits, num_levels, count_size, fingerprint_bits, flags, bloom_bits, num_hashes, \
+            num_entries, num_slots, num_leftover, num_bloom_words, count_cap = _HEADER.unpack_from(self.index_map, 0)
+        if magic != MPH_INDEX_MAGIC:
+            raise ValueError(filename + " is not a minimal perfect hash k-mer index file")
+        if version != MPH_INDEX_VERSION:
+            raise ValueError("K-mer index " + filename + " has version " + str(version) + \
+            " but this program reads version " + str(MPH_INDEX_VERSION) + ". Please rebuild it with BuildKmerIndex.py")
+
+        self.k = k
+        self.bucket_bits = bucket_bits
+        self.count_cap = count_cap
+        self.count_dtype = {1: np.uint8, 2: np.uint16, 4: np.uint32}[count_size]
+        self.fingerprint_bits = fingerprint_bits
+        self.fingerprint_dtype = np.uint8 if fingerprint_bits == 8 else np.uint16
+
+        position = [_HEADER_SIZE]
+        def Section(dtype, length):
+            dtype = np.dtype(dtype).newbyteorder('<')
+            section = np.frombuffer(self.index_map, dtype=dtype, count=length, offset=position[0])
+            position[0] += length * dtype.itemsize
+            position[0] += -position[0] % 8
+            return section
+
+        level_table = Section(np.uint64, 2 * num_levels).reshape(-1, 2).tolist()
+        for seed, num_words in level_table:
+            self.levels.append((seed, Section(np.int64, (1 << bucket_bits) + 1), Section(np.uint64, num_words), \
+                Section(np.uint64, num_words // _BLOCK_WORDS), Section(np.uint16, num_words)))
+        self.counts = Section(self.count_dtype, num_slots)
+        self.fingerprints = Section(self.fingerprint_dtype, num_slots)
+        self.leftover_keys = Section(np.uint64, num_leftover)
+        self.leftover_counts = Section(self.count_dtype, num_leftover)
+        bloom_words = Section(np.uint64, num_bloom_words)
+        self.num_entries = num_entries
+
+        # K-mers aren't in the index, so a Bloom filter can only come from it
+        if self.bloom_bits and flags & _FLAG_BLOOM:
+            self.bloom = KmerBloom(num_entries, bloom_bits, num_hashes, words=bloom_words)
+            self.bloom_bits = bloom_bits
+        elif self.bloom_bits:
+            sys.stderr.write("K-mer index " + filename + " has no Bloom filter; rebuild it with BuildKmerIndex.py " \
+                "--bloom-bits to use one\n")
+            self.bloom_bits = 0
+
+        proc_time = process_time() - time0
+        self.cur_size = self.Size()
+        sys.stderr.write(str(self.num_entries) + " kmers and counts mapped from index " + filename + "\n")
+        log.write("K-mer index " + filename + " memory-mapped at time " + ctime() + "\n")
+        log.write("Load time: " + str(timedelta(seconds=proc_time)) + " (total seconds = " + str(proc_time) + ")\n")
+        log.write("Hash has {} buckets, {} levels and {} leftover k-mers, {:.2f} bits per k-mer\n".format( \
+            1 << self.bucket_bits, len(self.levels), len(self.leftover_keys), \
+            8 * self._HashSize() / max(1, self.num_entries)))
+        if self.bloom is not None:
+            log.write("Bloom filter of {} bytes ({} bits per k-mer, {} hashes) mapped from index\n".format( \
+                self.bloom.Size(), self.bloom_bits, self.bloom.num_hashes))
+        log.write("Mapped size is " + str(self.cur_size) + " bytes for " + str(self.num_entries) + " entries\n")
+        log.flush()
+
+    # Slot of each set bit position in level: set bits before it in all levels
+    def _Rank(self, level, positions):
+        seed, bases, words, ranks, word_ranks = level
+        word_index = (positions >> np.uint64(6)).astype(np.int64)
+        below = (np.uint64(1) << (positions & np.uint64(63))) - np.uint64(1)
+        return ranks[word_index // _BLOCK_WORDS].astype(np.int64) + word_ranks[word_index] + \
+            _Popcount(words[word_index] & below)
+
+    # Fingerprint of each code, top bits of a second hash
+    def _Fingerprint(self, codes):
+        return (HashCodes(codes, _FINGERPRINT_SEED) >> np.uint64(64 - self.fingerprint_bits)).astype(self.fingerprint_dtype)
+
+    # Find counts for array of canonical codes at once
+    # Returns array of counts (0 if not found) and array of whether each was found
+    def _LookupMany(self, codes):
+        codes = np.asarray(codes, dtype=np.uint64)
+        slots = np.full(len(codes), -1, dtype=np.int64)
+        pending = np.arange(len(codes))
+
+        buckets = self._Buckets(codes)
+        for level in self.levels:
+            if not len(pending):
+                break
+            seed, bases, words, ranks, word_ranks = level
+            # Codes of buckets with no bits at this level are not in dictionary
+            starts = bases[buckets[pending]]
+            num_bits = bases[buckets[pending] + 1] - starts
+            has_bits = num_bits > 0
+            pending, starts, num_bits = pending[has_bits], starts[has_bits], num_bits[has_bits]
+            positions = starts.astype(np.uint64) + HashCodes(codes[pending], seed) % num_bits.astype(np.uint64)
+            set_bit = (words[(positions >> np.uint64(6)).astype(np.int64)] >> (positions & np.uint64(63))) & np.uint64(1)
+            hit = set_bit.astype(bool)
+            slots[pending[hit]] = self._Rank(level, positions[hit])
+            pending = pending[~hit]
+
+        # Every code lands on some slot; reject codes whose fingerprint doesn't match
+        found = slots >= 0
+        found[found] = self.fingerprints[slots[found]] == self._Fingerprint(codes[found])
+        counts = np.zeros(len(codes), dtype=np.uint64)
+        counts[found] = self.counts[slots[found]]
+
+        # Codes that fell through every level may be in side table
+        if len(self.leftover_keys) and len(pending):
+            leftover = IsIn(codes[pending], self.leftover_keys)
+            rows = np.searchsorted(self.leftover_keys, codes[pending][leftover])
+            found[pending[leftover]] = True
+            counts[pending[leftover]] = self.leftover_counts[rows]
+        return counts, found
+
+    # Find count for k-mer or its reverse complement in one lookup
+    # Raises KeyError if not found
+    def Query(self, seq, log=open("/dev/fd/1", 'w')):
+        try:
+            code = np.array([Encode(seq)], dtype=np.uint64)
+        except AttributeError:
+            sys.stderr.write("Please enter a DNA sequence in quotes\n")
+            raise KeyError
+        counts, found = self._LookupMany(Canonicals(code, len(seq)))
+        if not found[0]:
+            raise KeyError(seq)
+        return int(counts[0])
+
+    # Same as Query, since k-mers are stored by canonical code
+    def QueryFast(self, seq, log=open("/dev/fd/1", 'w')):
+        return self.Query(seq, log)
+
+    # Find count for every k-mer along sequence at once
+    # fast makes no difference, since each k-mer is one lookup either way
+    # Returns list of counts (0 if not found) and list of whether each was found
+    def QueryAlong(self, seq, fast=True, log=open("/dev/fd/1", 'w')):
+        if len(seq) < 256:
+            fcodes, rcodes = RollingCodes(seq, self.k)
+            valid = np.array([code is not None for code in fcodes], dtype=bool)
+            codes = np.array([min(f, r) if f is not None else 0 for f, r in zip(fcodes, rcodes)], dtype=np.uint64)
+        else:
+            codes, valid = EncodeAll(seq, self.k)
+            codes = np.minimum(codes, RCCodes(codes, self.k))
+
+        counts, found = self._QueryCanonicals(codes, valid)
+        return counts.tolist(), found.tolist()
+
+    # Find counts for batch of k-mers at once
+    # kmers is a NumPy array of 2-bit codes or a list of sequences of length k
+    # Returns NumPy array of counts (0 if not found) and array of whether each was found
+    def QueryMany(self, kmers, fast=True, log=open("/dev/fd/1", 'w')):
+        codes, valid = EncodeKmers(kmers, self.k)
+        return self._QueryCanonicals(Canonicals(codes, self.k), valid)
+
+    # Find counts for array of canonical codes
+    # Codes where valid is False are reported not found
+    def _QueryCanonicals(self, codes, valid):
+        # K-mers the Bloom filter rejects are not looked up at all
+        if self.bloom is not None and len(codes) >= MIN_KMERS:
+            valid = valid & self.bloom.MightContain(codes)
+            counts = np.zeros(len(codes), dtype=np.uint64)
+            found = np.zeros(len(codes), dtype=bool)
+            where = np.flatnonzero(valid)
+            counts[where], found[where] = self._LookupMany(codes[where])
+        else:
+            counts, found = self._LookupMany(codes)
+        found &= valid
+        counts[~found] = 0
+        return counts, found
+
+    # Size of hash levels and rank tables in bytes
+    def _HashSize(self):
+        return sum(bases.nbytes + words.nbytes + ranks.nbytes + word_ranks.nbytes \
+            for seed, bases, words, ranks, word_ranks in self.levels)
+
+    # Size of arrays in bytes
+    def Size(self):
+        return self._HashSize() + self.counts.nbytes + self.fingerprints.nbytes + \
+            self.leftover_keys.nbytes + self.leftover_counts.nbytes + \
+            (self.bloom.Size() if self.bloom is not None else 0)
+
+    def PrintAll(self):
+        sys.stderr.write("MphKmerDict doesn't store k-mers, only their counts\n")
+        return {}
+    def NumEntries(self):
+        return self.num_entries
+
+    def Help(self):
+        print("# Output number of entries in dictionary")
+        print("NumEntries()")
+        print("# Output size of dictionary in bytes")
+        print("Size()")
+        print("# Query count for a particular sequence")
+        print("Query(sequence)")
+        print("# Query counts for every k-mer along a longer sequence")
+        print("QueryAlong(sequence)")
+        print("# Query counts for a list of k-mers or array of 2-bit codes at once")
+        print("QueryMany(kmers)")
+        print("# Write hash to index file for Load")
+        print("Save(filename)")
+        print("# Release arrays from memory")
+        print("Close()")
+        print("# Display this help menu")
+        print("Help()")
+
+# Demo
+if __name__ == '__main__':
+    mkd = MphKmerDict()
+    mkd.Populate("fakedump.fa")
+    print("Size =", mkd.Size())
+    print(mkd.Query("AAAAAAAAAAAAAAAAA"))
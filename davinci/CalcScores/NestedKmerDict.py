@@ -4,8 +4,16 @@
 
 """
 Nested k-mer dictionary class which holds 17-mers in 3 levels.
-Reads 17-mers from a Jellyfish dump file.
+Reads 17-mers from a Jellyfish dump file (fasta or column format, see JellyfishDump.py).
 Multiple Jellyfish dump files can be read into same dictionary object.
+
+With canonical=True, each 17-mer is stored as the smaller of itself and its
+reverse complement, and counts of both are combined once at load time by the
+conflict policy ("max", "sum", or "error"; see PackedKmerDict.py).
+Query and QueryFast are then the same single lookup.
+
+With bloom_bits, a Bloom filter over the 17-mers (see KmerBloom.py) lets
+QueryAlong skip the dictionary for 17-mers that are certainly missing.
 """
 
 import sys
@@ -16,9 +24,37 @@ try:
 except:
     from time import clock as process_time #python2
 from datetime import timedelta
+try:
+    import numpy as np
+except ImportError:
+    exit("numpy not installed")
+from KmerEncoding import Canonicals, RCCodes, IsIn, DecodeRows, EncodeAll, EncodeMany, EncodeKmers, \
+    CombineStrands, CONFLICT_POLICIES
+from JellyfishDump import DumpReader
+from KmerBloom import KmerBloom, MIN_KMERS
+
+# Translation tables for reverse complement
+_COMPLEMENT = str.maketrans("ACGT", "TGCA")
+_DELETE_BASES = str.maketrans("", "", "ACGT")
+
+# Stands in for a missing level in lookups that return None instead of raising
+_EMPTY = {}
 
 class NestedKmerDict():
-    def __init__(self, source=None):
+    def __init__(self, source=None, canonical=False, conflict="max", bloom_bits=0):
+        # Nested levels are 6, 6, and 5 letters long
+        self.k = 17
+
+        # Whether 17-mers are stored canonical, and how counts of both strands are combined
+        assert conflict in CONFLICT_POLICIES, "conflict must be one of " + ", ".join(CONFLICT_POLICIES)
+        self.canonical = canonical
+        self.conflict = conflict
+        self.num_collisions = 0
+
+        # Optional Bloom filter over canonical 17-mers, rebuilt after each dump
+        self.bloom_bits = bloom_bits
+        self.bloom = None
+
         # Empty counts dictionary
         self.counts = {"": {"": {"": 0}}}
 
@@ -29,114 +65,43 @@ class NestedKmerDict():
         # Whether duplicates found (for logging)
         self.dup_found = False
 
-        # Percent cleared (for status messages in clear)
-        self.percent_emptied = 0
-
         # Deluxe constructor: Can populate at same time
         if source is not None:
             self.Populate(source)
 
+    # Release dictionary when object goes away
     def __del__(self):
-        sys.stderr.write("\nNkd destructor says: Unloading nested k-mer dictionary from memory\n")
-
-        self.Clear()
-
-        try:
-            sys.stderr.write("Nkd destructor says: Current size: {} bytes\n".format(str(self.Size())))
-        except:
-            pass
-
-        try:
-            gc.collect()
-        except:
-            pass
-
-        try:
-            del self.counts
-            sys.stderr.write("Nkd destructor says: Deleted counts dictionary\n")
-        except:
-            sys.stderr.write("Nkd destructor says: Could not delete counts dictionary\n")
-
-        try:
-            gc.collect()
-        except:
-            pass
-
-        sys.stderr.write("Nkd destructor says: Nested kmer dict removed from memory\n")
-
-    # Recursively empty dictionary and print helpful status messages
-    def Clear(self, verbose=False):
-        sys.stderr.write("\nNkd clear says: Starting to clear nested k-mer dictionary from memory.\t{}\n".format(ctime()))
-        sys.stderr.write("Nkd clear says: This process may take 8+ hours. You should see progress updates here.\n")
-        sys.stderr.write("\nNkd clear says: Your task manager may not show this program's memory usage lowering but that is ok.\n")
-        sys.stderr.write("Nkd clear says: To avoid damage to your system's memory, please do not force quit this program unless there are no progress updates for a day.\n")
-        sys.stderr.write("\nNkd clear says: Let me calculate how much garbage I have to collect\n")
-        sys.stderr.write("Nkd clear says: I have {} entries and {} bytes of memory to clear...\n".format(self.num_entries, str(self.Size())))
-
-        self._Clear(self.counts, self.num_entries)
-
-        sys.stderr.write("Nkd clear says: My work here is done.\t{}\n".format(ctime()))
-
-
-    def _Clear(self, obj, orig_num_entries, level=1, verbose=False, hella_verbose=False, debug_percent=False):
-        # Debug status counter
-        if debug_percent:
-            print("\nNum entries: ", self.num_entries)
-            print("percent complete: ", str((1 - self.num_entries / orig_num_entries) * 100))
-            print("Current % counter: " + str(self.percent_emptied))
-
-        # Status counter
-        if ((1 - self.num_entries / orig_num_entries) * 100 > self.percent_emptied):
-            sys.stderr.write("Memory clearing {}% complete\t\t {}\n".format(\
-            str(self.percent_emptied), ctime()))
-
-            if self.percent_emptied == 90:
-                sys.stderr.write("You may see a slowdown here, that is expected\n")
-            if self.percent_emptied == 99:
-                sys.stderr.write("You may see even more of a slowdown here, that is expected\n")
-
-            # Add smaller increments nearing 100%
-            if self.percent_emptied < 90:
-                self.percent_emptied += 10
-            elif self.percent_emptied < 99:
-                self.percent_emptied += 1
-            else:
-                self.percent_emptied = round(self.percent_emptied + 0.1, 1)
-
-
-
-        # When terminal key found, decrement num_entries and return
-        if not isinstance(obj, dict):
-            if verbose:
-                sys.stderr.write("Terminal item found:" + str(obj) + "\n")
-            self.num_entries -= 1
-            return
-
-        # If current object is a dictionary, recur on all items
-        # After all nested items have returned, clear this level and return
-        if verbose:
-            print("Nested dict found:")
-            if hella_verbose:
-                print(obj)
-
-        for item in obj:
-            if verbose:
-                sys.stderr.write("Recursing on {}\n".format(item))
-            self._Clear(obj[item], orig_num_entries, level + 1, verbose, hella_verbose)
-
-        # Clear + delete all inner objects
-        obj.clear()
-        del obj
-        gc.collect()
-
-        # Verify empty before return
-        if level == 1:
-            sys.stderr.write("Nkd clear says: Done clearing dictionary.\n")
+        self.Close()
+
+    # Use in with statement to release dictionary at end of block
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.Close()
+
+    # Release whole dictionary at once.
+    # Entries hold no reference cycles, so dropping the top level frees them
+    # all by reference counting, with no garbage collector passes over them.
+    def Close(self):
+        if getattr(self, "num_entries", 0):
+            sys.stderr.write("\nNkd says: Releasing {} entries from memory\t{}\n".format(self.num_entries, ctime()))
+        self.counts = {}
+        self.bloom = None
+        self.num_entries = 0
+        self.cur_size = 0
 
+    # Same as Close, for contextlib.closing and habits from file objects
+    close = Close
+    # Old name from when emptying the dictionary took hours
+    Clear = Close
 
     # Read 17-mers from Jellyfish dump file
     # Accepts string of filename or file object
-    def Populate(self, source, log=open("/dev/fd/1", 'w')):
+    # keep is an optional sorted NumPy array of canonical codes (see CollectKmers
+    # in CalcKmerScores.py); if given, only k-mers in it or whose reverse
+    # complement is in it are stored and the rest of the dump is skipped
+    def Populate(self, source, log=open("/dev/fd/1", 'w'), keep=None):
         time0 = process_time()
 
         # If string of filename passed, reassign variable to be file object
@@ -150,67 +115,64 @@ class NestedKmerDict():
         sys.stderr.write("\nReading kmer counts from file " + source.name + "...\n")
         sys.stderr.write("Logging to " + log.name + "\n")
         log.write("Kmer loading from " + source.name + " began at time " + ctime() + "\n")
+        if keep is not None:
+            log.write("Keeping only k-mers from set of " + str(len(keep)) + " canonical k-mers\n")
         log.flush()
-        line = source.readline()
-
-        while line:
-            # Error message for unreadable input
-            assert line[0] == ">", \
-            "\nUnable to read k-mers and scores due to unexpected input. " + \
-            "Line was:\n" + line.rstrip('\n') + "\nfrom " + source.name
-
-            # Read count and associated sequence
-            count = line[1:].rstrip('\n')
-
-            line = source.readline()
-            seq = line.rstrip('\n')
-
-            level1 = seq[0:6]
-            level2 = seq[6:12]
-            level3 = seq[12:17]
-
-            # Insert entry
-
-            # If there no entry for level1
-            if not level1 in self.counts:
-                self.counts[level1] = {level2: {level3: count}}
-
-            # If there is an entry for level1 but not level2
-            elif not level2 in self.counts[level1]:
-                self.counts[level1][level2] = {level3: count}
-
-            # If there is an entry for level1 and level2
-            elif not level3 in self.counts[level1][level2]:
-                self.counts[level1][level2][level3] = count
-
-            # If entry already exists, raise error (should be no duplicates in file)
+        # Garbage collector can't free any entries, so don't let it scan
+        # the growing dictionary over and over while loading
+        gc_was_enabled = gc.isenabled()
+        gc.disable()
+
+        # Parse dump a block at a time, then insert entries one by one
+        # Canonical k-mers are collected first, since a k-mer and its
+        # reverse complement can be anywhere in the dump
+        reader = DumpReader(source, self.k)
+        key_batches = [np.zeros(0, dtype=np.uint64)]
+        count_batches = [np.zeros(0, dtype=np.uint64)]
+        for codes, counts, seqs in reader:
+            if keep is not None:
+                kept = IsIn(Canonicals(codes, self.k), keep)
+                codes, counts, seqs = codes[kept], counts[kept], seqs[kept]
+            if self.canonical:
+                key_batches.append(codes)
+                count_batches.append(counts)
             else:
-                raise AssertionError("Duplicate entry found for sequence " \
-                + seq + " in " + source.name)
-
-            self.num_entries += 1
-
-            # Watch size grow
-            # if cur_size != sizeofdict(counts):
-            #     cur_size = sizeofdict(counts)
-            #     print("Number of entries =", num_entries, \
-            #     "\ttop level size =", sys.getsizeof(counts), \
-            #     "\ttotal size =", cur_size)
-
-            line = source.readline()
+                self._InsertMany(seqs, counts, source.name)
+        num_read = reader.num_records
+
+        if self.canonical:
+            keys, counts, num_collisions = CombineStrands(np.concatenate(key_batches), \
+                np.concatenate(count_batches), self.k, self.conflict, source.name)
+            del key_batches, count_batches
+            self.num_collisions += num_collisions
+            block = 1 << 20
+            for start in range(0, len(keys), block):
+                self._InsertMany(DecodeRows(keys[start:start + block], self.k), \
+                    counts[start:start + block], source.name)
+            del keys, counts
 
         # Close source file and remove dummy entry if necessary
         source.close()
         self.counts.pop("") if "" in self.counts else None
+        if gc_was_enabled:
+            gc.enable()
+        self._BuildBloom(log)
 
         # Output size of dictionary
         proc_time = process_time() - time0
-        sys.stderr.write(str(self.num_entries) + " kmers and counts read from file " + source.name + "\n")
+        sys.stderr.write(str(num_read) + " kmers and counts read from file " + source.name + "\n")
+        if keep is not None:
+            sys.stderr.write(str(self.num_entries) + " kmers kept\n")
+            log.write(str(self.num_entries) + " of " + str(num_read) + " kmers kept from " + source.name + "\n")
         sys.stderr.write("Calculating memory size...\n")
         self.cur_size = self.Size()
         sys.stderr.write("Memory size is " + str(self.cur_size) + " bytes.\n")
         log.write("Kmer loading from " + source.name + " completed at time " + ctime() + "\n")
         log.write("Load time: " + str(timedelta(seconds=proc_time)) + " (total seconds = " + str(proc_time) + ")\n")
+        log.write("Load rate: " + reader.Rates(proc_time) + " (" + reader.format + " format)\n")
+        if self.canonical:
+            log.write("{} k-mers found with reverse complement, counts combined by {}\n".format( \
+                self.num_collisions, self.conflict))
         log.write("Total size in memory is " + str(self.cur_size) + " bytes for " + str(self.num_entries) + " entries\n")
         log.flush()
 
@@ -219,61 +181,197 @@ class NestedKmerDict():
             print("\nFurther commands:")
             self.Help()
 
+    # Insert one entry into nested levels
+    def _Insert(self, seq, count, name):
+        level1 = seq[0:6]
+        level2 = seq[6:12]
+        level3 = seq[12:17]
+
+        # If there no entry for level1
+        if not level1 in self.counts:
+            self.counts[level1] = {level2: {level3: count}}
+
+        # If there is an entry for level1 but not level2
+        elif not level2 in self.counts[level1]:
+            self.counts[level1][level2] = {level3: count}
+
+        # If there is an entry for level1 and level2
+        elif not level3 in self.counts[level1][level2]:
+            self.counts[level1][level2][level3] = count
+
+        # Canonical 17-mer from an earlier dump is combined by conflict policy
+        elif self.canonical and self.conflict != "error":
+            old = int(self.counts[level1][level2][level3])
+            combined = old + int(count) if self.conflict == "sum" else max(old, int(count))
+            self.counts[level1][level2][level3] = str(combined)
+            self.num_collisions += 1
+            return
+
+        # If entry already exists, raise error (should be no duplicates in file)
+        else:
+            raise AssertionError("Duplicate entry found for sequence " \
+            + seq + " in " + name)
+
+        self.num_entries += 1
+
+    # Insert block of entries from DumpReader
+    # Counts are kept as strings, same as they were read from dump
+    def _InsertMany(self, seqs, counts, name):
+        k = self.k
+        text = seqs.tobytes().decode()
+        for i, count in enumerate(map(str, counts.tolist())):
+            self._Insert(text[i * k:i * k + k], count, name)
+
     # Converts sequence to reverse complement
     def RC(self, seq):
-        rc = ""
         # syntax [::-1] reverses string
-        for letter in seq[::-1]:
-            if letter == 'A':
-                rc += 'T'
-            elif letter == 'C':
-                rc += 'G'
-            elif letter == 'G':
-                rc += 'C'
-            elif letter == 'T':
-                rc += 'A'
-            else:
-                raise ValueError("Function RC only accepts A, C, G, and T")
+        rc = seq[::-1].translate(_COMPLEMENT)
+        # Anything left after deleting bases was not A, C, G, or T
+        if rc.translate(_DELETE_BASES):
+            raise ValueError("Function RC only accepts A, C, G, and T")
         return rc
 
+    # Count stored for exactly seq, or None if not in dictionary
+    def _Get(self, seq):
+        return self.counts.get(seq[0:6], _EMPTY).get(seq[6:12], _EMPTY).get(seq[12:17])
+
+    # Same as Query (or QueryFast if fast=True), but returns None instead of raising KeyError
+    # Reverse complement isn't checked for bad bases, since a k-mer
+    # with anything but A, C, G, and T is never in the dictionary anyway
+    def _Find(self, seq, fast, log):
+        if self.canonical:
+            return self._Get(min(seq, seq[::-1].translate(_COMPLEMENT)))
+        fcount = self._Get(seq)
+        if fast and fcount is not None:
+            return fcount
+        rc = seq[::-1].translate(_COMPLEMENT)
+        rcount = self._Get(rc)
+        if fcount is None or rcount is None:
+            return rcount if fcount is None else fcount
+        log.write("Both " + seq + " and reverse complement " + rc + " found in dictionary\n")
+        # Counts are strings, so compare them as numbers
+        return max(fcount, rcount, key=int)
+
     # Find count for k-mer or its reverse complement
     # Always checks both forward and reverse and logs if both are found
     def Query(self, seq, log=open("/dev/fd/1", 'w')):
-        matches = 0
-        try:
-            fcount = self.counts[seq[0:6]][seq[6:12]][seq[12:17]]
-            matches += 1
-        except KeyError:
-            fcount = 0
-        try:
-            rc = self.RC(seq)
-            rcount = self.counts[rc[0:6]][rc[6:12]][rc[12:17]]
-            matches += 1
-        except KeyError:
-            rcount = 0
-        except TypeError:
+        if not isinstance(seq, str):
             sys.stderr.write("Please enter a DNA sequence in quotes\n")
-
-        if matches == 1:
-            return fcount or rcount
-        elif matches == 2:
-            log.write("Both " + seq + " and reverse complement " + rc + " found in dictionary\n")
-            return max(fcount, rcount)
-        else:
             raise KeyError
+        count = self._Find(seq, False, log)
+        if count is None:
+            raise KeyError(seq)
+        return count
 
     # Find count for k-mer or its reverse complement
     # Only checks for reverse complement if forward not found
     def QueryFast(self, seq, log=open("/dev/fd/1", 'w')):
-        try:
-            return self.counts[seq[0:6]][seq[6:12]][seq[12:17]]
-        except KeyError:
-            rc = self.RC(seq)
-            return self.counts[rc[0:6]][rc[6:12]][rc[12:17]]
-
+        count = self._Find(seq, True, log)
+        if count is None:
+            raise KeyError(seq)
+        return count
+
+    # Find count for every 17-mer along sequence,
+    # same as QueryFast (or Query if fast=False) on each one
+    # K-mers the Bloom filter rejects are not looked up at all
+    # Returns list of counts (0 if not found) and list of whether each was found
+    def QueryAlong(self, seq, fast=True, log=open("/dev/fd/1", 'w')):
+        k = self.k
+        num_kmers = len(seq) - k + 1
+        maybe = None
+        if self.bloom is not None and num_kmers >= MIN_KMERS:
+            codes, valid = EncodeAll(seq, k)
+            maybe = (valid & self.bloom.MightContain(Canonicals(codes, k))).tolist()
+
+        counts = []
+        found = []
+        for i in range(num_kmers):
+            count = None
+            if maybe is None or maybe[i]:
+                count = self._Find(seq[i:i+k], fast, log)
+            if count is None:
+                counts.append(0)
+                found.append(False)
+            else:
+                counts.append(int(count))
+                found.append(True)
+        return counts, found
+
+    # Find counts for batch of 17-mers at once,
+    # same as QueryFast (or Query if fast=False) on each one
+    # kmers is a NumPy array of 2-bit codes or a list of sequences of length 17
+    # Forward and reverse complement sequences are decoded from codes all at once,
+    # then looked up in list comprehensions
+    # Returns NumPy array of counts (0 if not found) and array of whether each was found
+    def QueryMany(self, kmers, fast=True, log=open("/dev/fd/1", 'w')):
+        k = self.k
+        codes, valid = EncodeKmers(kmers, k)
+
+        # K-mers the Bloom filter rejects, or with anything but A, C, G, and T, are not looked up
+        if self.bloom is not None and len(codes) >= MIN_KMERS:
+            valid &= self.bloom.MightContain(Canonicals(codes, k))
+        where = np.flatnonzero(valid)
+        codes = codes[where]
+
+        # Same lookups as _Get, written out to save a function call per 17-mer
+        d = self.counts
+        if self.canonical:
+            seqs = self._DecodeAll(Canonicals(codes, k))
+            fcounts = [d.get(s[0:6], _EMPTY).get(s[6:12], _EMPTY).get(s[12:17]) for s in seqs]
+        elif fast:
+            fseqs = self._DecodeAll(codes)
+            fcounts = [d.get(s[0:6], _EMPTY).get(s[6:12], _EMPTY).get(s[12:17]) for s in fseqs]
+            # Reverse complements only of 17-mers not found forward
+            misses = [i for i, count in enumerate(fcounts) if count is None]
+            rseqs = self._DecodeAll(RCCodes(codes[misses], k))
+            for i, s in zip(misses, rseqs):
+                fcounts[i] = d.get(s[0:6], _EMPTY).get(s[6:12], _EMPTY).get(s[12:17])
+        else:
+            fseqs = self._DecodeAll(codes)
+            rseqs = self._DecodeAll(RCCodes(codes, k))
+            fcounts = [d.get(s[0:6], _EMPTY).get(s[6:12], _EMPTY).get(s[12:17]) for s in fseqs]
+            rcounts = [d.get(s[0:6], _EMPTY).get(s[6:12], _EMPTY).get(s[12:17]) for s in rseqs]
+            for i, (fcount, rcount) in enumerate(zip(fcounts, rcounts)):
+                if fcount is None:
+                    fcounts[i] = rcount
+                elif rcount is not None:
+                    log.write("Both " + fseqs[i] + " and reverse complement " + rseqs[i] + " found in dictionary\n")
+                    fcounts[i] = max(fcount, rcount, key=int)
+
+        counts = np.zeros(len(valid), dtype=np.uint64)
+        found = np.zeros(len(valid), dtype=bool)
+        found[where] = [count is not None for count in fcounts]
+        counts[where] = [int(count) if count is not None else 0 for count in fcounts]
+        return counts, found
+
+    # List of sequences of array of codes
+    def _DecodeAll(self, codes):
+        k = self.k
+        text = DecodeRows(codes, k).tobytes().decode()
+        return [text[i:i + k] for i in range(0, len(text), k)]
+
+    # Build Bloom filter over canonical codes of all entries if bloom_bits was given
+    def _BuildBloom(self, log):
+        if not self.bloom_bits:
+            return
+        time0 = process_time()
+        self.bloom = KmerBloom(self.num_entries, self.bloom_bits)
+        seqs = []
+        for level1, d1 in self.counts.items():
+            for level2, d2 in d1.items():
+                for level3 in d2:
+                    seqs.append(level1 + level2 + level3)
+                    if len(seqs) == 1 << 20:
+                        self.bloom.Add(Canonicals(EncodeMany(seqs, self.k)[0], self.k))
+                        seqs = []
+        self.bloom.Add(Canonicals(EncodeMany(seqs, self.k)[0], self.k))
+        proc_time = process_time() - time0
+        log.write("Bloom filter of {} bytes ({} bits per k-mer, {} hashes) built in {:.2f} seconds\n".format( \
+            self.bloom.Size(), self.bloom_bits, self.bloom.num_hashes, proc_time))
 
     def Size(self, sum=0, verbose=False):
-        return self._Size(self.counts, sum, verbose)
+        bloom_size = self.bloom.Size() if self.bloom is not None else 0
+        return self._Size(self.counts, sum, verbose) + bloom_size
 
     def _Size(self, d, sum=0, verbose=False):
         # Execute this block for innermost values only
@@ -310,6 +408,12 @@ class NestedKmerDict():
         print("Size()")
         print("# Query count for a particular sequence")
         print("Query(sequence)")
+        print("# Query counts for every 17-mer along a longer sequence")
+        print("QueryAlong(sequence)")
+        print("# Query counts for a list of 17-mers or array of 2-bit codes at once")
+        print("QueryMany(kmers)")
+        print("# Release dictionary from memory")
+        print("Close()")
         print("# Display this help menu")
         print("Help()")
 
@@ -0,0 +1,524 @@
+# 17 October 2026
+# Lisa Malins
+# PackedKmerDict.py
+
+"""
+Packed k-mer dictionary class which holds k-mers as sorted 2-bit codes in NumPy arrays.
+Reads k-mers from a Jellyfish dump file (fasta or column format, see
+JellyfishDump.py), same as NestedKmerDict, and answers
+the same Query/QueryFast calls, but uses about 10 bytes per k-mer instead of hundreds.
+
+Layout:
+keys      sorted uint64 2-bit codes, one per k-mer
+counts    parallel uint16 (or uint32) counts
+overflow  sorted side table of (key, count) for counts too big for the counts array
+offsets   bucket index over the top bits of each key, so a lookup only
+          searches the handful of keys that share its prefix
+
+Multiple Jellyfish dump files can be read into same dictionary object.
+
+With canonical=True, each k-mer is stored under its canonical code (the
+smaller of its code and its reverse complement's). If a dump has both, their
+counts are combined once at load time by the conflict policy: "max" (same
+as exact mode of Query), "sum", or "error". Query and QueryFast are then
+the same single lookup. A k-mer already loaded from an earlier dump is
+combined the same way.
+
+With bloom_bits, a Bloom filter of that many bits per k-mer (see KmerBloom.py)
+is built after loading, and QueryAlong only searches the keys for k-mers
+that pass it. Scores are the same, but k-mers missing from the dump cost
+one word read instead of a search.
+
+The arrays can be saved to a binary index file with Save(), which
+BuildKmerIndex.py does once per dump. Load() opens an index file with mmap
+so it is ready to query almost instantly, and several processes that load
+the same index share one copy in the OS page cache. A Bloom filter built
+before Save is saved too, and Load maps it instead of hashing every key again.
+"""
+
+import sys
+import os
+import mmap
+import struct
+from time import ctime
+try:
+    from time import process_time
+except:
+    from time import clock as process_time #python2
+from datetime import timedelta
+from bisect import bisect_left
+try:
+    import numpy as np
+except ImportError:
+    exit("numpy not installed")
+from KmerEncoding import Encode, Decode, RCCode, RCCodes, EncodeAll, EncodeKmers, RollingCodes, Canonicals, IsIn, \
+    CombineStrands, CombineRuns, CONFLICT_POLICIES
+from JellyfishDump import DumpReader
+from KmerBloom import KmerBloom, MIN_KMERS
+
+# Index file format
+# Header is magic, version, k, bucket bits, bytes per count, number of entries,
+# number of overflow entries, flags, Bloom filter bits per k-mer and hashes,
+# number of Bloom filter words, padded to 64 bytes.
+# Flags are 1 if keys are canonical and 2 if there is a Bloom filter;
+# older indexes have 0 from the padding.
+# Then offsets, keys, counts, overflow keys, overflow counts, and Bloom filter
+# words if there are any, each starting on an 8-byte boundary.
+# All numbers are little-endian.
+INDEX_MAGIC = b"DAVKIDX\0"
+INDEX_VERSION = 1
+_HEADER = struct.Struct("<8sIIIIQQIIIQ")
+_FLAG_CANONICAL = 1
+_FLAG_BLOOM = 2
+_HEADER_SIZE = 64
+
+# Returns True if file is a k-mer index written by PackedKmerDict.Save
+def IsIndex(filename):
+    with open(filename, 'rb') as f:
+        return f.read(len(INDEX_MAGIC)) == INDEX_MAGIC
+
+class PackedKmerDict():
+    def __init__(self, source=None, k=17, bucket_bits=None, count_dtype=np.uint16, canonical=False, conflict="max", \
+    bloom_bits=0):
+        self.k = k
+
+        # Whether keys are canonical codes, and how counts of both strands are combined
+        assert conflict in CONFLICT_POLICIES, "conflict must be one of " + ", ".join(CONFLICT_POLICIES)
+        self.canonical = canonical
+        self.conflict = conflict
+
+        # Sorted keys and parallel counts
+        self.keys = np.zeros(0, dtype=np.uint64)
+        self.counts = np.zeros(0, dtype=count_dtype)
+        # Counts at or above this value live in the overflow side table
+        self.count_max = int(np.iinfo(count_dtype).max)
+        self.overflow_keys = np.zeros(0, dtype=np.uint64)
+        self.overflow_counts = np.zeros(0, dtype=np.uint64)
+
+        # Optional Bloom filter over canonical keys, rebuilt whenever keys change
+        self.bloom_bits = bloom_bits
+        self.bloom = None
+
+        # Bucket index (chosen from number of entries unless specified)
+        self.fixed_bucket_bits = bucket_bits
+        self._Index()
+
+        # Size info
+        self.num_entries = 0
+        self.num_collisions = 0
+        self.cur_size = 0
+
+        # Deluxe constructor: Can populate at same time
+        if source is not None:
+            self.Populate(source)
+
+    # Use in with statement to release arrays at end of block
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.Close()
+
+    # Release arrays, and unmap index file if opened with Load
+    # Arrays are a few large blocks, so they are freed at once
+    def Close(self):
+        index_map = getattr(self, "index_map", None)
+        self.__init__(k=self.k, count_dtype=self.counts.dtype.newbyteorder('='), \
+            canonical=self.canonical, conflict=self.conflict, bloom_bits=self.bloom_bits)
+        if index_map is not None:
+            try:
+                index_map.close()
+            except BufferError:
+                # Someone still holds a view of the index; it is unmapped when they let go
+                pass
+            self.index_map = None
+
+    # Same as Close, for contextlib.closing and habits from file objects
+    close = Close
+
+    # Build bucket offset index over the top bits of the keys
+    # offsets[b] is the position of the first key whose top bits are b
+    def _Index(self):
+        if self.fixed_bucket_bits is not None:
+            self.bucket_bits = self.fixed_bucket_bits
+        else:
+            # Aim for roughly 8-16 keys per bucket
+            self.bucket_bits = min(24, 2 * self.k, max(0, len(self.keys).bit_length() - 4))
+        self.shift = 2 * self.k - self.bucket_bits
+        buckets = np.arange(2 ** self.bucket_bits + 1, dtype=np.uint64) << np.uint64(self.shift)
+        self.offsets = np.searchsorted(self.keys, buckets).astype(np.int64)
+        # Last offset is one past the end, even if top bucket is full
+        self.offsets[-1] = len(self.keys)
+
+    # Read k-mers from Jellyfish dump file
+    # Accepts string of filename or file object
+    # keep is an optional sorted NumPy array of canonical codes (see CollectKmers
+    # in CalcKmerScores.py); if given, only k-mers in it or whose reverse
+    # complement is in it are stored and the rest of the dump is skipped
+    def Populate(self, source, log=open("/dev/fd/1", 'w'), keep=None):
+        time0 = process_time()
+
+        # If string of filename passed, reassign variable to be file object
+        if isinstance(source, str):
+            try:
+                source = open(source, 'r')
+            except FileNotFoundError:
+                exit("File " + source + " not found")
+
+        # Read all k-mers and counts into compact arrays
+        sys.stderr.write("\nReading kmer counts from file " + source.name + "...\n")
+        sys.stderr.write("Logging to " + log.name + "\n")
+        log.write("Kmer loading from " + source.name + " began at time " + ctime() + "\n")
+        if keep is not None:
+            log.write("Keeping only k-mers from set of " + str(len(keep)) + " canonical k-mers\n")
+        log.flush()
+        key_batches = [np.zeros(0, dtype=np.uint64)]
+        count_batches = [np.zeros(0, dtype=np.uint64)]
+
+        # Parse dump a block at a time
+        reader = DumpReader(source, self.k)
+        for codes, counts, seqs in reader:
+            if keep is not None:
+                kept = IsIn(Canonicals(codes, self.k), keep)
+                codes, counts = codes[kept], counts[kept]
+            key_batches.append(codes)
+            count_batches.append(counts)
+        num_read = reader.num_records
+
+        source.close()
+        new_keys = np.concatenate(key_batches)
+        new_counts = np.concatenate(count_batches)
+        del key_batches, count_batches
+        if self.canonical:
+            new_keys, new_counts, num_collisions = CombineStrands(new_keys, new_counts, self.k, self.conflict, source.name)
+            self.num_collisions += num_collisions
+        self._Merge(new_keys, new_counts, source.name)
+        self.BuildBloom(log)
+
+        # Output size of dictionary
+        proc_time = process_time() - time0
+        sys.stderr.write(str(num_read) + " kmers and counts read from file " + source.name + "\n")
+        if keep is not None:
+            sys.stderr.write(str(len(new_keys)) + " kmers kept\n")
+            log.write(str(len(new_keys)) + " of " + str(num_read) + " kmers kept from " + source.name + "\n")
+        self.cur_size = self.Size()
+        sys.stderr.write("Memory size is " + str(self.cur_size) + " bytes.\n")
+        log.write("Kmer loading from " + source.name + " completed at time " + ctime() + "\n")
+        log.write("Load time: " + str(timedelta(seconds=proc_time)) + " (total seconds = " + str(proc_time) + ")\n")
+        log.write("Load rate: " + reader.Rates(proc_time) + " (" + reader.format + " format)\n")
+        if self.canonical:
+            log.write("{} k-mers found with reverse complement, counts combined by {}\n".format( \
+                self.num_collisions, self.conflict))
+        log.write("Total size in memory is " + str(self.cur_size) + " bytes for " + str(self.num_entries) + " entries\n")
+        log.flush()
+
+        # Print help if running in interactive mode
+        if not sys.argv[0]:
+            print("\nFurther commands:")
+            self.Help()
+
+    # Sort new entries and merge them with any already loaded
+    # Raises AssertionError on duplicates, same as NestedKmerDict,
+    # unless keys are canonical and conflict policy says how to combine them
+    def _Merge(self, new_keys, new_counts, name):
+        all_counts = np.concatenate((self._FullCounts(), new_counts))
+        all_keys = np.concatenate((self.keys, new_keys))
+        order = np.argsort(all_keys, kind="stable")
+        all_keys = all_keys[order]
+        all_counts = all_counts[order]
+
+        dups = np.flatnonzero(all_keys[1:] == all_keys[:-1])
+        if len(dups) and self.canonical and self.conflict != "error":
+            # Canonical k-mers from an earlier dump are combined with new ones by conflict policy
+            all_keys, all_counts, num_collisions = CombineRuns(all_keys, all_counts, self.conflict)
+            self.num_collisions += num_collisions
+        elif len(dups):
+            # If entry already exists, raise error (should be no duplicates in file)
+            raise AssertionError("Duplicate entry found for sequence " \
+            + Decode(int(all_keys[dups[0]]), self.k) + " in " + name)
+
+        # Big counts go to side table and leave a marker in the counts array
+        big = all_counts >= self.count_max
+        self.overflow_keys = all_keys[big]
+        self.overflow_counts = all_counts[big]
+        self.counts = np.minimum(all_counts, self.count_max).astype(self.counts.dtype)
+        self.keys = all_keys
+        self.num_entries = len(self.keys)
+        self._Index()
+
+    # Build Bloom filter over canonical keys if bloom_bits was given, here or to constructor
+    # BuildKmerIndex.py builds it once after every dump is read, so Save keeps it in the index
+    def BuildBloom(self, log, bloom_bits=None):
+        if bloom_bits is not None:
+            self.bloom_bits = bloom_bits
+        if not self.bloom_bits:
+            return
+        time0 = process_time()
+        self.bloom = KmerBloom(self.num_entries, self.bloom_bits)
+        block = 1 << 22
+        for start in range(0, self.num_entries, block):
+            self.bloom.Add(Canonicals(self.keys[start:start + block], self.k))
+        proc_time = process_time() - time0
+        log.write("Bloom filter of {} bytes ({} bits per k-mer, {} hashes) built in {:.2f} seconds\n".format( \
+            self.bloom.Size(), self.bloom_bits, self.bloom.num_hashes, proc_time))
+
+    # Write arrays to binary index file for Load
+    def Save(self, filename, log=open("/dev/fd/1", 'w')):
+        time0 = process_time()
+        sys.stderr.write("\nWriting k-mer index to " + filename + "...\n")
+
+        # Write to temporary file and rename so a half-written index is never loaded
+        tmpname = filename + ".tmp"
+        bloom_words = self.bloom.words if self.bloom is not None else np.zeros(0, dtype=np.uint64)
+        with open(tmpname, 'wb') as out:
+            out.write(_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, self.k, self.bucket_bits, \
+                self.counts.dtype.itemsize, self.num_entries, len(self.overflow_keys), \
+                (_FLAG_CANONICAL if self.canonical else 0) | (_FLAG_BLOOM if self.bloom is not None else 0), \
+                self.bloom_bits if self.bloom is not None else 0, self.bloom.num_hashes if self.bloom is not None else 0, \
+                len(bloom_words)))
+            out.write(b"\0" * (_HEADER_SIZE - _HEADER.size))
+            for section in (self.offsets, self.keys, self.counts, self.overflow_keys, self.overflow_counts, bloom_words):
+                section.astype(section.dtype.newbyteorder('<'), copy=False).tofile(out)
+                out.write(b"\0" * (-section.nbytes % 8))
+        os.replace(tmpname, filename)
+
+        proc_time = process_time() - time0
+        log.write("K-mer index with " + str(self.num_entries) + " entries written to " + filename + \
+            " at time " + ctime() + "\n")
+        log.write("Index write time: " + str(timedelta(seconds=proc_time)) + " (total seconds = " + str(proc_time) + ")\n")
+        log.flush()
+
+    # Memory-map binary index file written by Save
+    # Arrays are read-only views of the file, so nothing is read until it is queried
+    # If bloom_bits was given, the index's Bloom filter is mapped too, or built if it has none
+    def Load(self, filename, log=open("/dev/fd/1", 'w')):
+        assert self.num_entries == 0, "Load only works on an empty k-mer dictionary"
+        time0 = process_time()
+
+        with open(filename, 'rb') as f:
+            self.index_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, k, bucket_bits, count_size, num_entries, num_overflow, flags, bloom_bits, num_hashes, \
+            num_bloom_words = _HEADER.unpack_from(self.index_map, 0)
+        if magic != INDEX_MAGIC:
+            raise ValueError(filename + " is not a k-mer index file")
+        if version != INDEX_VERSION:
+            raise ValueError("K-mer index " + filename + " has version " + str(version) + \
+            " but this program reads version " + str(INDEX_VERSION) + ". Please rebuild it with BuildKmerIndex.py")
+
+        count_dtype = {2: np.uint16, 4: np.uint32}[count_size]
+        self.k = k
+        self.canonical = bool(flags & _FLAG_CANONICAL)
+        self.fixed_bucket_bits = self.bucket_bits = bucket_bits
+        self.shift = 2 * k - bucket_bits
+        self.count_max = int(np.iinfo(count_dtype).max)
+
+        position = _HEADER_SIZE
+        sections = []
+        for dtype, length in ((np.int64, 2 ** bucket_bits + 1), (np.uint64, num_entries), \
+        (count_dtype, num_entries), (np.uint64, num_overflow), (np.uint64, num_overflow), (np.uint64, num_bloom_words)):
+            dtype = np.dtype(dtype).newbyteorder('<')
+            sections.append(np.frombuffer(self.index_map, dtype=dtype, count=length, offset=position))
+            position += length * dtype.itemsize
+            position += -position % 8
+        self.offsets, self.keys, self.counts, self.overflow_keys, self.overflow_counts, bloom_words = sections
+        self.num_entries = num_entries
+        if self.bloom_bits and flags & _FLAG_BLOOM:
+            self.bloom = KmerBloom(num_entries, bloom_bits, num_hashes, words=bloom_words)
+            self.bloom_bits = bloom_bits
+            log.write("Bloom filter of {} bytes ({} bits per k-mer, {} hashes) mapped from index\n".format( \
+                self.bloom.Size(), self.bloom_bits, self.bloom.num_hashes))
+        elif self.bloom_bits:
+            sys.stderr.write("K-mer index " + filename + " has no Bloom filter, so one is built every run; " \
+                "rebuild the index with BuildKmerIndex.py --bloom-bits to store it\n")
+            self.BuildBloom(log)
+
+        proc_time = process_time() - time0
+        self.cur_size = self.Size()
+        sys.stderr.write(str(self.num_entries) + " kmers and counts mapped from index " + filename + "\n")
+        log.write("K-mer index " + filename + " memory-mapped at time " + ctime() + "\n")
+        log.write("Load time: " + str(timedelta(seconds=proc_time)) + " (total seconds = " + str(proc_time) + ")\n")
+        if self.canonical:
+            log.write("K-mer index " + filename + " holds canonical k-mers\n")
+        log.write("Mapped size is " + str(self.cur_size) + " bytes for " + str(self.num_entries) + " entries\n")
+        log.flush()
+
+    # All counts as uint64, with overflow markers replaced by real counts
+    def _FullCounts(self):
+        counts = self.counts.astype(np.uint64)
+        if len(self.overflow_keys):
+            counts[np.searchsorted(self.keys, self.overflow_keys)] = self.overflow_counts
+        return counts
+
+    # Find count for 2-bit code, or None if not in dictionary
+    def _Lookup(self, code):
+        bucket = code >> self.shift
+        lo = int(self.offsets[bucket])
+        hi = int(self.offsets[bucket + 1])
+        i = bisect_left(self.keys, code, lo, hi)
+        if i == hi or self.keys[i] != code:
+            return None
+        count = int(self.counts[i])
+        if count == self.count_max:
+            count = int(self.overflow_counts[self.overflow_keys.searchsorted(code)])
+        return count
+
+    # Find counts for array of 2-bit codes at once
+    # If mask is given, only codes where it is True are searched for
+    # Returns array of counts (0 if not found) and array of whether each was found
+    def _LookupMany(self, codes, mask=None):
+        if mask is not None:
+            counts = np.zeros(len(codes), dtype=np.uint64)
+            found = np.zeros(len(codes), dtype=bool)
+            where = np.flatnonzero(mask)
+            counts[where], found[where] = self._LookupMany(codes[where])
+            return counts, found
+        if not len(self.keys):
+            return np.zeros(len(codes), dtype=np.uint64), np.zeros(len(codes), dtype=bool)
+        i = np.minimum(np.searchsorted(self.keys, codes), len(self.keys) - 1)
+        found = self.keys[i] == codes
+        counts = np.where(found, self.counts[i], 0).astype(np.uint64)
+        big = found & (counts == self.count_max)
+        if big.any():
+            counts[big] = self.overflow_counts[np.searchsorted(self.overflow_keys, codes[big])]
+        return counts, found
+
+    # Converts sequence to reverse complement
+    def RC(self, seq):
+        return Decode(RCCode(Encode(seq), len(seq)), len(seq))
+
+    # Find count for forward and reverse complement codes of one k-mer
+    # fast=True only checks reverse complement if forward not found
+    # fast=False checks both and logs if both are found
+    # Canonical keys need only one lookup either way
+    # Returns None if neither is found
+    def _QueryCodes(self, fcode, rcode, fast, log):
+        if self.canonical:
+            return self._Lookup(min(fcode, rcode))
+        fcount = self._Lookup(fcode)
+        if fast and fcount is not None:
+            return fcount
+        rcount = self._Lookup(rcode)
+
+        if fcount is not None and rcount is not None:
+            seq = Decode(fcode, self.k)
+            log.write("Both " + seq + " and reverse complement " + Decode(rcode, self.k) + " found in dictionary\n")
+            return max(fcount, rcount)
+        elif fcount is not None:
+            return fcount
+        else:
+            return rcount
+
+    # Find count for k-mer or its reverse complement
+    # Always checks both forward and reverse and logs if both are found
+    def Query(self, seq, log=open("/dev/fd/1", 'w')):
+        try:
+            code = Encode(seq)
+        except AttributeError:
+            sys.stderr.write("Please enter a DNA sequence in quotes\n")
+            raise KeyError
+        count = self._QueryCodes(code, RCCode(code, len(seq)), False, log)
+        if count is None:
+            raise KeyError(seq)
+        return count
+
+    # Find count for k-mer or its reverse complement
+    # Only checks for reverse complement if forward not found
+    def QueryFast(self, seq, log=open("/dev/fd/1", 'w')):
+        code = Encode(seq)
+        count = self._QueryCodes(code, RCCode(code, len(seq)), True, log)
+        if count is None:
+            raise KeyError(seq)
+        return count
+
+    # Find count for every k-mer along sequence, same as calling
+    # QueryFast (or Query if fast=False) on each one, but without slicing out k-mers
+    # Short sequences like single oligos are encoded with rolling codes,
+    # long ones like sliding window runs with NumPy all at once
+    # Returns list of counts (0 if not found) and list of whether each was found
+    def QueryAlong(self, seq, fast=True, log=open("/dev/fd/1", 'w')):
+        if len(seq) < 256:
+            fcodes, rcodes = RollingCodes(seq, self.k)
+            valid = np.array([code is not None for code in fcodes], dtype=bool)
+            fcodes = np.array([code or 0 for code in fcodes], dtype=np.uint64)
+            rcodes = np.array([code or 0 for code in rcodes], dtype=np.uint64)
+        else:
+            fcodes, valid = EncodeAll(seq, self.k)
+            rcodes = RCCodes(fcodes, self.k)
+
+        counts, found = self._QueryMany(fcodes, rcodes, valid, fast, log)
+        return counts.tolist(), found.tolist()
+
+    # Find counts for batch of k-mers at once, same as calling
+    # QueryFast (or Query if fast=False) on each one
+    # kmers is a NumPy array of 2-bit codes or a list of sequences of length k
+    # Returns NumPy array of counts (0 if not found) and array of whether each was found
+    def QueryMany(self, kmers, fast=True, log=open("/dev/fd/1", 'w')):
+        codes, valid = EncodeKmers(kmers, self.k)
+        return self._QueryMany(codes, RCCodes(codes, self.k), valid, fast, log)
+
+    # Find counts for arrays of forward and reverse complement codes
+    # Codes where valid is False are reported not found
+    def _QueryMany(self, fcodes, rcodes, valid, fast, log):
+        # K-mers the Bloom filter rejects are not searched for at all
+        mask = None
+        if self.bloom is not None and len(fcodes) >= MIN_KMERS:
+            valid = valid & self.bloom.MightContain(np.minimum(fcodes, rcodes))
+            mask = valid
+
+        if self.canonical:
+            counts, found = self._LookupMany(np.minimum(fcodes, rcodes), mask)
+            found &= valid
+            counts[~found] = 0
+            return counts, found
+
+        fcounts, ffound = self._LookupMany(fcodes, mask)
+        rcounts, rfound = self._LookupMany(rcodes, mask)
+        ffound &= valid
+        rfound &= valid
+
+        if fast:
+            counts = np.where(ffound, fcounts, rcounts)
+        else:
+            counts = np.maximum(fcounts, rcounts)
+            for i in np.flatnonzero(ffound & rfound):
+                log.write("Both " + Decode(int(fcodes[i]), self.k) + " and reverse complement " + \
+                    Decode(int(rcodes[i]), self.k) + " found in dictionary\n")
+        found = ffound | rfound
+        counts[~found] = 0
+        return counts, found
+
+    # Size of arrays in bytes
+    def Size(self):
+        return self.keys.nbytes + self.counts.nbytes + self.offsets.nbytes + \
+            self.overflow_keys.nbytes + self.overflow_counts.nbytes + \
+            (self.bloom.Size() if self.bloom is not None else 0)
+
+    def PrintAll(self):
+        return dict(zip(map(lambda code: Decode(int(code), self.k), self.keys), self._FullCounts().tolist()))
+    def NumEntries(self):
+        return self.num_entries
+
+    # Help function designed for interactive mode
+    def Help(self):
+        print("# Print all entries in dictionary")
+        print("PrintAll()")
+        print("# Output number of entries in dictionary")
+        print("NumEntries()")
+        print("# Output size of dictionary in bytes")
+        print("Size()")
+        print("# Query count for a particular sequence")
+        print("Query(sequence)")
+        print("# Query counts for every k-mer along a longer sequence")
+        print("QueryAlong(sequence)")
+        print("# Query counts for a list of k-mers or array of 2-bit codes at once")
+        print("QueryMany(kmers)")
+        print("# Release arrays from memory")
+        print("Close()")
+        print("# Display this help menu")
+        print("Help()")
+
+# Demo
+if __name__ == '__main__':
+    pkd = PackedKmerDict()
+    pkd.Populate("fakedump.fa")
+    print("Size =", pkd.Size())
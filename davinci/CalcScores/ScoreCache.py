@@ -0,0 +1,255 @@
+# 17 October 2026
+# Lisa Malins
+# ScoreCache.py
+
+"""
+On-disk cache of oligo scores, so reruns of the pipeline (new sequences,
+bed regions or filter thresholds) only score oligos that weren't scored before.
+
+Scores are kept in an SQLite file, keyed by fingerprint of the k-mer dictionary
+and hash of the oligo sequence. The fingerprint covers the whole contents of each
+dump and every option that changes scores (k, oligo size, fast mode, backend and
+its options), so changing any of them gives new entries instead of wrong scores.
+Hashing a dump means reading all of it, so its digest is kept in the cache too,
+by path, size, modification time and inode, and only worked out again if one of
+those changes.
+Each entry holds the oligo's score against each library and the positions of
+its k-mers not in the (first) dump, so KS:i:, KM:i: and K1:i:, ... tags and
+the missing k-mer log come out the same as if it had been scored again.
+
+The cache is held to a size limit; when it goes over, the entries used least
+recently (by run) are evicted at Close.
+
+Usage:
+from ScoreCache import ScoreCache, Fingerprint
+cache = ScoreCache("scores.cache", ["dump.fa"], settings, max_bytes=1 << 30)
+cache.fingerprint                  # same as Fingerprint(["dump.fa"], settings)
+results = cache.Get(seqs)      # (scores, missing positions), or None if not cached, for each
+cache.Put(seqs, results)
+cache.Flush()                  # write entries from Put and Get to file
+cache.Stats()                  # "... hits, ... misses ..."
+cache.Close()
+"""
+
+import sqlite3
+import json
+from copy import copy
+from hashlib import blake2b, sha1
+from os import stat, path
+
+# Most parameters in one query; older SQLite allows no more than 999
+_MAX_PARAMS = 900
+
+# Bytes of a dump hashed at a time
+_READ_SIZE = 1 << 24
+
+# Digest of the whole contents of a file, as hex string
+def FileDigest(filename):
+    h = blake2b(digest_size=32)
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(_READ_SIZE), b""):
+            h.update(block)
+    return h.hexdigest()
+
+# Fingerprint of k-mer dictionaries from their dump files and options that change scores
+# Dumps are fingerprinted by a digest of their whole contents (from function digest),
+# not by path or time, so copies of the same dump share cache entries
+# Returns hex string
+def Fingerprint(filenames, settings, digest=FileDigest):
+    h = sha1(json.dumps(settings, sort_keys=True).encode())
+    for filename in filenames:
+        h.update(digest(filename).encode())
+    return h.hexdigest()
+
+# Key of oligo sequence in cache
+def OligoHash(seq):
+    return blake2b(seq.encode(), digest_size=16).digest()
+
+class ScoreCache():
+    # dumps: filenames of dumps scored against, settings: options that change scores
+    def __init__(self, filename, dumps, settings, max_bytes=1 << 30, description=""):
+        self.filename = filename
+        self.max_bytes = max_bytes
+        # Statistics for log
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        # Entries from Put and keys of hits from Get, not yet written
+        self.pending_puts = []
+        self.pending_hits = []
+        # Worker processes only read, see Reopen
+        self.worker = False
+
+        self.db = sqlite3.connect(filename)
+        # Write-ahead log lets worker processes read while this one writes
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS dictionaries " \
+            "(id INTEGER PRIMARY KEY, fingerprint TEXT UNIQUE, description TEXT)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS runs (id INTEGER PRIMARY KEY AUTOINCREMENT, time TEXT)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS scores (dictionary INTEGER, oligo BLOB, " \
+            "scores TEXT, missing TEXT, used INTEGER, PRIMARY KEY (dictionary, oligo)) WITHOUT ROWID")
+        self.db.execute("CREATE TABLE IF NOT EXISTS files (path TEXT, size INTEGER, mtime INTEGER, " \
+            "inode INTEGER, digest TEXT, PRIMARY KEY (path, size, mtime, inode))")
+        fingerprint = Fingerprint(dumps, settings, self.Digest)
+        self.fingerprint = fingerprint
+
+        self.db.execute("INSERT OR IGNORE INTO dictionaries (fingerprint, description) VALUES (?, ?)", \
+            (fingerprint, description))
+        self.dictionary = self.db.execute("SELECT id FROM dictionaries WHERE fingerprint = ?", \
+            (fingerprint,)).fetchone()[0]
+        # Each run is one step of age for eviction
+        self.run = self.db.execute("INSERT INTO runs (time) VALUES (datetime('now'))").lastrowid
+        self.db.commit()
+
+    # Digest of whole contents of file, from cache if the file hasn't changed since it was hashed
+    def Digest(self, filename):
+        info = stat(filename)
+        key = (path.abspath(filename), info.st_size, info.st_mtime_ns, info.st_ino)
+        row = self.db.execute("SELECT digest FROM files WHERE path = ? AND size = ? AND mtime = ? AND inode = ?", \
+            key).fetchone()
+        if row:
+            return row[0]
+        digest = FileDigest(filename)
+        self.db.execute("DELETE FROM files WHERE path = ?", key[:1])
+        self.db.execute("INSERT INTO files VALUES (?, ?, ?, ?, ?)", key + (digest,))
+        self.db.commit()
+        return digest
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.Close()
+
+    # Look up list of oligo sequences
+    # Returns list with (list of scores, list of missing k-mer positions)
+    # for each cached oligo and None for the rest
+    def Get(self, seqs):
+        keys = [OligoHash(seq) for seq in seqs]
+        found = {key: (list(map(int, scores.split(","))), list(map(int, missing.split(","))) if missing else []) \
+            for key, scores, missing in self._Lookup(keys, "oligo, scores, missing")}
+
+        results = [found.get(key) for key in keys]
+        num_hits = sum(result is not None for result in results)
+        self.hits += num_hits
+        self.misses += len(keys) - num_hits
+        self.pending_hits.extend(found)
+        return results
+
+    # Returns list of whether each oligo sequence is not cached, without counting hits or misses
+    def Missing(self, seqs):
+        keys = [OligoHash(seq) for seq in seqs]
+        found = set(key for key, in self._Lookup(keys, "oligo"))
+        return [key not in found for key in keys]
+
+    # List of rows of columns for keys in cache, a few hundred keys per query
+    def _Lookup(self, keys, columns):
+        rows = []
+        for i in range(0, len(keys), _MAX_PARAMS):
+            chunk = keys[i:i + _MAX_PARAMS]
+            query = "SELECT " + columns + " FROM scores WHERE dictionary = ? AND oligo IN (" + \
+                ",".join("?" * len(chunk)) + ")"
+            rows.extend(self.db.execute(query, [self.dictionary] + chunk))
+        return rows
+
+    # Add list of oligo sequences and their (scores, missing k-mer positions) to cache
+    def Put(self, seqs, results):
+        self.pending_puts.extend((OligoHash(seq), ",".join(str(s) for s in scores), \
+            ",".join(str(m) for m in missing)) for seq, (scores, missing) in zip(seqs, results))
+
+    # Same cache opened again in a worker process, which can't share this connection
+    # Worker only reads; it hands its entries to this process with TakePending
+    def Reopen(self):
+        worker = copy(self)
+        worker.worker = True
+        worker.db = sqlite3.connect(self.filename)
+        worker.pending_puts, worker.pending_hits = [], []
+        worker.hits = worker.misses = worker.evicted = 0
+        return worker
+
+    # Entries and hits not yet written, and statistics since last call,
+    # so a worker process can hand them to the process that writes the cache
+    def TakePending(self):
+        pending = (self.pending_puts, self.pending_hits, self.hits, self.misses)
+        self.pending_puts, self.pending_hits = [], []
+        self.hits = self.misses = 0
+        return pending
+
+    # Add what a worker process took with TakePending
+    def AddPending(self, pending):
+        puts, hits, num_hits, num_misses = pending
+        self.pending_puts.extend(puts)
+        self.pending_hits.extend(hits)
+        self.hits += num_hits
+        self.misses += num_misses
+
+    # Write new entries, and mark entries that were hit as used by this run
+    # In a worker process, entries are left for TakePending instead
+    def Flush(self):
+        if self.worker:
+            return
+        self.db.executemany("INSERT OR REPLACE INTO scores VALUES (?, ?, ?, ?, ?)", \
+            ((self.dictionary, key, scores, missing, self.run) for key, scores, missing in self.pending_puts))
+        hits = self.pending_hits
+        for i in range(0, len(hits), _MAX_PARAMS):
+            chunk = hits[i:i + _MAX_PARAMS]
+            self.db.execute("UPDATE scores SET used = ? WHERE dictionary = ? AND oligo IN (" + \
+                ",".join("?" * len(chunk)) + ")", [self.run, self.dictionary] + chunk)
+        self.db.commit()
+        self.pending_puts, self.pending_hits = [], []
+
+    # Bytes of file in use
+    def Size(self):
+        page_size = self.db.execute("PRAGMA page_size").fetchone()[0]
+        page_count = self.db.execute("PRAGMA page_count").fetchone()[0]
+        free_pages = self.db.execute("PRAGMA freelist_count").fetchone()[0]
+        return (page_count - free_pages) * page_size
+
+    def NumEntries(self):
+        return self.db.execute("SELECT COUNT(*) FROM scores").fetchone()[0]
+
+    # If cache is over its size limit, delete entries of oldest runs first
+    # until it is at 90% of the limit (freed pages are reused, so the file stops growing)
+    def Evict(self):
+        size = self.Size()
+        if size <= self.max_bytes:
+            return
+        count = self.NumEntries()
+        target = int(count * self.max_bytes / size * 0.9)
+        ages = self.db.execute("SELECT used, COUNT(*) FROM scores GROUP BY used ORDER BY used").fetchall()
+        for used, num_entries in ages:
+            if count <= target:
+                break
+            if count - num_entries >= target:
+                self.db.execute("DELETE FROM scores WHERE used = ?", (used,))
+                num_deleted = num_entries
+            else:
+                num_deleted = count - target
+                self.db.execute("DELETE FROM scores WHERE (dictionary, oligo) IN " \
+                    "(SELECT dictionary, oligo FROM scores WHERE used = ? LIMIT ?)", (used, num_deleted))
+            count -= num_deleted
+            self.evicted += num_deleted
+        # Forget dictionaries with no entries left
+        self.db.execute("DELETE FROM dictionaries WHERE id NOT IN (SELECT DISTINCT dictionary FROM scores)")
+        self.db.commit()
+
+    # Statistics for log
+    def Stats(self):
+        total = self.hits + self.misses
+        return "Score cache {}: {} hits, {} misses ({:.1f}% hit rate), {} entries evicted, {} entries in {} bytes".format( \
+            self.filename, self.hits, self.misses, 100 * self.hits / total if total else 0, \
+            self.evicted, self.NumEntries(), self.Size())
+
+    # Write everything, evict if over size limit, and close file
+    def Close(self):
+        if self.db is None:
+            return
+        if self.worker:
+            self.db.close()
+            self.db = None
+            return
+        self.Flush()
+        self.Evict()
+        self.db.close()
+        self.db = None
@@ -0,0 +1,145 @@
+# 17 October 2026
+# Lisa Malins
+# BatchTm.py
+
+"""
+Melting temperatures of a whole batch of oligos at once, the way
+primer3.calcTm works them out with its default model: SantaLucia (1998)
+nearest-neighbor parameters with SantaLucia salt correction.
+
+Each oligo's enthalpy and entropy are sums of table values over its
+dinucleotides, plus terminal and symmetry terms, so a batch of equal-length
+oligos is a few NumPy table lookups and row sums instead of one primer3 call
+per oligo. Concentrations are the defaults of the installed primer3.calcTm,
+or those given, so both agree. Temperatures match primer3 within TOLERANCE
+degrees (about 0.003 in practice; run this file to check against primer3).
+Oligos with letters other than A, C, G, and T, or longer than primer3's
+nearest-neighbor limit, get NaN and are left to primer3.
+
+Usage:
+from BatchTm import BatchTm
+engine = BatchTm()                      # or BatchTm(mv_conc=50, dv_conc=1.5, ...)
+tms = engine.Tm(["ACGT...", ...])       # NumPy array, NaN where primer3 is needed
+
+Check against primer3:
+python BatchTm.py
+"""
+
+import sys
+import inspect
+try:
+    import numpy as np
+except ImportError:
+    exit("numpy not installed")
+try:
+    import primer3
+except ImportError:
+    exit("primer3-py not installed")
+
+# Largest difference from primer3.calcTm allowed, in degrees
+TOLERANCE = 0.01
+
+# Gas constant (cal/K/mol)
+_R = 1.9872
+
+# SantaLucia (1998) unified nearest-neighbor enthalpy (cal/mol) and entropy (cal/K/mol)
+# of each dinucleotide, indexed by 4 * first base + second base, bases coded A=0, C=1, G=2, T=3
+_NN = {
+    "AA": (-7900, -22.2), "AC": (-8400, -22.4), "AG": (-7800, -21.0), "AT": (-7200, -20.4),
+    "CA": (-8500, -22.7), "CC": (-8000, -19.9), "CG": (-10600, -27.2), "CT": (-7800, -21.0),
+    "GA": (-8200, -22.2), "GC": (-9800, -24.4), "GG": (-8000, -19.9), "GT": (-8400, -22.4),
+    "TA": (-7200, -21.3), "TC": (-8200, -22.2), "TG": (-8500, -22.7), "TT": (-7900, -22.2),
+}
+_DH = np.array([_NN[a + b][0] for a in "ACGT" for b in "ACGT"], dtype=np.float64)
+_DS = np.array([_NN[a + b][1] for a in "ACGT" for b in "ACGT"], dtype=np.float64)
+
+# Initiation with terminal A or T, and with terminal C or G, by base code
+_INIT_DH = np.array([2300, 100, 100, 2300], dtype=np.float64)
+_INIT_DS = np.array([4.1, -2.8, -2.8, 4.1], dtype=np.float64)
+
+# Entropy penalty of self-complementary oligos
+_SYMMETRY_DS = -1.4
+
+# Translation table from ASCII bytes to base codes, with 4 for anything but A, C, G, and T
+_TO_CODES = np.full(256, 4, dtype=np.uint8)
+for _code, _letter in enumerate(b"ACGT"):
+    _TO_CODES[_letter] = _code
+
+# Settings of primer3.calcTm this engine can stand in for, as (name, value)
+_MODEL = (("tm_method", "santalucia"), ("salt_corrections_method", "santalucia"), \
+    ("dmso_conc", 0), ("formamide_conc", 0))
+
+class BatchTm():
+    # params: keyword arguments of primer3.calcTm; the rest are its defaults
+    def __init__(self, **params):
+        self.params = {name: parameter.default for name, parameter in \
+            inspect.signature(primer3.calcTm).parameters.items() if parameter.default is not inspect.Parameter.empty}
+        self.params.update(params)
+        # Whether primer3 would use the model above; if not, every oligo is left to primer3
+        self.supported = all(self.params.get(name, value) == value for name, value in _MODEL)
+        self.max_length = self.params.get("max_nn_length", 60)
+
+        # Monovalent equivalent of salt concentrations (mM), for entropy correction
+        mv, dv, dntp = self.params["mv_conc"], self.params["dv_conc"], self.params["dntp_conc"]
+        self.salt = np.log((mv + (120 * np.sqrt(dv - dntp) if dv > dntp else 0)) / 1000)
+        self.dna_conc = self.params["dna_conc"] * 1e-9
+
+    # Melting temperatures (degrees C) of list of oligo sequences
+    # Returns NumPy array, with NaN for oligos primer3 has to work out
+    def Tm(self, seqs):
+        tms = np.full(len(seqs), np.nan)
+        if not self.supported:
+            return tms
+        lengths = np.array([len(seq) for seq in seqs], dtype=np.int64)
+        # Oligos of each length are one matrix
+        for length in np.unique(lengths).tolist():
+            if length < 2 or length > self.max_length:
+                continue
+            group = np.flatnonzero(lengths == length)
+            text = "".join(seqs[i] for i in group.tolist()).encode()
+            codes = _TO_CODES[np.frombuffer(text, dtype=np.uint8)].reshape(len(group), length)
+            tms[group] = self._Tm(codes)
+        return tms
+
+    # Melting temperatures of matrix of base codes, one oligo per row
+    def _Tm(self, codes):
+        length = codes.shape[1]
+        valid = (codes < 4).all(axis=1)
+        codes = np.where(codes < 4, codes, 0)
+
+        pairs = 4 * codes[:, :-1] + codes[:, 1:]
+        dh = _DH[pairs].sum(axis=1) + _INIT_DH[codes[:, 0]] + _INIT_DH[codes[:, -1]]
+        ds = _DS[pairs].sum(axis=1) + _INIT_DS[codes[:, 0]] + _INIT_DS[codes[:, -1]]
+        ds += 0.368 * (length - 1) * self.salt
+
+        # Self-complementary oligos pair with copies of themselves
+        symmetric = (codes == 3 - codes[:, ::-1]).all(axis=1)
+        ds += np.where(symmetric, _SYMMETRY_DS, 0)
+        strands = np.where(symmetric, self.dna_conc, self.dna_conc / 4)
+
+        tms = dh / (ds + _R * np.log(strands)) - 273.15
+        tms[~valid] = np.nan
+        return tms
+
+# Self-check: batch temperatures of random oligos against primer3.calcTm
+if __name__ == "__main__":
+    import warnings
+    # calcTm is deprecated in newer primer3-py, and says so every call
+    warnings.simplefilter("ignore")
+    rng = np.random.RandomState(45)
+    engine = BatchTm()
+    worst = 0
+    for length in (15, 20, 30, 45, 60):
+        rows = np.frombuffer(b"ACGT", dtype=np.uint8)[rng.randint(0, 4, (2000, length))]
+        seqs = [row.tobytes().decode() for row in rows]
+        # Self-complementary oligos too
+        seqs += [seq[:length // 2] + seq[:length // 2][::-1].translate(str.maketrans("ACGT", "TGCA")) for seq in seqs[:50]]
+        tms = engine.Tm(seqs)
+        exact = np.array([primer3.calcTm(seq) for seq in seqs])
+        error = np.abs(tms - exact).max()
+        worst = max(worst, error)
+        print("{}-mers: largest difference from primer3.calcTm {:.4f} degrees".format(length, error))
+    if not worst <= TOLERANCE:
+        print("Batch melting temperatures differ from primer3 by more than " + str(TOLERANCE) + " degrees")
+        sys.exit(1)
+    print("Batch melting temperatures match primer3 within " + str(TOLERANCE) + " degrees")
@@ -1,45 +1,235 @@
 import sys
 import argparse
 import re
-try:
-    import primer3
-except ImportError:
-    sys.stderr.write("primer3-py not installed")
-    sys.exit(1)
+import gzip
+import io
+import multiprocessing
+from collections import deque
+from os import path
+from Primer3Cache import Primer3Cache
+
+# Oligo stores are read with OligoStore.py, which lives with GetOligos.py
+sys.path.append(path.join(path.dirname(path.abspath(__file__)), "..", "GetOligos"))
+from OligoStore import OligoStore, StoreWriter, IsStoreStart
 
 """
 Returns reason for sequences that fail.
 Returns False for good sequences.
+Melting temperatures come from cache (see Primer3Cache.py) if given one.
+"""
+def primer3filter(seq, min_TM=37, max_HTM=35, min_diff_TM=10, cache=None):
+    if cache is None:
+        cache = _no_cache
+    return cache.Check(seq, min_TM, max_HTM, min_diff_TM)
+
+"""
+Primer3 checks for callers without a cache, made once since making one takes longer than a check.
+"""
+_no_cache = Primer3Cache(0, batch_tm=False)
+
+"""
+Checks sequence against homopolymer filter, then primer3 filter.
+Returns message with reason for sequences that fail, for verbose.
+Returns None for good sequences.
+"""
+def filter_message(name, seq, homopolymer, args, cache=None):
+    # Check for N's and homopolymers of 5 bases or more
+    message = homopolymer_message(name, seq, homopolymer)
+    if message:
+        return message
+
+    # Check for primer3 criteria
+    return primer3_message(name, primer3filter(seq.rstrip(), args.min_tm, args.max_htm, args.min_dtm, cache))
+
+"""
+Returns message for sequences that fail homopolymer filter, None for the rest.
+"""
+def homopolymer_message(name, seq, homopolymer):
+    match = homopolymer.search(seq)
+    if match:
+        return "Sequence {} failed homopolymer filter, sequence contains {}\n".format(name, match.group())
+    return None
+
+"""
+Returns message for reason sequence failed primer3 filter, None if it passed.
+"""
+def primer3_message(name, p3filter):
+    if p3filter:
+        return "Sequence {} failed primer3 filter, reason: {}\n".format(name, p3filter)
+    return None
+
+"""
+Checks sequence against homopolymer filter, then primer3 filter.
+Prints reason to standard error for sequences that fail, if verbose.
+Returns True for good sequences.
+"""
+def passes_filters(name, seq, homopolymer, args, cache=None):
+    message = filter_message(name, seq, homopolymer, args, cache)
+    if message and args.verbose:
+        sys.stderr.write(message)
+    return message is None
+
+"""
+Homopolymer regex, arguments and primer3 cache shared with worker processes,
+set before they are forked. Each worker fills its own copy of the cache.
+"""
+_shared = None
+
+"""
+Checks batch of sequences, in worker process if there are any.
+Sequences that pass homopolymer filter go to primer3 filter together,
+so their melting temperatures are worked out at once (see BatchTm.py).
+Returns message (or None) for each sequence, and primer3 cache statistics of the batch.
+"""
+def filter_batch(batch):
+    homopolymer, args, cache = _shared
+    names, seqs = batch
+    messages = [homopolymer_message(name, seq, homopolymer) for name, seq in zip(names, seqs)]
+    checked = [j for j, message in enumerate(messages) if message is None]
+    reasons = cache.CheckBatch([seqs[j].rstrip() for j in checked], args.min_tm, args.max_htm, args.min_dtm)
+    for j, reason in zip(checked, reasons):
+        messages[j] = primer3_message(names[j], reason)
+    return messages, cache.TakeCounts()
+
+"""
+Checks batches of sequences, in threads worker processes if more than one.
+batches yields (context, names, sequences); only names and sequences go to workers.
+Each sequence goes to the worker its hash picks, so a repeated sequence is always
+checked by the worker whose primer3 cache has seen it.
+Yields (context, message or None for each sequence) in order of batches.
+Only a few batches per worker are read ahead, so input isn't all held in memory.
+Primer3 cache statistics of workers are added to cache.
+"""
+def filter_batches(batches, homopolymer, args, cache, threads=1):
+    global _shared
+    _shared = (homopolymer, args, cache)
+    if threads <= 1:
+        for context, names, seqs in batches:
+            messages, counts = filter_batch((names, seqs))
+            cache.AddCounts(counts)
+            yield context, messages
+        _shared = None
+        return
+
+    pending = deque()
+    pools = [multiprocessing.get_context("fork").Pool(1) for i in range(threads)]
+    try:
+        for context, names, seqs in batches:
+            parts = [[] for pool in pools]
+            for j, seq in enumerate(seqs):
+                parts[hash(seq.rstrip()) % threads].append(j)
+            results = [(part, pool.apply_async(filter_batch, (([names[j] for j in part], [seqs[j] for j in part]),))) \
+                for part, pool in zip(parts, pools) if part]
+            pending.append((context, len(seqs), results))
+            if len(pending) >= 4 * threads:
+                context, num_seqs, results = pending.popleft()
+                yield context, gather_batch(num_seqs, results, cache)
+        while pending:
+            context, num_seqs, results = pending.popleft()
+            yield context, gather_batch(num_seqs, results, cache)
+    finally:
+        for pool in pools:
+            pool.close()
+        for pool in pools:
+            pool.join()
+        _shared = None
+
+"""
+Puts messages of parts of batch checked by different workers back in order of batch.
+results is a list of (positions in batch, result of filter_batch) for each worker given a part.
+Primer3 cache statistics of workers are added to cache.
 """
-def primer3filter(seq, min_TM=37, max_HTM=35, min_diff_TM=10):
+def gather_batch(num_seqs, results, cache):
+    messages = [None] * num_seqs
+    for part, result in results:
+        part_messages, counts = result.get()
+        cache.AddCounts(counts)
+        for j, message in zip(part, part_messages):
+            messages[j] = message
+    return messages
 
-    # Calculate
-    TM = primer3.calcTm(seq)
-    HTM = primer3.calcHairpinTm(seq)
+"""
+Reads fasta of oligos (header line, then sequence line) in batches of batch_size records.
+Yields ((headers, sequences), names, sequences) for filter_batches.
+"""
+def fasta_batches(oligos, batch_size=1024):
+    linecount = 0
+    headers, seqs = [], []
+    while True:
+        # Read and confirm header
+        header = oligos.readline()
+        if not header: break
+        linecount += 1
+        assert header[0] == ">", \
+        "Oligo file {} not in recognized fasta format\nExpected fasta header on line {}, " \
+        "instead found:\n{}\n".format(oligos.name, linecount, header)
 
-    # If melting temperature is too low, filter out
-    if TM < min_TM:
-        return "melting temp too low"
+        # Read sequence
+        seq = oligos.readline()
+        linecount += 1
 
-    # If hairpin melting temperature is too high, filter out
-    elif HTM > max_HTM:
-        return "hairpin melting temp too high"
+        headers.append(header)
+        seqs.append(seq)
+        if len(headers) == batch_size:
+            yield (headers, seqs), [h.strip(">\n") for h in headers], seqs
+            headers, seqs = [], []
+    if headers:
+        yield (headers, seqs), [h.strip(">\n") for h in headers], seqs
 
-    # If melting temperature and hairpin melting temperature
-    # are too close together, filter out
-    elif (TM - HTM) < min_diff_TM:
-        return "difference between melting temp and hairpin melting temp too small"
+"""
+Reads oligo store (see OligoStore.py) in batches of batch_size oligos.
+Yields ((sequence index, starts), names, sequences) for filter_batches.
+"""
+def store_batches(store, batch_size=1024):
+    for names, rows, i, starts in store.BatchesWithRecords(batch_size):
+        width = rows.shape[1]
+        text = rows.tobytes().decode()
+        yield (i, starts), names, [text[j * width:(j + 1) * width] for j in range(len(names))]
+
+"""
+Filters oligo store into another store with only the oligos that pass,
+which keeps the same packed sequences and lists the oligos kept.
+"""
+def filter_store(store, output_name, homopolymer, args, cache, threads=1):
+    with StoreWriter(output_name, store.mer_size, store.step_size) as output:
+        for i in range(len(store.sequences)):
+            output.CopySequence(store, i)
+        kept_sequences = []
+        kept_starts = []
+        for (i, starts), messages in filter_batches(store_batches(store), homopolymer, args, cache, threads):
+            for start, message in zip(starts.tolist(), messages):
+                if message is None:
+                    kept_sequences.append(i)
+                    kept_starts.append(start)
+                elif args.verbose:
+                    sys.stderr.write(message)
+        output.SetRecords(kept_sequences, kept_starts)
 
-    # If sequence will make a good probe, return false (do not filter)
-    else:
-        return False
+"""
+Opens oligo file for reading as text, gzipped or not,
+or as OligoStore if it is an oligo store.
+File is opened once ("-" is standard input) and its first bytes are peeked at,
+so pipes and other files that can't be read twice work too.
+Only a regular file can be an oligo store, which is mapped into memory.
+"""
+def open_fasta(filename):
+    try:
+        f = sys.stdin.buffer if filename == "-" else open(filename, 'rb')
+        if filename != "-" and path.isfile(filename) and IsStoreStart(f.peek(8)):
+            f.close()
+            return OligoStore(filename)
+    except OSError as e:
+        raise argparse.ArgumentTypeError("can't open '{}': {}".format(filename, e.strerror))
+    if f.peek(2)[:2] == b"\x1f\x8b":
+        return io.TextIOWrapper(gzip.GzipFile(fileobj=f))
+    return io.TextIOWrapper(f)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Filter oligos from fasta. Check for homopolymers and primer3 criteria.\n")
 
     # I/O
-    parser.add_argument("-i", "--in", dest="oligos", type=argparse.FileType('r'), help="input fasta filename", required=True)
-    parser.add_argument("-o", "--output", type=argparse.FileType('w'), default="/dev/fd/1", help="output filename (default: standard out)")
+    parser.add_argument("-i", "--in", dest="oligos", type=open_fasta, help="input fasta filename, plain or gzipped, or oligo store from GetOligos.py --store", required=True)
+    parser.add_argument("-o", "--output", type=argparse.FileType('w'), default="/dev/fd/1", help="output filename, an oligo store if input is one (default: standard out)")
 
     # Primer3 arguments
     parser.add_argument("--min-tm", type=int, default=37, help="minimum melting temperature (default: %(default)s)")
@@ -47,6 +237,10 @@ if __name__ == '__main__':
     parser.add_argument("--min-dtm", type=int, default=10, help="minimum difference between melting temperature and hairpin melting temperature (default: %(default)s)")
 
     parser.add_argument("--homopolymer-length", type=int, default=5, help="minimum length of homopolymer to filter out (default: %(default)s)")
+    parser.add_argument("-t", "--threads", type=int, default=1, help="number of worker processes checking batches of oligos at once (default: %(default)s)")
+    parser.add_argument("--primer3-cache", type=int, default=1 << 20, help="number of sequences to remember melting temperatures of, for repeated oligos; 0 for none (default: %(default)s)")
+
+    parser.add_argument("--no-batch-tm", action="store_true", help="have primer3 work out every melting temperature, instead of estimating them a batch at a time (see BatchTm.py)")
 
     parser.add_argument("--verbose", action="store_true", help="print filtered records and reason for filtering to standard error (default: do not print)")
 
@@ -56,35 +250,27 @@ if __name__ == '__main__':
     # or a homopolymer of user-specified length or greater
     homopolymer = re.compile("N|A{{{n}}}|C{{{n}}}|G{{{n}}}|T{{{n}}}".format(n=args.homopolymer_length))
 
-    # Loop through file
-    linecount = 0
-    while True:
-        # Read and confirm header
-        header = args.oligos.readline()
-        if not header: break
-        linecount += 1
-        assert header[0] == ">", \
-        "Oligo file {} not in recognized fasta format\nExpected fasta header on line {}, " \
-        "instead found:\n{}\n".format(args.oligos.name, linecount, header)
+    # Melting temperatures of sequences seen before
+    cache = Primer3Cache(args.primer3_cache, batch_tm=not args.no_batch_tm)
 
-        # Read sequence
-        seq = args.oligos.readline()
-        linecount += 1
+    # Oligo store in, oligo store out
+    if isinstance(args.oligos, OligoStore):
+        args.output.close()
+        filter_store(args.oligos, args.output.name, homopolymer, args, cache, args.threads)
+        args.oligos.Close()
+        sys.stderr.write(cache.Stats() + "\n")
+        sys.exit(0)
+
+    # Loop through file, a batch of records at a time
+    for (headers, seqs), messages in filter_batches(fasta_batches(args.oligos), homopolymer, args, cache, args.threads):
+        for header, seq, message in zip(headers, seqs, messages):
+            if message:
+                if args.verbose:
+                    sys.stderr.write(message)
+                continue
+
+            # Write sequence in fasta format if passes both filters
+            args.output.write(header)
+            args.output.write(seq)
 
-        # Check for N's and homopolymers of 5 bases or more
-        match = homopolymer.search(seq)
-        if match:
-            if args.verbose:
-                sys.stderr.write("Sequence {} failed homopolymer filter, sequence contains {}\n".format(header.strip(">\n"), match.group()))
-            continue
-
-        # Check for primer3 criteria
-        p3filter = primer3filter(seq.rstrip(), args.min_tm, args.max_htm, args.min_dtm)
-        if p3filter:
-            if args.verbose:
-                sys.stderr.write("Sequence {} failed primer3 filter, reason: {}\n".format(header.lstrip(">").rstrip("\n"), p3filter))
-            continue
-
-        # Write sequence in fasta format if passes both filters
-        args.output.write(header)
-        args.output.write(seq)
+    sys.stderr.write(cache.Stats() + "\n")
@@ -15,10 +15,7 @@ python FilterSam.py --help
 
 import sys
 from os import stat
-try:
-    import primer3
-except ImportError:
-    exit("primer3-py not installed")
+from Primer3Cache import Primer3Cache
 from time import ctime
 try:
     from time import process_time
@@ -70,31 +67,32 @@ def bwa_filter(line, min_AS, max_XS):
         return False
 
 # Filter out oligos that would behave unexpectedly as probes
+# Melting temperatures come from cache (see Primer3Cache.py) if given one
 # Returns true to discard oligo; returns false to keep
-def primer3_filter(line, min_TM, max_HTM, min_diff_TM):
+def primer3_filter(line, min_TM, max_HTM, min_diff_TM, cache=None):
     # Get sequence from line passed to function
     sequence = line.split('\t')[9]
 
-    # Calculate
-    TM = primer3.calcTm(sequence)
-    HTM = primer3.calcHairpinTm(sequence)
+    if cache is None:
+        cache = _no_cache
+    return bool(cache.Check(sequence, min_TM, max_HTM, min_diff_TM))
 
-    # If melting temperature is too low, filter out
-    if TM < min_TM:
-        return True
+# Primer3 checks for callers without a cache, made once since making one takes longer than a check
+_no_cache = Primer3Cache(0, batch_tm=False)
 
-    # If hairpin melting temperature is too high, filter out
-    elif HTM > max_HTM:
-        return True
+# Filter batch of lines with primer3 at once, so melting temperatures are
+# worked out together (see BatchTm.py); same result as primer3_filter on each
+# Writes lines that pass to output, and the rest to rejects if given
+def primer3_filter_batch(lines, min_TM, max_HTM, min_diff_TM, cache, output, rejects=None):
+    reasons = cache.CheckBatch([line.split('\t')[9] for line in lines], min_TM, max_HTM, min_diff_TM)
+    for line, reason in zip(lines, reasons):
+        if not reason:
+            output.write(line)
+        elif rejects:
+            rejects.write(line)
 
-    # If melting temperature and hairpin melting temperature
-    # are too close together, filter out
-    elif (TM - HTM) < min_diff_TM:
-        return True
-
-    # If sequence will make a good probe, return false (do not filter)
-    else:
-        return False
+# Lines checked by primer3 at once
+_BATCH_SIZE = 1024
 
 #-------------------main-----------------------
 
@@ -114,6 +112,8 @@ if __name__ == '__main__':
     parser.add_argument("--min-TM", type=int, default=37, help="minimum melting temperature (default: %(default)s)")
     parser.add_argument("--max-HTM", type=int, default=35, help="maximum hairpin melting temperature (default: %(default)s)")
     parser.add_argument("--min-diff-TM", type=int, default=10, help="minimum difference between melting temperature and hairpin melting temperature (default: %(default)s)")
+    parser.add_argument("--primer3-cache", type=int, default=1 << 20, help="number of sequences to remember melting temperatures of, for repeated oligos; 0 for none (default: %(default)s)")
+    parser.add_argument("--no-batch-tm", action="store_true", help="have primer3 work out every melting temperature, instead of estimating them a batch at a time (see BatchTm.py)")
 
     # Other
     parser.add_argument("--write-rejects", action="store_true", help="write rejected oligos to separate output file")
@@ -153,6 +153,12 @@ if __name__ == '__main__':
     filelength = float(stat(args.source.name).st_size)
     percent = 10
 
+    # Melting temperatures of sequences seen before
+    cache = Primer3Cache(args.primer3_cache, batch_tm=not args.no_batch_tm)
+    # Lines that passed BWA filter, waiting for primer3 filter
+    batch = []
+    primer3_rejects = rejects[1] if args.write_rejects else None
+
     print("Filter beginning at " + ctime())
     log.write("\nFiltering began at " + ctime())
 
@@ -167,6 +173,8 @@ if __name__ == '__main__':
 
         # Output all headers
         if line[0] == '@':
+            primer3_filter_batch(batch, args.min_TM, args.max_HTM, args.min_diff_TM, cache, args.output, primer3_rejects)
+            batch = []
             args.output.write(line)
             continue
 
@@ -176,10 +184,13 @@ if __name__ == '__main__':
                 rejects[0].write(line)
             continue
 
-        # If primer3 filtering enabled, discard lines that fail primer3 filter
-        elif args.enable_primer3_filter and primer3_filter(line, args.min_TM, args.max_HTM, args.min_diff_TM):
-            if args.write_rejects:
-                rejects[1].write(line)
+        # If primer3 filtering enabled, discard lines that fail primer3 filter,
+        # checked a batch at a time
+        elif args.enable_primer3_filter:
+            batch.append(line)
+            if len(batch) == _BATCH_SIZE:
+                primer3_filter_batch(batch, args.min_TM, args.max_HTM, args.min_diff_TM, cache, args.output, primer3_rejects)
+                batch = []
             continue
 
         # Write lines that pass both filters
@@ -187,6 +198,8 @@ if __name__ == '__main__':
             args.output.write(line)
 
 
+    primer3_filter_batch(batch, args.min_TM, args.max_HTM, args.min_diff_TM, cache, args.output, primer3_rejects)
+
     # Close file
     args.source.close()
 
@@ -195,6 +208,8 @@ if __name__ == '__main__':
 
     msg = "Filtering completed successfully at " + ctime() + \
     "\nRun time: " + str(timedelta(seconds=proc_time)) + " (total seconds: " + str(proc_time) + ")"
+    if args.enable_primer3_filter:
+        msg += "\n" + cache.Stats()
     log.write("\n" + msg)
     print(msg)
     print("Filtered oligos written to " + args.output.name)
@@ -0,0 +1,154 @@
+# 17 October 2026
+# Lisa Malins
+# Primer3Cache.py
+
+"""
+Primer3 checks of oligos for FilterFasta.py and FilterSam.py, with melting
+temperatures remembered for sequences seen before.
+
+Repeat-rich genomes give the same oligo sequence many times over, and primer3
+(hairpin melting temperature above all) is most of the time spent filtering.
+Temperatures are kept in a least recently used cache of bounded size, keyed by
+sequence; a cache holds temperatures for one set of thermodynamic parameters
+(the ones passed on to primer3), so a cache is made per set.
+
+Temperatures are only worked out when they are needed: hairpin melting
+temperature isn't, for oligos whose melting temperature is already too low.
+
+CheckBatch works out melting temperatures of a whole batch at once with
+BatchTm.py, which is within BatchTm.TOLERANCE degrees of primer3. Only oligos
+that close to a threshold are worked out again by primer3, so every oligo
+passes or fails the same as if primer3 had checked it alone.
+
+Usage:
+from Primer3Cache import Primer3Cache
+cache = Primer3Cache(max_entries=1 << 20)
+reason = cache.Check(seq, min_TM=37, max_HTM=35, min_diff_TM=10)   # reason it fails, or False
+reasons = cache.CheckBatch(seqs, min_TM=37, max_HTM=35, min_diff_TM=10)
+cache.Stats()                                                        # "... hit rate ..., ... primer3 calls avoided ..."
+counts = cache.TakeCounts()                                          # in worker process, then
+cache.AddCounts(counts)                                              # in process writing the log
+"""
+
+from collections import OrderedDict
+from math import isnan
+try:
+    import primer3
+except ImportError:
+    exit("primer3-py not installed")
+from BatchTm import BatchTm, TOLERANCE
+
+class Primer3Cache():
+    # max_entries: sequences to remember, 0 for none
+    # batch_tm: whether CheckBatch estimates melting temperatures with BatchTm
+    # params: thermodynamic parameters passed to primer3.calcTm and primer3.calcHairpinTm
+    def __init__(self, max_entries=1 << 20, batch_tm=True, **params):
+        self.max_entries = max_entries
+        self.params = params
+        self.engine = BatchTm(**params) if batch_tm else None
+        # Sequence -> [melting temp, hairpin melting temp or None if not worked out yet,
+        # whether melting temp is from primer3 rather than BatchTm]
+        self.entries = OrderedDict()
+        # Statistics for log
+        self.lookups = 0
+        self.hits = 0
+        self.tm_calls = 0
+        self.hairpin_calls = 0
+        self.hairpins_skipped = 0
+        self.estimates = 0
+
+    # Entry for sequence, from cache or worked out
+    # estimate: melting temperature from BatchTm, used instead of primer3 unless it is NaN
+    def _Entry(self, seq, estimate=None):
+        self.lookups += 1
+        entry = self.entries.get(seq)
+        if entry is not None:
+            self.hits += 1
+            self.entries.move_to_end(seq)
+            return entry
+        if estimate is None or isnan(estimate):
+            self.tm_calls += 1
+            entry = [primer3.calcTm(seq, **self.params), None, True]
+        else:
+            self.estimates += 1
+            entry = [estimate, None, False]
+        if self.max_entries:
+            self.entries[seq] = entry
+            if len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return entry
+
+    # Melting temperature of entry, from primer3 if an estimate is too close to threshold to tell
+    # which side of it primer3 would put it
+    def _Tm(self, seq, entry, threshold):
+        if not entry[2] and abs(entry[0] - threshold) <= TOLERANCE:
+            self.tm_calls += 1
+            entry[0] = primer3.calcTm(seq, **self.params)
+            entry[2] = True
+        return entry[0]
+
+    # Hairpin melting temperature of entry, worked out the first time it is needed
+    def _HairpinTm(self, seq, entry):
+        if entry[1] is None:
+            self.hairpin_calls += 1
+            entry[1] = primer3.calcHairpinTm(seq, **self.params)
+        return entry[1]
+
+    # Returns reason for sequences that fail
+    # Returns False for good sequences
+    # estimate: melting temperature from BatchTm, if there is one
+    def Check(self, seq, min_TM=37, max_HTM=35, min_diff_TM=10, estimate=None):
+        entry = self._Entry(seq, estimate)
+
+        # If melting temperature is too low, filter out
+        if self._Tm(seq, entry, min_TM) < min_TM:
+            if entry[1] is None:
+                self.hairpins_skipped += 1
+            return "melting temp too low"
+
+        # If hairpin melting temperature is too high, filter out
+        HTM = self._HairpinTm(seq, entry)
+        if HTM > max_HTM:
+            return "hairpin melting temp too high"
+
+        # If melting temperature and hairpin melting temperature
+        # are too close together, filter out
+        elif (self._Tm(seq, entry, HTM + min_diff_TM) - HTM) < min_diff_TM:
+            return "difference between melting temp and hairpin melting temp too small"
+
+        # If sequence will make a good probe, return false (do not filter)
+        else:
+            return False
+
+    # Returns list of reason (or False) for each sequence, the same as Check,
+    # with melting temperatures of the whole batch estimated at once
+    def CheckBatch(self, seqs, min_TM=37, max_HTM=35, min_diff_TM=10):
+        estimates = self.engine.Tm(seqs).tolist() if self.engine else [None] * len(seqs)
+        return [self.Check(seq, min_TM, max_HTM, min_diff_TM, estimate) for seq, estimate in zip(seqs, estimates)]
+
+    # Statistics since last call, so a worker process can hand them to the one writing the log
+    def TakeCounts(self):
+        counts = (self.lookups, self.hits, self.tm_calls, self.hairpin_calls, self.hairpins_skipped, self.estimates)
+        self.lookups = self.hits = self.tm_calls = self.hairpin_calls = self.hairpins_skipped = self.estimates = 0
+        return counts
+
+    # Add statistics a worker process took with TakeCounts
+    def AddCounts(self, counts):
+        lookups, hits, tm_calls, hairpin_calls, hairpins_skipped, estimates = counts
+        self.lookups += lookups
+        self.hits += hits
+        self.tm_calls += tm_calls
+        self.hairpin_calls += hairpin_calls
+        self.hairpins_skipped += hairpins_skipped
+        self.estimates += estimates
+
+    # Number of primer3 calls checking every sequence in full would have made, less those made
+    def Avoided(self):
+        return 2 * self.lookups - self.tm_calls - self.hairpin_calls
+
+    # Statistics for log
+    def Stats(self):
+        return "Primer3 cache: {} sequences, {} hits ({:.1f}% hit rate), {} primer3 calls made, " \
+            "{} avoided ({} hairpins not needed, {} melting temps from batch estimates)".format(self.lookups, \
+            self.hits, 100 * self.hits / self.lookups if self.lookups else 0, self.tm_calls + self.hairpin_calls, \
+            self.Avoided(), self.hairpins_skipped, self.estimates)
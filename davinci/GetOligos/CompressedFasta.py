@@ -0,0 +1,301 @@
+# 17 October 2026
+# Lisa Malins
+# CompressedFasta.py
+
+"""
+Reads fasta files that are plain, gzipped, or BGZF-compressed (bgzip, as
+written by samtools and htslib), so a downloaded genome doesn't have to be
+gunzipped to disk before slicing.
+
+Compressed files are read front to back by GzipReader, which decompresses
+in a background thread while the caller works on what came before; zlib
+lets go of the GIL while it inflates, so the two really run at once.
+
+BGZF files are a series of gzip members of at most 64 KB each, so with a
+.gzi index (uncompressed offset of each member) BgzfReader can seek to any
+position of the uncompressed file and read from there, like a plain file
+opened in binary. The .gzi is the one `bgzip -r` and `samtools faidx` write;
+if it is missing it is built from the member headers without inflating them.
+
+Usage:
+from CompressedFasta import OpenFasta, OpenSeekable, IsGzip, IsBgzf
+genome = OpenFasta("genome.fa.gz")       # read(), readline(), tell(), close() like a text file
+genome = OpenSeekable("genome.fa.gz")    # seek(), read() like a binary file; BGZF or plain only
+for line in OpenLines("genome.fa.gz"):   # binary lines, for indexing
+"""
+
+import struct
+import threading
+import zlib
+from codecs import getincrementaldecoder
+import gzip
+from os import path, stat, replace, getpid
+from queue import Queue
+from bisect import bisect_right
+
+# First bytes of every gzip member
+_GZIP_MAGIC = b"\x1f\x8b"
+
+# Compressed bytes read at a time
+_CHUNK_SIZE = 1 << 20
+
+# Largest BGZF member
+_MAX_BLOCK_SIZE = 1 << 16
+
+# Decompressed chunks waiting for reader; bounds memory if reader is slow
+_QUEUE_SIZE = 16
+
+# Whether file is gzipped (BGZF included)
+def IsGzip(filename):
+    with open(filename, 'rb') as f:
+        return f.read(2) == _GZIP_MAGIC
+
+# Whether file is BGZF: gzip member with extra field holding BC subfield (block size)
+def IsBgzf(filename):
+    with open(filename, 'rb') as f:
+        header = f.read(18)
+    return len(header) == 18 and header[:4] == b"\x1f\x8b\x08\x04" and header[12:14] == b"BC"
+
+# Opens fasta file for reading front to back in text mode,
+# decompressing in background thread if it is gzipped
+def OpenFasta(filename):
+    if IsGzip(filename):
+        return GzipReader(filename)
+    return open(filename, 'r')
+
+# Opens fasta file for reading line by line in binary mode, gzipped or not
+def OpenLines(filename):
+    if IsGzip(filename):
+        return gzip.open(filename, 'rb')
+    return open(filename, 'rb')
+
+# Opens fasta file for random access in binary mode
+# Raises ValueError for gzipped files that aren't BGZF, which can only be read front to back
+def OpenSeekable(filename):
+    if not IsGzip(filename):
+        return open(filename, 'rb')
+    if not IsBgzf(filename):
+        raise ValueError(filename + " is gzipped but not BGZF, so it can't be read at random; " \
+            "recompress it with bgzip for that")
+    return BgzfReader(filename)
+
+# Name of genome with .gz extension taken off, for naming outputs
+def StripGz(filename):
+    return filename[:-3] if filename.endswith(".gz") else filename
+
+# Text reader of gzipped file, decompressed by a background thread
+# Has the parts of a text file GetOligos uses: read(n), readline(), tell(), close() and name.
+# tell() is the position in the compressed file, so it can be compared to its size for progress.
+class GzipReader():
+    def __init__(self, filename):
+        self.name = filename
+        self.raw = open(filename, 'rb')
+        self.chunks = Queue(_QUEUE_SIZE)
+        self.buffer = ""
+        self.pos = 0
+        self.done = False
+        self.compressed_pos = 0
+        self.error = None
+        self.closed = False
+        self.thread = threading.Thread(target=self._Decompress, daemon=True)
+        self.thread.start()
+
+    # Background thread: inflate every gzip member in turn and hand text to reader
+    # Queue gets (text, compressed position) tuples, then None at end of file
+    def _Decompress(self):
+        try:
+            inflater = zlib.decompressobj(zlib.MAX_WBITS | 16)
+            decoder = getincrementaldecoder("utf-8")()
+            # Whether current member has been given any bytes
+            started = False
+            offset = 0
+            while not self.closed:
+                data = self.raw.read(_CHUNK_SIZE)
+                if not data:
+                    break
+                offset += len(data)
+                text = []
+                while data:
+                    started = True
+                    text.append(inflater.decompress(data))
+                    if not inflater.eof:
+                        break
+                    # Next member begins right after this one
+                    data = inflater.unused_data
+                    inflater = zlib.decompressobj(zlib.MAX_WBITS | 16)
+                    started = False
+                self.chunks.put((decoder.decode(b"".join(text)), offset))
+            if started and not self.closed:
+                raise EOFError("Compressed file " + self.name + " ended in the middle of a gzip member")
+            self.chunks.put((decoder.decode(b"", final=True), offset))
+        except Exception as e:
+            self.error = e
+        self.chunks.put(None)
+
+    # Take next chunk of text from background thread into buffer
+    # Returns False at end of file
+    def _Fill(self):
+        if self.done:
+            return False
+        item = self.chunks.get()
+        if item is None:
+            self.done = True
+            if self.error:
+                raise self.error
+            return False
+        text, self.compressed_pos = item
+        self.buffer = self.buffer[self.pos:] + text
+        self.pos = 0
+        return True
+
+    # Read up to n characters, or everything left
+    def read(self, n=-1):
+        while (n < 0 or len(self.buffer) - self.pos < n) and self._Fill():
+            pass
+        end = len(self.buffer) if n < 0 else self.pos + n
+        text = self.buffer[self.pos:end]
+        self.pos += len(text)
+        return text
+
+    # Read up to and including next newline, or everything left
+    def readline(self):
+        while True:
+            end = self.buffer.find("\n", self.pos)
+            if end >= 0 or not self._Fill():
+                break
+        end = len(self.buffer) if end < 0 else end + 1
+        text = self.buffer[self.pos:end]
+        self.pos = end
+        return text
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+    # Position in compressed file of text read so far, within one chunk
+    def tell(self):
+        return self.compressed_pos
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        # Let background thread finish if it is waiting on a full queue
+        while self.thread.is_alive():
+            while not self.chunks.empty():
+                self.chunks.get()
+            self.thread.join(0.01)
+        self.raw.close()
+
+# Reads BGZF .gzi index: number of entries, then (compressed, uncompressed) offset of
+# the start of every member after the first, all as little-endian 64-bit integers
+# Returns lists of compressed and uncompressed offsets, including the first member at 0, 0
+def ReadGzi(gzi_name):
+    with open(gzi_name, 'rb') as f:
+        num_entries, = struct.unpack("<Q", f.read(8))
+        values = struct.unpack("<" + str(2 * num_entries) + "Q", f.read(16 * num_entries))
+    return [0] + list(values[0::2]), [0] + list(values[1::2])
+
+# Writes BGZF .gzi index, all at once so other jobs never read half of it
+def WriteGzi(gzi_name, compressed, uncompressed):
+    tmp = gzi_name + "." + str(getpid()) + ".tmp"
+    with open(tmp, 'wb') as f:
+        f.write(struct.pack("<Q", len(compressed) - 1))
+        for entry in zip(compressed[1:], uncompressed[1:]):
+            f.write(struct.pack("<QQ", *entry))
+    replace(tmp, gzi_name)
+
+# Walks headers of BGZF members: each one gives its compressed size,
+# and its last 4 bytes give its uncompressed size, so nothing is inflated
+# Returns lists of compressed and uncompressed offsets of each member
+def BuildGzi(filename):
+    compressed, uncompressed = [], []
+    coffset = uoffset = 0
+    size = stat(filename).st_size
+    with open(filename, 'rb') as f:
+        while coffset < size:
+            f.seek(coffset)
+            header = f.read(18)
+            if len(header) < 18 or header[:4] != b"\x1f\x8b\x08\x04" or header[12:14] != b"BC":
+                raise ValueError(filename + " is not BGZF at byte " + str(coffset))
+            block_size = struct.unpack("<H", header[16:18])[0] + 1
+            f.seek(coffset + block_size - 4)
+            isize, = struct.unpack("<I", f.read(4))
+            # Empty end-of-file member needn't be indexed
+            if isize:
+                compressed.append(coffset)
+                uncompressed.append(uoffset)
+            coffset += block_size
+            uoffset += isize
+    if not compressed:
+        compressed, uncompressed = [0], [0]
+    return compressed, uncompressed
+
+# Binary reader of BGZF file at any uncompressed position, using its .gzi index
+# Has the parts of a binary file GetOligos uses: seek(), read(n), tell(), close() and name.
+class BgzfReader():
+    def __init__(self, filename):
+        self.name = filename
+        gzi_name = filename + ".gzi"
+        if path.exists(gzi_name) and stat(gzi_name).st_mtime >= stat(filename).st_mtime:
+            self.compressed, self.uncompressed = ReadGzi(gzi_name)
+        else:
+            self.compressed, self.uncompressed = BuildGzi(filename)
+            # Keep index for next time if genome's folder can be written to
+            try:
+                WriteGzi(gzi_name, self.compressed, self.uncompressed)
+            except OSError:
+                pass
+        self.raw = open(filename, 'rb')
+        self.seek(0)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    # Move to uncompressed position: start inflating at the member that holds it
+    # and skip the bytes before it
+    def seek(self, offset):
+        i = bisect_right(self.uncompressed, offset) - 1
+        self.raw.seek(self.compressed[i])
+        self.inflater = zlib.decompressobj(zlib.MAX_WBITS | 16)
+        self.buffer = b""
+        self.offset = self.uncompressed[i]
+        self.read(offset - self.offset)
+
+    # Read up to n bytes, or everything left
+    def read(self, n=-1):
+        parts = [self.buffer]
+        have = len(self.buffer)
+        while n < 0 or have < n:
+            data = b""
+            if self.inflater.eof:
+                # Next member begins right after this one
+                data = self.inflater.unused_data
+                self.inflater = zlib.decompressobj(zlib.MAX_WBITS | 16)
+            if not data:
+                data = self.raw.read(_MAX_BLOCK_SIZE)
+            if not data:
+                break
+            text = self.inflater.decompress(data)
+            parts.append(text)
+            have += len(text)
+        data = b"".join(parts)
+        if n < 0:
+            n = len(data)
+        self.buffer = data[n:]
+        self.offset += min(n, len(data))
+        return data[:n]
+
+    def tell(self):
+        return self.offset
+
+    def close(self):
+        self.raw.close()
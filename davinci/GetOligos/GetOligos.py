@@ -6,7 +6,15 @@
 Script slices fasta genome assembly into overlapping oligos.
 
 Required argument: genome filename
-Optional arguments: kmer size, step size, output filename, log filename, sequences to keep.
+Optional arguments: kmer size, step size, output filename, log filename, sequences to keep,
+number of worker processes.
+
+Genome may be plain, gzipped, or BGZF-compressed (bgzip); gzipped genomes are
+decompressed in a background thread while slicing.
+
+With --sequences or --seqfile (or --threads), the genome's samtools .fai index
+is used to seek straight to each sequence; it is built next to the genome
+if it is missing or older than the genome.
 
 For more usage information:
 python GetOligos.py --help
@@ -14,76 +22,505 @@ python GetOligos.py --help
 
 import sys
 import argparse
-from os import stat
-from time import ctime
+import multiprocessing
+from os import stat, path, replace, remove
+from shutil import copyfileobj
+from collections import Counter
+from OligoStore import StoreWriter
+from CompressedFasta import OpenFasta, OpenLines, OpenSeekable, IsGzip, IsBgzf, StripGz
+from time import ctime, time
 try:
     from time import process_time
 except:
     from time import clock as process_time #python2
 from datetime import timedelta
+try:
+    import numpy as np
+except ImportError:
+    exit("numpy not installed")
+
+# Slices one sequence record into oligos as its letters arrive in blocks.
+# Keeps only the letters not yet part of a finished oligo, so memory
+# doesn't grow with the length of the record.
+# Oligo i starts at base 1 + i * step_size and is named id_index, as always.
+# With a WindowFilter, oligos it rejects are left out (names of the rest don't change)
+# and counted in dropped by reason.
+class Slicer:
+
+    def __init__(self, id, mer_size, step_size, window_filter=None):
+        self.prefix = np.frombuffer((">" + str(id) + "_").encode(), dtype=np.uint8)
+        self.mer_size = mer_size
+        self.step_size = step_size
+        # Letters from position offset on (0-based)
+        self.seq = ""
+        self.offset = 0
+        # Start of next oligo (0-based)
+        self.next = 0
+        self.num_oligos = 0
+        self.window_filter = window_filter
+        self.dropped = Counter()
+
+    # Adds letters to end of record
+    # Returns text of every oligo now complete, in fasta format
+    def Add(self, letters):
+        return "".join(self.Format(*group) for group in self.Complete(letters))
+
+    # Adds letters to end of record
+    # Returns starts (0-based) of every oligo now complete, as NumPy array, for an oligo store
+    def AddStarts(self, letters):
+        groups = self.Complete(letters)
+        return np.concatenate([starts for _, starts, _, _ in groups]) if groups else np.zeros(0, dtype=np.int64)
+
+    # Adds letters to end of record
+    # Returns list of (letters, starts, base, width) for each group of oligos now complete,
+    # where letters is NumPy array of ASCII bytes beginning at position base of the record
+    # and each oligo is width letters from its start; oligos window_filter rejects are left out
+    def Complete(self, letters):
+        seq = self.seq + letters
+        m, step = self.mer_size, self.step_size
+        # Start of last oligo that fits in letters so far
+        last = self.offset + len(seq) - m
+        groups = []
+        codes = np.frombuffer(seq.encode(), dtype=np.uint8)
+
+        # First oligo
+        if self.next == 0 and last >= 0:
+            groups.append(self.Kept(codes, np.zeros(1, dtype=np.int64), 0, m))
+            self.next = step
+
+        # With step size larger than oligo size, every oligo after the first
+        # is the step_size letters just read, ending where the oligo would
+        shift = max(0, step - m)
+        width = max(m, step)
+        if 0 < self.next <= last:
+            starts = np.arange(self.next, last + 1, step, dtype=np.int64)
+            groups.append(self.Kept(codes, starts, self.offset + shift, width))
+            self.next = int(starts[-1]) + step
+
+        # Forget letters before the next oligo
+        keep = self.next - shift if self.next else 0
+        self.seq = seq[keep - self.offset:]
+        self.offset = keep
+        return groups
+
+    # Group of oligos with the ones window_filter rejects left out, and counted
+    def Kept(self, letters, starts, base, width):
+        if self.window_filter:
+            starts = starts[self.window_filter.Keep(letters, starts - base, width, self.dropped)]
+        self.num_oligos += len(starts)
+        return letters, starts, base, width
+
+    # Fasta text of oligos beginning at starts, with width letters each from letters,
+    # where letters begins at position base of the record
+    # Built as one matrix of bytes per number of digits in the index
+    def Format(self, letters, starts, base, width):
+        # Every window of width letters, without copying them
+        windows = np.lib.stride_tricks.as_strided(letters, (len(letters) - width + 1, width), (1, 1))
+        p = len(self.prefix)
+        text = []
+        # Starts are in order, so each number of digits is one stretch of them
+        bounds = np.searchsorted(starts + 1, _POWERS_OF_10)
+        for num_digits in range(1, len(_POWERS_OF_10)):
+            group = slice(bounds[num_digits - 1], bounds[num_digits])
+            indices = starts[group] + 1
+            if not len(indices):
+                continue
+            rows = np.empty((len(indices), p + num_digits + width + 2), dtype=np.uint8)
+            rows[:, :p] = self.prefix
+            for i in range(num_digits):
+                rows[:, p + num_digits - 1 - i] = indices % 10 + ord("0")
+                indices //= 10
+            rows[:, p + num_digits] = ord("\n")
+            rows[:, p + num_digits + 1:-1] = windows[starts[group] - base]
+            rows[:, -1] = ord("\n")
+            text.append(rows.tobytes().decode())
+        return "".join(text)
+
+# Drops oligos before they are written, instead of FilterFasta.py throwing them out later
+# homopolymer_length: drop oligos with an N or a run of that many of the same base
+# (same as the homopolymer regex of FilterFasta.py), 0 for off
+# max_masked: drop oligos with more than this fraction of soft-masked (lowercase) letters,
+# which most assemblies use for repeats, None for off
+# Runs are found once for each block of sequence, and each oligo is checked with
+# a few differences of cumulative sums, however long it is
+class WindowFilter:
+
+    def __init__(self, homopolymer_length=0, max_masked=None):
+        self.homopolymer_length = homopolymer_length
+        self.max_masked = max_masked
+
+    def __bool__(self):
+        return self.homopolymer_length > 0 or self.max_masked is not None
+
+    # List of (reason, description) of oligos this filter drops, for log
+    def Reasons(self):
+        reasons = []
+        if self.homopolymer_length:
+            reasons.append(("N", "with N"))
+            reasons.append(("homopolymer", "with homopolymers of " + str(self.homopolymer_length) + " bases or more"))
+        if self.max_masked is not None:
+            reasons.append(("masked", "more than " + str(self.max_masked) + " soft-masked"))
+        return reasons
+
+    # Returns array of whether to keep each oligo of width letters beginning at positions
+    # of letters (NumPy array of ASCII bytes), and adds oligos dropped to Counter dropped by reason
+    def Keep(self, letters, positions, width, dropped):
+        keep = np.ones(len(positions), dtype=bool)
+        if not len(positions):
+            return keep
+        n = self.homopolymer_length
+        if n:
+            # N anywhere in oligo
+            n_sums = np.concatenate(([0], np.cumsum(letters == ord("N"))))
+            has_n = n_sums[positions + width] > n_sums[positions]
+
+            # Position j ends a homopolymer if it is A, C, G, or T, and so are the n - 1 before it
+            same = np.concatenate(([False], letters[1:] == letters[:-1]))
+            same_sums = np.concatenate(([0], np.cumsum(same)))
+            ends = np.zeros(len(letters) + 1, dtype=np.int64)
+            if len(letters) >= n:
+                ends[n:] = ((same_sums[n:] - same_sums[1:len(letters) - n + 2]) == n - 1) & _IS_ACGT[letters[n - 1:]]
+            end_sums = np.cumsum(ends)
+            # Homopolymer ending anywhere from n - 1 letters into oligo to its end
+            has_run = end_sums[positions + width] > end_sums[np.minimum(positions + n - 1, positions + width)]
+
+            dropped["N"] += int(has_n.sum())
+            dropped["homopolymer"] += int((has_run & ~has_n).sum())
+            keep &= ~(has_n | has_run)
+        if self.max_masked is not None:
+            # Lowercase letters in oligo
+            masked_sums = np.concatenate(([0], np.cumsum(letters >= ord("a"))))
+            too_masked = masked_sums[positions + width] - masked_sums[positions] > self.max_masked * width
+            dropped["masked"] += int((too_masked & keep).sum())
+            keep &= ~too_masked
+        return keep
+
+# Whether each ASCII byte is an uppercase base, for WindowFilter
+_IS_ACGT = np.zeros(256, dtype=bool)
+_IS_ACGT[np.frombuffer(b"ACGT", dtype=np.uint8)] = True
+
+# Smallest index with each number of digits, for Slicer.Format
+_POWERS_OF_10 = 10 ** np.arange(19, dtype=np.int64)
+
+# Letters of sequence text, without newlines or other whitespace
+# Raises ValueError with the letters before anything but ASCII letters and whitespace
+def Letters(text):
+    letters = "".join(text.split())
+    if letters and not (letters.isascii() and letters.isalpha()):
+        i = next(i for i, letter in enumerate(letters) if not (letter.isascii() and letter.isalpha()))
+        raise ValueError(letters[:i], letters[i])
+    return letters
+
+# Reads genome in blocks of about block_size characters, each ending at end of a line,
+# and slices every sequence (or only those in seqs_to_read) into oligos written to output.
+# Returns number of bases sliced, number of oligos written, and Counter of oligos
+# dropped by window_filter by reason
+def SliceGenome(source, output, log, mer_size=45, step_size=3, seqs_to_read=None, block_size=1 << 20, \
+    window_filter=None):
+    slicer = None
+    num_bases = 0
+    num_oligos = 0
+    dropped = Counter()
+    for id, text in SequenceText(source, log, seqs_to_read, block_size):
+        # Header: finish previous sequence and start next one
+        if text is None:
+            if slicer:
+                num_oligos += slicer.num_oligos
+                dropped += slicer.dropped
+            slicer = Slicer(id, mer_size, step_size, window_filter)
+            continue
+        try:
+            num_bases += AddText(slicer, text, output, source.name)
+        except ValueError as e:
+            print(e.args[0])
+            sys.exit(1)
 
-class HeaderException(Exception):
-    pass
-
-class Kmer:
+    if slicer:
+        num_oligos += slicer.num_oligos
+        dropped += slicer.dropped
+    return num_bases, num_oligos, dropped
 
-    # Starts a new k-mer with given index and sequence
-    def StartNew(self, id, seq):
-        self.seq = seq
-        self.id = id
-        self.index = 1
+# Reads genome in blocks of about block_size characters, each ending at end of a line.
+# Headers are lines beginning with >, and the id of a sequence is the first word of its header.
+# Yields (id, None) at the header of every sequence (or only those in seqs_to_read),
+# then (id, text) for each piece of its sequence lines, newlines and all
+def SequenceText(source, log, seqs_to_read=None, block_size=1 << 20):
+    filelength = float(stat(source.name).st_size)
+    percent = 10
+    reading = False
 
-    # Appends next sequence and forgets the same # characters that is added
-    def Advance(self, addition):
-        self.seq = self.seq[len(addition):] + addition
-        self.index += len(addition)
+    while True:
+        block = source.read(block_size)
+        if not block:
+            break
+        block += source.readline()
 
+        # Progress messages
+        while source.tell() / filelength * 100 >= percent:
+            print("Read progress : " + str(percent) + "%")
+            percent += 10
 
-# Finds headers returns the id.
-# If user specified sequences to read, this function skips over sequences not in user's list.
-def NextHeader(source, log, line=" ", read_all_seqs=True, seqs_to_read=""):
-    while True:
-        # If the next line is a header
-        if line[0] == ">":
-            id = line[1:].split()[0]
-            if read_all_seqs:
-                return id
-            elif id in seqs_to_read:
-                return id
-            else:
-                log.write("Ignored sequence:\n" + line)
-
-        line = args.genome.readline()
-
-# Reads the specified number of characters from source and returns string
-def ReadChars(source, length):
-    addition = ""
-    while len(addition) < length:
-        next_letter = source.read(1)
-
-        # Append letters
-        if next_letter.isalpha():
-            addition += next_letter
-        # Ignore whitespace
-        elif next_letter.isspace():
-            continue
-        # Throw headers back
-        elif next_letter == '>':
-            line = ">" + source.readline()
-            raise HeaderException(line)
-        # Throw EOF when out of letters
-        elif not next_letter:
-            raise EOFError
-        # Anything else is a problem
+        # Block starts at beginning of a line, and so does each piece of it
+        pos = 0
+        while pos < len(block):
+            # Header: start next sequence, or skip it
+            if block[pos] == ">":
+                end = block.find("\n", pos) + 1 or len(block)
+                header = block[pos:end]
+                id = header[1:].split()[0]
+                reading = seqs_to_read is None or id in seqs_to_read
+                if reading:
+                    yield id, None
+                else:
+                    log.write("Ignored sequence:\n" + header)
+                pos = end
+                continue
+
+            # Sequence lines up to next header
+            end = block.find("\n>", pos) + 1 or len(block)
+            if reading:
+                yield id, block[pos:end]
+            pos = end
+
+# Adds letters of sequence text to slicer and writes the oligos they finish
+# Raises ValueError on anything but letters and whitespace, after writing oligos before it
+# Returns number of letters added
+def AddText(slicer, text, output, source_name):
+    try:
+        letters = Letters(text)
+    except ValueError as e:
+        letters, bad = e.args
+        output.write(slicer.Add(letters))
+        raise ValueError("Unexpected character " + bad + " from file " + source_name)
+    output.write(slicer.Add(letters))
+    return len(letters)
+
+# Index entry of each sequence, like a line of a samtools .fai file:
+# [name, length, offset, linebases, linewidth, end]
+# where offset and end are the byte range of its sequence lines in the genome file
+
+# Reads .fai index of genome, or builds one if it is missing or older than genome
+# Index is saved as genome.fai if samtools could use it (every sequence has lines
+# of one length but the last, and names are unique); otherwise it is only kept for this run
+# Returns list of index entries in file order
+def LoadFai(genome_name, log):
+    fai_name = genome_name + ".fai"
+    if path.exists(fai_name) and stat(fai_name).st_mtime >= stat(genome_name).st_mtime:
+        log.write("Reading index " + fai_name + "\n")
+        return ReadFai(fai_name)
+
+    time0 = process_time()
+    entries, regular = BuildFai(genome_name)
+    log.write("Indexed {} sequences of {} in {:.2f} seconds\n".format(len(entries), genome_name, process_time() - time0))
+    if regular and len(set(entry[0] for entry in entries)) == len(entries):
+        WriteFai(fai_name, entries)
+        log.write("Index written to " + fai_name + "\n")
+    else:
+        log.write("Lines of genome are uneven or names repeat, so index isn't saved\n")
+    return entries
+
+# Reads samtools .fai file
+def ReadFai(fai_name):
+    entries = []
+    with open(fai_name, 'r') as f:
+        for line in f:
+            name, length, offset, linebases, linewidth = line.rstrip("\n").split("\t")[:5]
+            length, offset, linebases, linewidth = int(length), int(offset), int(linebases), int(linewidth)
+            # Full lines, then whatever is left on the last line
+            end = offset
+            if linebases:
+                end += length // linebases * linewidth + length % linebases
+            entries.append([name, length, offset, linebases, linewidth, end])
+    return entries
+
+# Writes samtools .fai file, all at once so other jobs never read half of it
+def WriteFai(fai_name, entries):
+    tmp = fai_name + "." + str(multiprocessing.current_process().pid) + ".tmp"
+    with open(tmp, 'w') as f:
+        for name, length, offset, linebases, linewidth, end in entries:
+            f.write("\t".join(map(str, (name, length, offset, linebases, linewidth))) + "\n")
+    replace(tmp, fai_name)
+
+# Scans genome for index entries, one line at a time
+# Returns list of index entries, and whether samtools could use them:
+# every sequence has lines of one length but the last, without blank lines between
+def BuildFai(genome_name):
+    entries = []
+    regular = True
+    entry = None
+    offset = 0
+    with OpenLines(genome_name) as f:
+        for line in f:
+            offset += len(line)
+            if line[:1] == b">":
+                if entry:
+                    entry[5] = offset - len(line)
+                entry = [line[1:].split()[0].decode(), 0, offset, 0, 0, offset]
+                # Whether a line shorter than the first has been seen in this sequence
+                ended = False
+                entries.append(entry)
+                continue
+            if entry is None:
+                continue
+
+            bases = line.rstrip(b"\r\n")
+            if ended and bases:
+                regular = False
+            elif not entry[3]:
+                entry[3], entry[4] = len(bases), len(line)
+            elif len(bases) != entry[3] or len(line) != entry[4]:
+                ended = True
+                regular &= len(bases) < entry[3]
+            if len(bases.split()) > 1:
+                regular = False
+            entry[1] += len(bases)
+    if entry:
+        entry[5] = offset
+    return entries, regular
+
+# Slices one sequence of genome, read straight from its place in the file
+# Returns number of bases sliced, number of oligos written, and Counter of oligos dropped by reason
+def SliceRecord(genome_name, entry, output, mer_size=45, step_size=3, block_size=1 << 20, window_filter=None):
+    slicer = Slicer(entry[0], mer_size, step_size, window_filter)
+    num_bases = 0
+    for text in RecordText(genome_name, entry, block_size):
+        num_bases += AddText(slicer, text, output, genome_name)
+    return num_bases, slicer.num_oligos, slicer.dropped
+
+# Yields sequence lines of one sequence of genome in blocks of up to block_size characters,
+# read straight from its place in the file
+def RecordText(genome_name, entry, block_size=1 << 20):
+    name, length, offset, linebases, linewidth, end = entry
+    with OpenSeekable(genome_name) as f:
+        f.seek(offset)
+        while offset < end:
+            block = f.read(min(block_size, end - offset))
+            if not block:
+                break
+            offset += len(block)
+            yield block.decode("ascii", errors="replace")
+
+# Slice one sequence into its own shard file in worker process
+# Returns number of bases sliced, number of oligos written, and Counter of oligos dropped by reason
+def SliceShard(task):
+    genome_name, entry, shard_name, mer_size, step_size, window_filter = task
+    with open(shard_name, 'w') as shard:
+        return SliceRecord(genome_name, entry, shard, mer_size, step_size, window_filter=window_filter)
+
+# Slices sequences of genome (or only those in seqs_to_read) using its index,
+# so sequences that aren't wanted are never read.
+# With threads > 1, each sequence is sliced by a worker process into its own
+# shard file, and shards are appended to output in file order as they finish,
+# so output is the same as slicing them one after another.
+# Returns number of bases sliced, number of oligos written, and Counter of oligos
+# dropped by window_filter by reason
+def SliceIndexed(genome_name, entries, output, log, mer_size=45, step_size=3, seqs_to_read=None, threads=1, \
+    window_filter=None):
+    selected = SelectEntries(entries, log, seqs_to_read)
+    num_bases = 0
+    num_oligos = 0
+    dropped = Counter()
+    if threads <= 1:
+        for i, entry in enumerate(selected):
+            try:
+                bases, oligos, record_dropped = SliceRecord(genome_name, entry, output, mer_size, step_size, \
+                    window_filter=window_filter)
+            except ValueError as e:
+                print(e.args[0])
+                sys.exit(1)
+            num_bases += bases
+            num_oligos += oligos
+            dropped += record_dropped
+            print("Sliced sequence " + entry[0] + " (" + str(i + 1) + " of " + str(len(selected)) + ")")
+        return num_bases, num_oligos, dropped
+
+    shards = [output.name + "." + str(i) + ".part" for i in range(len(selected))]
+    tasks = [(genome_name, entry, shard, mer_size, step_size, window_filter) for entry, shard in zip(selected, shards)]
+    pool = multiprocessing.get_context("fork").Pool(threads)
+    try:
+        # imap returns results in order of tasks, even if they finish out of order
+        for i, (bases, oligos, record_dropped) in enumerate(pool.imap(SliceShard, tasks)):
+            with open(shards[i], 'r') as shard:
+                copyfileobj(shard, output, 1 << 20)
+            remove(shards[i])
+            num_bases += bases
+            num_oligos += oligos
+            dropped += record_dropped
+            print("Sliced sequence " + selected[i][0] + " (" + str(i + 1) + " of " + str(len(selected)) + ")")
+    except ValueError as e:
+        print(e.args[0])
+        sys.exit(1)
+    finally:
+        pool.close()
+        pool.join()
+        for shard in shards:
+            if path.exists(shard):
+                remove(shard)
+    return num_bases, num_oligos, dropped
+
+# Index entries of sequences in seqs_to_read (or all), logging the rest as ignored
+def SelectEntries(entries, log, seqs_to_read=None):
+    selected = []
+    for entry in entries:
+        if seqs_to_read is None or entry[0] in seqs_to_read:
+            selected.append(entry)
         else:
-            print("Unexpected character", next_letter, "from file", source.name)
+            log.write("Ignored sequence:\n" + entry[0] + "\n")
+    return selected
+
+# Yields (id, None) for each sequence of index entries, then (id, text) for each
+# block of its sequence lines, read straight from its place in the file, like SequenceText
+def IndexedText(genome_name, entries, block_size=1 << 20):
+    for i, entry in enumerate(entries):
+        yield entry[0], None
+        for text in RecordText(genome_name, entry, block_size):
+            yield entry[0], text
+        print("Read sequence " + entry[0] + " (" + str(i + 1) + " of " + str(len(entries)) + ")")
+
+# Packs sequences into oligo store (see OligoStore.py) instead of slicing them
+# pieces are (id, None) at each sequence and (id, text) for its sequence lines,
+# from SequenceText or IndexedText
+# With a WindowFilter, only the oligos it keeps are listed in the store as records
+# Returns number of bases stored, number of oligos they hold, and Counter of oligos
+# dropped by window_filter by reason
+def StoreGenome(pieces, store, source_name, window_filter=None):
+    num_bases = 0
+    dropped = Counter()
+    # Oligos window_filter keeps, as (sequence index, start) records
+    slicer = None
+    seq_indices, starts = [], []
+    for id, text in pieces:
+        if text is None:
+            store.Begin(id)
+            if window_filter:
+                if slicer:
+                    dropped += slicer.dropped
+                slicer = Slicer(id, store.mer_size, store.step_size, window_filter)
+            continue
+        try:
+            letters = Letters(text)
+        except ValueError as e:
+            letters, bad = e.args
+            store.Add(letters)
+            print("Unexpected character " + bad + " from file " + source_name)
             sys.exit(1)
-    return addition
-
+        store.Add(letters)
+        num_bases += len(letters)
+        if slicer:
+            kept = slicer.AddStarts(letters)
+            seq_indices.append(np.full(len(kept), len(store.sequences), dtype=np.int32))
+            starts.append(kept)
+    store.End()
+    if window_filter:
+        if slicer:
+            dropped += slicer.dropped
+        store.SetRecords(np.concatenate(seq_indices) if seq_indices else [], \
+            np.concatenate(starts) if starts else [])
+    return num_bases, sum(entry["num_oligos"] for entry in store.sequences), dropped
 
 def read_args():
     parser = argparse.ArgumentParser("Get oligos from a genome assembly.\n")
-    parser.add_argument("-g", "--genome", type=argparse.FileType('r'), required=True, help="filename of genome assembly to get oligos from")
+    parser.add_argument("-g", "--genome", required=True, help="filename of genome assembly to get oligos from, plain, gzipped or BGZF-compressed")
     parser.add_argument("-m", "--mer-size", type=int, default=45, help="desired oligo size in bases")
     parser.add_argument("-s", "--step-size", type=int, default=3, help="number of bases between start of consecutive oligos")
     parser.add_argument("-o", "--output", type=argparse.FileType('w'), help="output filename")
@@ -92,18 +529,32 @@ def read_args():
     sequence_args = parser.add_mutually_exclusive_group()
     sequence_args.add_argument("--sequences", type=str, nargs="+", help="space-separated list of sequences to get oligos from (default: all)")
     sequence_args.add_argument("--seqfile", type=argparse.FileType('r'), help="file with list of sequences to get oligos from, one per line (default: all)")
+    parser.add_argument("-t", "--threads", type=int, default=1, help="number of worker processes slicing sequences at once, each into its own shard (default: 1)")
+    parser.add_argument("--no-index", action="store_true", help="read the whole genome instead of seeking to sequences with its .fai index")
+    parser.add_argument("--store", action="store_true", help="write a compact oligo store (2-bit genome and step parameters, see OligoStore.py) instead of fasta")
+    parser.add_argument("--homopolymer-length", type=int, default=0, help="skip oligos with an N or a homopolymer of this many bases or more, as FilterFasta.py would (default: 0, keep all)")
+    parser.add_argument("--max-masked", type=float, help="skip oligos with more than this fraction of soft-masked (lowercase) bases, e.g. repeats (default: keep all)")
 
     args = parser.parse_args()
 
+    # Open genome, decompressing in background if it is gzipped
+    try:
+        args.genome = OpenFasta(args.genome)
+    except OSError as e:
+        parser.error("can't open '{}': {}".format(args.genome, e.strerror))
+
     # Validate mer size and step size
     if args.mer_size == 0:
         raise Exception("Error: mer size must be greater than 0")
     if args.step_size == 0:
         raise Exception("Error: step size must be greater than 0")
+    if args.max_masked is not None and not 0 <= args.max_masked <= 1:
+        parser.error("--max-masked must be a fraction between 0 and 1")
 
     # Set default output and log filenames
     if args.output is None:
-        args.output = open(args.genome.name.rsplit('.', 1)[0] + "_" + str(args.mer_size) + "mers.fa", 'w')
+        args.output = open(StripGz(args.genome.name).rsplit('.', 1)[0] + "_" + str(args.mer_size) + "mers" + \
+            (".oligos" if args.store else ".fa"), 'w')
     if args.log is None:
         args.log = open(args.output.name.rsplit('.', 1)[0] + ".log", 'w')
 
@@ -135,10 +586,6 @@ args.log.write(" Step size: " + str(args.step_size) + "\n")
 args.log.write("Oligos written to: " + args.output.name + "\n\n")
 
 
-# Get length of file for progress output
-filelength = float(stat(args.genome.name).st_size)
-percent = 10
-
 # Begin status messages to screen
 print("Reading " + str(args.mer_size) + "-mers with step size of " + str(args.step_size) + \
 " from " + args.genome.name + " and writing to " + args.output.name)
@@ -149,47 +596,65 @@ print("Progress messages may not reach 100% because of ignored sequences.")
 args.log.write("\nGenome slicing into oligos beginning at " + ctime() + "\n\n")
 
 time0 = process_time()
-
-# Create Kmer object
-kmer = Kmer()
-line = " "
-
-# Main loop for getting oligos
-try:
-    while True:
-        # Progress messages
-        if (args.genome.tell() / filelength * 100 >= percent):
-            print("Read progress : " + str(percent) + "%")
-            percent += 10
-
-        # Get header, start new k-mer
-        if read_all_seqs:
-            id = NextHeader(args.genome, args.log, line)
+wall0 = time()
+
+# Oligos to skip instead of writing
+window_filter = WindowFilter(args.homopolymer_length, args.max_masked)
+if window_filter:
+    args.log.write("Skipping oligos " + ", ".join(description for _, description in window_filter.Reasons()) + "\n")
+
+# Slice every sequence (or the ones asked for) into oligos
+# Seek to each sequence with index, unless every sequence is read one after another anyway
+# Plain gzip can only be read front to back; BGZF can be read at random like an uncompressed file
+seekable = not IsGzip(args.genome.name) or IsBgzf(args.genome.name)
+if not seekable and not args.no_index and (not read_all_seqs or args.threads > 1):
+    args.log.write("Genome is gzipped but not BGZF, so whole genome is read in one process\n")
+if args.store:
+    # Store is written by StoreWriter, in binary
+    args.output.close()
+    if args.threads > 1:
+        args.log.write("Oligo store is written by one process\n")
+    with StoreWriter(args.output.name, args.mer_size, args.step_size) as store:
+        if args.no_index or not seekable or read_all_seqs:
+            pieces = SequenceText(args.genome, args.log, None if read_all_seqs else seqs_to_read)
         else:
-            id = NextHeader(args.genome, args.log, line, read_all_seqs=False, seqs_to_read=seqs_to_read)
-
-        kmer.StartNew(id, ReadChars(args.genome, args.mer_size))
-
-        # Get k-mers until header encountered
-        while True:
-            args.output.write(">" + str(id) + "_" + str(kmer.index) + "\n")
-            args.output.write(kmer.seq + "\n")
-            try:
-                kmer.Advance(ReadChars(args.genome, args.step_size))
-            # Catch header line and carry to next main loop iteration
-            except HeaderException as e:
-                line = e.args[0]
-                break
-
-# Aaaaaaand stick the landing
-except (IndexError, EOFError) as e:
+            args.genome.close()
+            entries = SelectEntries(LoadFai(args.genome.name, args.log), args.log, seqs_to_read)
+            pieces = IndexedText(args.genome.name, entries)
+        num_bases, num_oligos, dropped = StoreGenome(pieces, store, args.genome.name, window_filter)
+    args.log.write("Oligo store written to " + args.output.name + "\n")
+elif args.no_index or not seekable or (read_all_seqs and args.threads <= 1):
+    num_bases, num_oligos, dropped = SliceGenome(args.genome, args.output, args.log, args.mer_size, args.step_size, \
+        None if read_all_seqs else seqs_to_read, window_filter=window_filter)
+else:
+    # Sequences are read straight from their place in the file instead
     args.genome.close()
+    entries = LoadFai(args.genome.name, args.log)
+    # Read or build BGZF .gzi index once, before any worker opens the genome
+    OpenSeekable(args.genome.name).close()
+    num_bases, num_oligos, dropped = SliceIndexed(args.genome.name, entries, args.output, args.log, args.mer_size, \
+        args.step_size, None if read_all_seqs else seqs_to_read, args.threads, window_filter)
 
-    proc_time = process_time() - time0
-
-    print("Finished writing " + str(args.mer_size) + "-mers to " + args.output.name)
-    print("Program finished successfully at " + ctime())
-    print("Total time " + str(timedelta(seconds=proc_time)) + " (" + str(proc_time) + " seconds)")
-    print("Log available at " + args.log.name)
-    args.log.write("\nGenome slicing into oligos finished successfully at " + ctime() + "\n")
-    args.log.write("Total time " + str(timedelta(seconds=proc_time)) + " (" + str(proc_time) + " seconds)\n")
+# Aaaaaaand stick the landing
+args.genome.close()
+args.output.close()
+
+proc_time = process_time() - time0
+# Worker processes' time isn't counted in this one's, so go by wall clock
+if args.threads > 1:
+    proc_time = time() - wall0
+rate = "{} bases sliced into {} oligos ({:.0f} bases/s)".format(num_bases, num_oligos, num_bases / max(proc_time, 1e-9))
+
+print("Finished writing " + str(args.mer_size) + "-mers to " + args.output.name)
+print("Program finished successfully at " + ctime())
+print("Total time " + str(timedelta(seconds=proc_time)) + " (" + str(proc_time) + " seconds)")
+print(rate)
+print("Log available at " + args.log.name)
+args.log.write("\nGenome slicing into oligos finished successfully at " + ctime() + "\n")
+args.log.write("Total time " + str(timedelta(seconds=proc_time)) + " (" + str(proc_time) + " seconds)\n")
+args.log.write(rate + "\n")
+if window_filter:
+    skipped = str(sum(dropped.values())) + " oligos skipped: " + \
+        ", ".join(str(dropped[reason]) + " " + description for reason, description in window_filter.Reasons())
+    print(skipped)
+    args.log.write(skipped + "\n")
@@ -0,0 +1,379 @@
+# 17 October 2026
+# Lisa Malins
+# OligoStore.py
+
+"""
+Compact store of oligos, written by GetOligos.py --store instead of a fasta
+file that repeats every base of the genome mer_size / step_size times.
+
+A store holds a 2-bit packed copy of each sliced sequence (4 bases per byte),
+with runs of lowercase letters and of letters other than A, C, G, and T
+kept on the side so sequences come back exactly as they were, plus the oligo
+size and step size. Oligos of a whole sequence follow from those alone; a
+subset of them (e.g. the ones that passed FilterFasta.py) is kept as a list
+of (sequence, start) records. Oligos come back with the same names and
+letters as the fasta file GetOligos.py writes, including its quirk for step
+sizes larger than oligo size.
+
+Oligos are read a batch at a time as rows of a NumPy array of ASCII bytes.
+Each sequence is unpacked once, and the rows of a whole sequence are a
+strided view of it, so no oligo is copied. Fasta is only written (WriteFasta,
+or running this file) when a tool like bwa mem needs it.
+
+File layout: magic, then packed bases and side runs of each sequence and
+the records (each 8-byte aligned so they can be viewed in place), then a JSON
+footer describing them, then the footer's offset and magic again.
+
+Usage:
+from OligoStore import OligoStore, StoreWriter, IsStore
+with StoreWriter("chr1_45mers.oligos", 45, 3) as store:
+    store.Begin("chr1")
+    store.Add("ACGTNNacgt...")              # letters of sequence, as many times as needed
+
+store = OligoStore("chr1_45mers.oligos")
+for names, rows in store.Batches(4096):    # rows: NumPy array, one oligo per row
+    ...
+store.WriteFasta(open("chr1_45mers.fa", 'w'))
+
+Convert store to fasta:
+python OligoStore.py chr1_45mers.oligos chr1_45mers.fa
+"""
+
+import sys
+import json
+import mmap
+import struct
+try:
+    import numpy as np
+except ImportError:
+    exit("numpy not installed")
+
+# First and last 8 bytes of every store
+_MAGIC = b"OLIGOS1\n"
+
+# Translation table from ASCII uppercase letters to 2-bit codes, with 4 for anything but A, C, G, and T
+_TO_CODES = np.full(256, 4, dtype=np.uint8)
+for _code, _letter in enumerate(b"ACGT"):
+    _TO_CODES[_letter] = _code
+_FROM_CODES = np.frombuffer(b"ACGT", dtype=np.uint8)
+
+# Whether file is an oligo store
+def IsStore(filename):
+    with open(filename, 'rb') as f:
+        return IsStoreStart(f.read(len(_MAGIC)))
+
+# Whether first bytes of a file are those of an oligo store
+def IsStoreStart(data):
+    return data[:len(_MAGIC)] == _MAGIC
+
+# Starts and ends of runs of equal nonzero values in array keys
+# Returns arrays of starts, ends, and value of each run
+def Runs(keys):
+    change = np.flatnonzero(keys[1:] != keys[:-1]) + 1
+    starts = np.concatenate(([0], change))
+    ends = np.concatenate((change, [len(keys)]))
+    values = keys[starts]
+    keep = values != 0
+    return starts[keep], ends[keep], values[keep]
+
+# Positions covered by runs from starts to ends
+def RunPositions(starts, ends):
+    lengths = ends - starts
+    if not len(lengths):
+        return np.zeros(0, dtype=np.int64)
+    # Start of each run, minus where it begins among all the positions
+    return np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+
+# Smallest index with each number of digits, for FastaText
+_POWERS_OF_10 = 10 ** np.arange(19, dtype=np.int64)
+
+# Fasta text of oligos named prefix + index, for array of indices in increasing order
+# and array of their letters with one oligo per row
+# Built as one matrix of bytes per number of digits in the index, like Slicer.Format in GetOligos.py
+def FastaText(prefix, indices, rows):
+    p = len(prefix)
+    width = rows.shape[1]
+    text = []
+    bounds = np.searchsorted(indices, _POWERS_OF_10)
+    for num_digits in range(1, len(_POWERS_OF_10)):
+        group = slice(bounds[num_digits - 1], bounds[num_digits])
+        digits = indices[group].copy()
+        if not len(digits):
+            continue
+        lines = np.empty((len(digits), p + num_digits + width + 2), dtype=np.uint8)
+        lines[:, :p] = prefix
+        for j in range(num_digits):
+            lines[:, p + num_digits - 1 - j] = digits % 10 + ord("0")
+            digits //= 10
+        lines[:, p + num_digits] = ord("\n")
+        lines[:, p + num_digits + 1:-1] = rows[group]
+        lines[:, -1] = ord("\n")
+        text.append(lines.tobytes().decode())
+    return "".join(text)
+
+# Number of oligos GetOligos.py slices from a sequence of given length
+def NumOligos(length, mer_size, step_size):
+    return max(0, (length - mer_size) // step_size + 1)
+
+# Writes an oligo store one sequence at a time, letters as they are read
+class StoreWriter():
+    def __init__(self, filename, mer_size=45, step_size=3):
+        self.name = filename
+        self.file = open(filename, 'wb')
+        # Bytes written so far, counted so the store can be written to a pipe
+        self.pos = 0
+        self._Write(_MAGIC)
+        self.mer_size = mer_size
+        self.step_size = step_size
+        self.sequences = []
+        self.records = None
+        self.current = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.Close()
+
+    def _Write(self, data):
+        self.file.write(data)
+        self.pos += len(data)
+
+    # Pad file to a multiple of 8 bytes, so the next array can be viewed in place
+    def _Align(self):
+        self._Write(b"\0" * (-self.pos % 8))
+
+    # Write NumPy array at next aligned offset
+    # Returns its offset
+    def _WriteArray(self, array):
+        self._Align()
+        offset = self.pos
+        self._Write(np.ascontiguousarray(array).tobytes())
+        return offset
+
+    # Start next sequence
+    def Begin(self, name):
+        self.End()
+        self._Align()
+        self.current = {"name": name, "length": 0, "offset": self.pos}
+        # Codes not yet packed (fewer than 4), and runs so far
+        self.carry = np.zeros(0, dtype=np.uint8)
+        self.lower = []
+        self.other = []
+
+    # Add letters (str of ASCII letters) to end of current sequence
+    def Add(self, letters):
+        if not letters:
+            return
+        pos = self.current["length"]
+        raw = np.frombuffer(letters.encode(), dtype=np.uint8)
+        upper = raw & np.uint8(0xDF)
+        codes = _TO_CODES[upper]
+
+        # Runs of lowercase letters, and of each letter other than A, C, G, and T
+        # Runs touching the end of the last letters are joined with them
+        for runs, keys in ((self.lower, (raw >= ord("a")).astype(np.uint8)), \
+        (self.other, np.where(codes == 4, upper, 0))):
+            starts, ends, values = Runs(keys)
+            starts, ends = starts + pos, ends + pos
+            if len(starts) and runs and runs[-1][1] == starts[0] and runs[-1][2] == values[0]:
+                runs[-1][1] = int(ends[0])
+                starts, ends, values = starts[1:], ends[1:], values[1:]
+            runs.extend([s, e, v] for s, e, v in zip(starts.tolist(), ends.tolist(), values.tolist()))
+        codes[codes == 4] = 0
+
+        # Pack 4 codes per byte, first base in the high bits
+        codes = np.concatenate((self.carry, codes))
+        whole = len(codes) // 4 * 4
+        self._Write(self.Pack(codes[:whole]).tobytes())
+        self.carry = codes[whole:]
+        self.current["length"] = pos + len(letters)
+
+    # Pack array of codes (length a multiple of 4) into bytes
+    @staticmethod
+    def Pack(codes):
+        return (codes[0::4] << 6) | (codes[1::4] << 4) | (codes[2::4] << 2) | codes[3::4]
+
+    # Finish current sequence
+    def End(self):
+        if self.current is None:
+            return
+        if len(self.carry):
+            codes = np.zeros(4, dtype=np.uint8)
+            codes[:len(self.carry)] = self.carry
+            self._Write(self.Pack(codes).tobytes())
+        lower = np.array([run[:2] for run in self.lower], dtype=np.int64).reshape(-1, 2)
+        other = np.array([run[:2] for run in self.other], dtype=np.int64).reshape(-1, 2)
+        self.current["lower"] = [self._WriteArray(lower), len(lower)]
+        self.current["other"] = [self._WriteArray(other), len(other)]
+        self.current["other_letters"] = self._WriteArray(np.array([run[2] for run in self.other], dtype=np.uint8))
+        self.current["num_oligos"] = NumOligos(self.current["length"], self.mer_size, self.step_size)
+        self.sequences.append(self.current)
+        self.current = None
+
+    # Copy sequence i of another store as it is, without unpacking it
+    def CopySequence(self, store, i):
+        self.End()
+        entry = dict(store.sequences[i])
+        length = entry["length"]
+        entry["offset"] = self._WriteArray(store._Packed(i))
+        num_lower = entry["lower"][1]
+        num_other = entry["other"][1]
+        entry["lower"] = [self._WriteArray(store._Array(store.sequences[i]["lower"][0], np.int64, 2 * num_lower)), num_lower]
+        entry["other"] = [self._WriteArray(store._Array(store.sequences[i]["other"][0], np.int64, 2 * num_other)), num_other]
+        entry["other_letters"] = self._WriteArray(store._Array(store.sequences[i]["other_letters"], np.uint8, num_other))
+        entry["num_oligos"] = NumOligos(length, self.mer_size, self.step_size)
+        self.sequences.append(entry)
+
+    # Keep only some oligos: arrays of sequence index and start (0-based) of each,
+    # sorted by sequence index, then start
+    def SetRecords(self, seq_indices, starts):
+        self.End()
+        seq_indices = np.asarray(seq_indices, dtype=np.int32)
+        starts = np.asarray(starts, dtype=np.int64)
+        self.records = {"sequences": self._WriteArray(seq_indices), "starts": self._WriteArray(starts), \
+            "count": len(starts)}
+        # First record of each sequence
+        first = np.searchsorted(seq_indices, np.arange(len(self.sequences) + 1))
+        for entry, begin, end in zip(self.sequences, first[:-1].tolist(), first[1:].tolist()):
+            entry["first_record"] = begin
+            entry["num_oligos"] = end - begin
+
+    # Write footer and close file
+    def Close(self):
+        if self.file is None:
+            return
+        self.End()
+        footer = json.dumps({"mer_size": self.mer_size, "step_size": self.step_size, \
+            "sequences": self.sequences, "records": self.records}).encode()
+        self._Align()
+        offset = self.pos
+        self._Write(footer)
+        self._Write(struct.pack("<Q", offset) + _MAGIC)
+        self.file.close()
+        self.file = None
+
+# Reads an oligo store
+class OligoStore():
+    def __init__(self, filename):
+        self.name = filename
+        with open(filename, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[:len(_MAGIC)] != _MAGIC or self.map[-len(_MAGIC):] != _MAGIC:
+            raise ValueError(filename + " is not an oligo store, or was not finished")
+        offset, = struct.unpack("<Q", self.map[-8 - len(_MAGIC):-len(_MAGIC)])
+        footer = json.loads(self.map[offset:-8 - len(_MAGIC)].decode())
+        self.mer_size = footer["mer_size"]
+        self.step_size = footer["step_size"]
+        self.sequences = footer["sequences"]
+        self.records = footer["records"]
+        # Last sequence unpacked, as (index, letters)
+        self.unpacked = (None, None)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.Close()
+
+    # NumPy array of count items of dtype at offset of file, without copying
+    def _Array(self, offset, dtype, count):
+        return np.frombuffer(self.map, dtype=dtype, count=count, offset=offset)
+
+    # Packed bytes of sequence i
+    def _Packed(self, i):
+        entry = self.sequences[i]
+        return self._Array(entry["offset"], np.uint8, -(-entry["length"] // 4))
+
+    # Letters of sequence i as NumPy array of ASCII bytes, exactly as in the genome
+    # Last one unpacked is kept, since its oligos are usually read in order
+    def Sequence(self, i):
+        if self.unpacked[0] == i:
+            return self.unpacked[1]
+        entry = self.sequences[i]
+        packed = self._Packed(i)
+        codes = np.empty((len(packed), 4), dtype=np.uint8)
+        for j, shift in enumerate((6, 4, 2, 0)):
+            codes[:, j] = (packed >> shift) & 3
+        letters = _FROM_CODES[codes.reshape(-1)[:entry["length"]]]
+
+        offset, count = entry["other"]
+        runs = self._Array(offset, np.int64, 2 * count).reshape(-1, 2)
+        run_letters = self._Array(entry["other_letters"], np.uint8, count)
+        letters[RunPositions(runs[:, 0], runs[:, 1])] = np.repeat(run_letters, runs[:, 1] - runs[:, 0])
+        offset, count = entry["lower"]
+        runs = self._Array(offset, np.int64, 2 * count).reshape(-1, 2)
+        letters[RunPositions(runs[:, 0], runs[:, 1])] |= np.uint8(0x20)
+
+        self.unpacked = (i, letters)
+        return letters
+
+    # Starts (0-based) of oligos of sequence i, as NumPy array
+    def Starts(self, i):
+        entry = self.sequences[i]
+        if self.records is None:
+            return np.arange(entry["num_oligos"], dtype=np.int64) * self.step_size
+        first = entry["first_record"]
+        return self._Array(self.records["starts"], np.int64, self.records["count"])[first:first + entry["num_oligos"]]
+
+    def NumOligos(self):
+        return sum(entry["num_oligos"] for entry in self.sequences)
+
+    # Yields (names, rows, sequence index, starts) of oligos of sequence i in batches,
+    # where rows is NumPy array of ASCII bytes with one oligo per row
+    # Like GetOligos.py, with step size larger than oligo size every oligo but the first
+    # is the step_size letters ending where it would, so the first comes in a batch of its own
+    def _SequenceBatches(self, i, batch_size=4096):
+        m, step = self.mer_size, self.step_size
+        letters = self.Sequence(i)
+        starts = self.Starts(i)
+        name = self.sequences[i]["name"] + "_"
+        if len(starts) and starts[0] == 0 and step > m:
+            yield [name + "1"], letters[None, :m], i, starts[:1]
+            starts = starts[1:]
+        shift = max(0, step - m)
+        width = max(m, step)
+        # Every window of width letters, without copying them
+        windows = np.lib.stride_tricks.as_strided(letters, (max(0, len(letters) - width + 1), width), (1, 1))
+        implicit = self.records is None
+        for j in range(0, len(starts), batch_size):
+            batch = starts[j:j + batch_size]
+            names = [name + str(start + 1) for start in batch.tolist()]
+            if implicit:
+                # Evenly spaced, so rows are one more strided view
+                first = int(batch[0]) - shift
+                rows = np.lib.stride_tricks.as_strided(letters[first:], (len(batch), width), (step, 1))
+            else:
+                rows = windows[batch - shift]
+            yield names, rows, i, batch
+
+    # Yields (names, rows) of every oligo in batches of up to batch_size, in file order
+    # rows is NumPy array of ASCII bytes with one oligo per row; don't write to it
+    def Batches(self, batch_size=4096):
+        for i in range(len(self.sequences)):
+            for names, rows, _, _ in self._SequenceBatches(i, batch_size):
+                yield names, rows
+
+    # Same as Batches, but also yields sequence index and starts of each batch, for SetRecords
+    def BatchesWithRecords(self, batch_size=4096):
+        for i in range(len(self.sequences)):
+            yield from self._SequenceBatches(i, batch_size)
+
+    # Write every oligo in fasta format, the same as GetOligos.py writes it
+    def WriteFasta(self, output, batch_size=1 << 16):
+        for names, rows, i, starts in self.BatchesWithRecords(batch_size):
+            prefix = np.frombuffer((">" + self.sequences[i]["name"] + "_").encode(), dtype=np.uint8)
+            output.write(FastaText(prefix, starts + 1, rows))
+
+    def Close(self):
+        self.unpacked = (None, None)
+        self.map.close()
+
+# Convert store to fasta
+if __name__ == '__main__':
+    if len(sys.argv) not in (2, 3):
+        exit("Usage: python OligoStore.py oligos.store [output.fa]")
+    output = open(sys.argv[2], 'w') if len(sys.argv) == 3 else sys.stdout
+    with OligoStore(sys.argv[1]) as store:
+        store.WriteFasta(output)
+    output.close()
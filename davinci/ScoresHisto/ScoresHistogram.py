@@ -57,9 +57,11 @@ while(line):
     if (source.tell() / filelength * 100) > percent:
         print("Read progress: " + str(percent) + "%")
         percent += 10
-    # Get score and put into dictionary
-    score = line.split("\t")[-1][5:].rstrip("\n")
-    scores_dict[score] += 1
+    # Get score from KS:i: tag (other tags like KM:i: may follow it) and put into dictionary
+    for field in line.rstrip("\n").split("\t")[11:]:
+        if field[:5] == "KS:i:":
+            scores_dict[field[5:]] += 1
+            break
 
     line = source.readline()
 